@@ -0,0 +1,3 @@
+from .benchmarks import Benchmark, BenchmarkSuite
+
+__all__ = ["Benchmark", "BenchmarkSuite"]
@@ -0,0 +1,81 @@
+import argparse
+import logging
+from benchmarks import BenchmarkSuite
+
+
+def parse_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-g",
+        "--grammar",
+        type=str,
+        default="experiment.json",
+        help="filepath to JSON file containing grammar"
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        type=int,
+        default=0,
+        help="specify the seed for the random-generator"
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default="benchmarks/baseline.json",
+        help="JSON file with the baseline timings"
+    )
+    parser.add_argument(
+        "--save",
+        action="store_true",
+        default=False,
+        help="store the measured timings as new baseline"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="relative slowdown of the median that counts as regression"
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="scales the number of iterations of every benchmark"
+    )
+    parser.add_argument(
+        "-k",
+        "--select",
+        type=str,
+        nargs="*",
+        help="only run benchmarks whose name contains one of the strings"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="h3fuzz micro-benchmarks")
+    args = parse_args(parser)
+
+    logger = logging.getLogger("benchmarks")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+    suite = BenchmarkSuite(logger, args.grammar, args.seed, args.scale)
+    results = suite.run(args.select)
+    if args.save:
+        BenchmarkSuite.save_baseline(args.baseline, results)
+        logger.info(f"Baseline written to {args.baseline}")
+        exit(0)
+    try:
+        regressions = BenchmarkSuite.compare(args.baseline,
+                                             results,
+                                             args.threshold)
+    except FileNotFoundError:
+        logger.info(f"No baseline at {args.baseline}, run with --save")
+        exit(0)
+    for name, old, new in regressions:
+        logger.warning(f"REGRESSION {name}: {old * 1e6:.2f} us -> "
+                       f"{new * 1e6:.2f} us ({(new / old - 1) * 100:+.1f}%)")
+    if len(regressions) > 0:
+        exit(1)
+    logger.info(f"No regressions beyond {args.threshold * 100:.0f}%")
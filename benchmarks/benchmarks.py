@@ -0,0 +1,394 @@
+import json
+import logging
+import os
+import platform
+import statistics
+import tempfile
+import time
+from logging import Logger
+from numpy import random
+from qh3.h3.connection import QpackDecoder, QpackEncoder
+from grammar import Grammar
+from h3fuzzer import H3Fuzzer
+from mutation import (InsertChar,
+                      DeleteChar,
+                      ReplaceWithUppercase,
+                      FillUntilMax,
+                      AddMax)
+from profiler import StageProfiler
+from metrics import Metrics
+from qpack import StaticQpackEncoder, STATIC_TABLE
+from request import Request
+from utilities import CharTable, TestResult
+
+
+SMALL_LIMIT = 16
+MAX_LIMIT = 8192
+AUTHORITY = b"localhost:4433"
+PATH = b"/"
+
+
+class Benchmark:
+    """
+    A single timed operation.
+
+    setup() is called before every run and is not timed, its return value
+    is passed to run(). This keeps operations that mutate their input (e.g.
+    the oracle removing reported chars) comparable between iterations.
+    """
+    def __init__(self, name: str, run, setup=None, number: int = 1000):
+        self.name = name
+        self.run = run
+        self.setup = setup
+        self.number = number
+
+    def measure(self) -> dict:
+        timings = []
+        for _ in range(self.number):
+            state = self.setup() if self.setup is not None else None
+            start = time.perf_counter()
+            self.run(state)
+            timings.append(time.perf_counter() - start)
+        return {"number": self.number,
+                "min": min(timings),
+                "median": statistics.median(timings),
+                "mean": statistics.fmean(timings)}
+
+
+class BenchmarkSuite:
+    def __init__(self,
+                 logger: Logger,
+                 grammar_path: str,
+                 seed: int,
+                 scale: float = 1.0):
+        self.__logger = logger
+        # Grammar, Request, ... would log on every iteration
+        self.__quiet_logger = logger.getChild("quiet")
+        self.__quiet_logger.setLevel(logging.WARNING)
+        self.__grammar_path = grammar_path
+        self.__seed = seed
+        self.__scale = scale
+        self.__random = random.default_rng(seed)
+        self.__tmp_dir = tempfile.TemporaryDirectory()
+        self.__large_grammar_path = os.path.join(self.__tmp_dir.name,
+                                                 "large.json")
+        with open(self.__large_grammar_path, "w") as file:
+            json.dump(self.__synthetic_grammar(), file)
+        self.__grammar = Grammar(self.__quiet_logger, grammar_path, seed)
+        self.__large_grammar = Grammar(self.__quiet_logger,
+                                       self.__large_grammar_path,
+                                       seed)
+        self.__benchmarks = self.__build()
+
+    def names(self) -> list[str]:
+        return [benchmark.name for benchmark in self.__benchmarks]
+
+    def run(self, selected: list[str] | None = None) -> dict:
+        results = {}
+        for benchmark in self.__benchmarks:
+            if selected and not any(s in benchmark.name for s in selected):
+                continue
+            results[benchmark.name] = benchmark.measure()
+            self.__logger.info(f"{benchmark.name:<45} "
+                               f"median {results[benchmark.name]['median'] * 1e6:12.2f} us")
+        return results
+
+    @staticmethod
+    def save_baseline(path: str, results: dict):
+        baseline = {"python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "benchmarks": results}
+        with open(path, "w") as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+
+    @staticmethod
+    def compare(path: str, results: dict, threshold: float):
+        """
+        Returns (name, baseline median, current median) for every benchmark
+        whose median is more than threshold (e.g. 0.2 = 20%) slower.
+        """
+        with open(path, "r") as file:
+            baseline = json.load(file)["benchmarks"]
+        regressions = []
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            old = baseline[name]["median"]
+            if result["median"] > old * (1.0 + threshold):
+                regressions.append((name, old, result["median"]))
+        return regressions
+
+    def __number(self, number: int) -> int:
+        return max(1, int(number * self.__scale))
+
+    def __load_cached(self, cache_dir: str, path: str) -> Grammar:
+        Grammar.cache_dir = cache_dir
+        try:
+            return Grammar(self.__quiet_logger, path, self.__seed)
+        finally:
+            Grammar.cache_dir = None
+
+    def __build(self) -> list[Benchmark]:
+        benchmarks = []
+        logger = self.__quiet_logger
+        seed = self.__seed
+        grammar_path = self.__grammar_path
+        large_path = self.__large_grammar_path
+
+        # Grammar loading and checking
+        benchmarks.append(Benchmark(
+            "grammar.load[experiment]",
+            lambda _: Grammar(logger, grammar_path, seed),
+            number=self.__number(50)))
+        benchmarks.append(Benchmark(
+            "grammar.load[synthetic]",
+            lambda _: Grammar(logger, large_path, seed),
+            number=self.__number(5)))
+        cache_dir = os.path.join(self.__tmp_dir.name, "grammar_cache")
+        for name, path in [("experiment", grammar_path),
+                           ("synthetic", large_path)]:
+            # Fill the cache once, the timed loads are hits
+            self.__load_cached(cache_dir, path)
+            benchmarks.append(Benchmark(
+                f"grammar.load_cached[{name}]",
+                lambda _, p=path: self.__load_cached(cache_dir, p),
+                number=self.__number(50)))
+        for name, grammar in [("experiment", self.__grammar),
+                              ("synthetic", self.__large_grammar)]:
+            benchmarks.append(Benchmark(
+                f"grammar.check[{name}]",
+                lambda _, g=grammar: g._Grammar__check_grammar(),
+                number=self.__number(50)))
+
+        # Generation and building
+        for name, grammar in [("experiment", self.__grammar),
+                              ("synthetic", self.__large_grammar)]:
+            fuzzer = self.__fuzzer(grammar)
+            benchmarks.append(Benchmark(
+                f"fuzzer.get_fuzz[{name}]",
+                lambda _, f=fuzzer: f._H3Fuzzer__get_fuzz(),
+                number=self.__number(1000)))
+            sequence = fuzzer._H3Fuzzer__derive_sequence()
+            benchmarks.append(Benchmark(
+                f"request.build[{name}]",
+                lambda _, g=grammar, s=sequence: Request(logger,
+                                                         s,
+                                                         g,
+                                                         AUTHORITY,
+                                                         PATH,
+                                                         SMALL_LIMIT,
+                                                         SMALL_LIMIT,
+                                                         False,
+                                                         self.__random),
+                number=self.__number(1000)))
+
+        # Mutations at small and max header limits
+        grammar = self.__grammar
+        mutations = [
+            ("InsertChar", InsertChar("", grammar, "illegal-header-name",
+                                      "all", 1, seed), False),
+            ("DeleteChar", DeleteChar("", "all", 1, seed), False),
+            ("ReplaceWithUppercase", ReplaceWithUppercase("", 1, seed), False),
+            ("FillUntilMax", FillUntilMax("", grammar, "legal",
+                                          "prefix", 0, seed), True),
+            ("AddMax", AddMax("", grammar, "legal", "prefix", 0, seed), True)]
+        for name, mutation, takes_limit in mutations:
+            for limit_name, limit in [("small", SMALL_LIMIT),
+                                      ("max", MAX_LIMIT)]:
+                if takes_limit:
+                    run = lambda _, m=mutation, l=limit: m.apply(b"content-length", l)
+                    number = 1000 if limit == SMALL_LIMIT else 3
+                else:
+                    value = b"content-length" + b"a" * (limit - 14)
+                    run = lambda _, m=mutation, v=value: m.apply(v)
+                    number = 1000
+                benchmarks.append(Benchmark(
+                    f"mutation.{name}[{limit_name}]",
+                    run,
+                    number=self.__number(number)))
+
+        # Char table feedback
+        for size in [len(self.__grammar.get_char_table("illegal-header-name").chars),
+                     3 * 4096]:
+            benchmarks.append(Benchmark(
+                f"chartable.report_result[{size}]",
+                lambda table: table.report_result(table.chars[-1],
+                                                  TestResult.MODIFIED),
+                setup=lambda s=size: self.__char_table(s),
+                number=self.__number(200)))
+
+        # Capture parsing and oracle
+        for name, capture in [("sample", self.__sample_capture()),
+                              ("synthetic", self.__synthetic_capture(200))]:
+            request = self.__request(self.__grammar)
+            benchmarks.append(Benchmark(
+                f"request.read_data[{name}]",
+                lambda _, r=request, c=capture: r._Request__read_data(c),
+                number=self.__number(1000)))
+            backend_headers, _ = request._Request__read_data(capture)
+            benchmarks.append(Benchmark(
+                f"request.malicious_reached_backend[{name}]",
+                lambda r, h=backend_headers: r._Request__malicious_reached_backend(h),
+                setup=lambda: self.__request(self.__grammar, chars=False),
+                number=self.__number(1000)))
+
+        # QPACK encoding of the headers of a request
+        headers = self.__request(self.__grammar).headers
+        static_encoder = StaticQpackEncoder()
+        benchmarks.append(Benchmark(
+            "qpack.encode[static]",
+            lambda _: static_encoder.encode(headers),
+            number=self.__number(1000)))
+        qh3_encoder = QpackEncoder()
+        benchmarks.append(Benchmark(
+            "qpack.encode[qh3]",
+            lambda _: qh3_encoder.encode(0, headers),
+            number=self.__number(1000)))
+        # Guards the hand-written field line layouts, fails on a mismatch
+        qpack_cases = self.__qpack_cases()
+        benchmarks.append(Benchmark(
+            "qpack.roundtrip[static]",
+            lambda _: self.__qpack_roundtrip(qpack_cases),
+            number=self.__number(10)))
+        return benchmarks
+
+    def __qpack_cases(self) -> list[list[tuple[bytes, bytes]]]:
+        """
+        Every static table entry, its name with an upper-case variant and
+        an unknown value, long literals whose lengths need more than one
+        byte, and random header lists.
+        """
+        cases = []
+        for name, value in STATIC_TABLE:
+            cases.append([(name, value)])
+            cases.append([(name.upper(), value)])
+            cases.append([(name, value + b"x" * 200)])
+        # qh3's decoder rejects empty names and field sections and aborts
+        # the process on huge or non-UTF-8 literals, random bytes are ASCII
+        cases.append([(b"x" * 300, b"")])
+        cases.append([(b"y", b"y" * 5000)])
+        rng = random.default_rng(self.__seed)
+        for _ in range(500):
+            headers = []
+            for _ in range(rng.integers(1, 16)):
+                if rng.random() < 0.5:
+                    name, value = STATIC_TABLE[rng.integers(len(STATIC_TABLE))]
+                else:
+                    name = rng.integers(0, 128, rng.integers(1, 40),
+                                        dtype="uint8").tobytes()
+                    value = rng.integers(0, 128, rng.integers(0, 300),
+                                         dtype="uint8").tobytes()
+                headers.append((name, value))
+            cases.append(headers)
+        return cases
+
+    @staticmethod
+    def __qpack_roundtrip(cases):
+        encoder = StaticQpackEncoder()
+        decoder = QpackDecoder(4096, 16)
+        # Twice, the second round is spliced from the encoder's cache
+        for round in range(2):
+            for index, headers in enumerate(cases):
+                stream_id = (round * len(cases) + index) * 4
+                _, decoded = decoder.feed_header(stream_id,
+                                                 encoder.encode(headers))
+                if decoded != headers:
+                    raise AssertionError(f"QPACK round trip mismatch: "
+                                         f"{headers!r} decoded as "
+                                         f"{decoded!r}")
+
+    def __fuzzer(self, grammar: Grammar) -> H3Fuzzer:
+        return H3Fuzzer(self.__quiet_logger,
+                        grammar,
+                        AUTHORITY,
+                        PATH,
+                        0,
+                        self.__seed,
+                        0.0,
+                        None,
+                        Metrics(self.__quiet_logger),
+                        StageProfiler(self.__quiet_logger, None, ""))
+
+    def __request(self, grammar: Grammar, chars: bool = True) -> Request:
+        request = Request(self.__quiet_logger,
+                          ["method-header", "scheme-header", "authority-header",
+                           "path-header", "content-length-header",
+                           "transfer-encoding-header", "conflicting-host-header"],
+                          grammar,
+                          AUTHORITY,
+                          PATH,
+                          SMALL_LIMIT,
+                          SMALL_LIMIT,
+                          True,
+                          None)
+        if not chars:
+            # Reporting chars changes the shared char tables
+            request.get_malicious().chars = []
+        return request
+
+    def __char_table(self, size: int) -> CharTable:
+        chars = [(bytes([i % 256]) * (1 + i // 256), pos)
+                 for i in range(size // 3) for pos in [-1, 0, 1]]
+        return CharTable(chars,
+                         [[0, 0] for _ in chars],
+                         [1 / len(chars)] * len(chars),
+                         "header-name",
+                         0.1,
+                         0.1,
+                         1.0)
+
+    def __sample_capture(self) -> bytes:
+        path = os.path.join(os.path.dirname(__file__), "..", "servers",
+                            "request")
+        with open(path, "rb") as file:
+            capture = file.read()
+        capture = capture.removeprefix(b"####REQ_ID_")
+        return capture[capture.index(b"####") + 4:]
+
+    def __synthetic_capture(self, num_headers: int) -> bytes:
+        capture = b""
+        for i in range(num_headers):
+            capture += b"####H_NAME####x-header-" + str(i).encode() + \
+                       b"####H_VALUE####" + b"v" * 64
+        return capture + b"####BODY####" + b"B" * 1024 + b"####REQ_END####"
+
+    def __synthetic_grammar(self) -> dict:
+        num_headers = 200
+        table = [f"0x{i:02x}" for i in range(256)]
+        mutations = {
+            "insert": {"action": "insert-char",
+                       "char-table": "large",
+                       "char-position": "all",
+                       "quantity": 1},
+            "upper": {"action": "replace-with-uppercase",
+                      "quantity": 1},
+            "max": {"action": "add-max",
+                    "char-table": "legal",
+                    "char-position": "prefix"}}
+        headers = {}
+        for i in range(num_headers):
+            headers[f"header-{i}"] = {
+                "name-field": {
+                    "terminals": [f"x-header-{i}"],
+                    "mutations": ["<insert>", "<upper><insert>", "<max>", None],
+                    "mutations-probabilities": [0.4, 0.3, 0.1, 0.2],
+                    "illegal": True},
+                "value-field": {
+                    "terminals": ["value", "<authority>", "<path>"],
+                    "mutations": ["<insert>", None]}}
+        nonterminals = {
+            "start": {"derivatives": ["<field><field><field>",
+                                      "<field><field><field><field><field>"],
+                      "illegal": True},
+            "field": {"derivatives": [f"<group-{i}>" for i in range(20)]}}
+        for i in range(20):
+            nonterminals[f"group-{i}"] = {
+                "derivatives": [f"<header-{j}>"
+                                for j in range(i * 10, i * 10 + 10)]}
+        return {"nonterminals": nonterminals,
+                "headers": headers,
+                "mutations": mutations,
+                "char-tables": {
+                    "large": {"illegal-in": "header-name", "table": table},
+                    "legal": {"table": list("abcdefghijklmnopqrstuvwxyz")}}}
@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SERVERS_DIR = os.path.join(REPO_DIR, "servers")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+class LoopbackHarness:
+    """
+    Runs a complete campaign against a proxy stand-in on localhost.
+
+    h3server.py terminates HTTP/3 and hands every request to forward.py,
+    which forwards it to h1server.py. main.py is then run with a fixed seed
+    and throughput, latency, reconnects and CPU time per process are
+    collected.
+    """
+    def __init__(self,
+                 num_fuzzes: int,
+                 seed: int,
+                 timeout: float,
+                 front_port: int,
+                 backend_port: int,
+                 grammar_path: str,
+                 qpack_table: str = "none"):
+        self.__num_fuzzes = num_fuzzes
+        self.__seed = seed
+        self.__timeout = timeout
+        self.__front_port = front_port
+        self.__backend_port = backend_port
+        self.__grammar_path = grammar_path
+        self.__qpack_table = qpack_table
+        self.__processes = {}
+
+    def run(self) -> dict:
+        tmp_dir = tempfile.mkdtemp(prefix="h3fuzz_loopback_")
+        results_path = os.path.join(tmp_dir, "results.sqlite")
+        os.makedirs(os.path.join(REPO_DIR, "logs"), exist_ok=True)
+        try:
+            self.__start_backend()
+            self.__start_front_end()
+            wall_time, main_cpu, output = self.__run_campaign(results_path)
+            cpu = {name: self.__cpu_seconds(process.pid)
+                   for name, process in self.__processes.items()}
+            cpu["main"] = main_cpu
+        finally:
+            self.__stop_all()
+        report = self.__evaluate(results_path, output)
+        report["wall_time"] = wall_time
+        report["qpack_table"] = self.__qpack_table
+        report["cpu_seconds"] = cpu
+        return report
+
+    def __start_backend(self):
+        if os.path.exists(os.path.join(SERVERS_DIR, "request")):
+            os.remove(os.path.join(SERVERS_DIR, "request"))
+        self.__processes["backend"] = subprocess.Popen(
+            [sys.executable, "h1server.py", str(self.__backend_port)],
+            cwd=SERVERS_DIR,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        # h1server.py exits on empty connections, so it can't be polled
+        self.__wait_for_start("backend")
+
+    def __start_front_end(self):
+        env = dict(os.environ)
+        env["H3FUZZ_BACKEND_PORT"] = str(self.__backend_port)
+        self.__processes["front_end"] = subprocess.Popen(
+            [sys.executable, "h3server.py", "forward:app",
+             "--host", "127.0.0.1",
+             "--port", str(self.__front_port),
+             "--no-capture",
+             "--no-webtransport"],
+            cwd=SERVERS_DIR,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        self.__wait_for_start("front_end")
+
+    def __run_campaign(self, results_path: str):
+        command = [sys.executable, "main.py",
+                   f"https://localhost:{self.__front_port}/",
+                   "-g", self.__grammar_path,
+                   "-n", str(self.__num_fuzzes),
+                   "-s", str(self.__seed),
+                   "-t", str(self.__timeout),
+                   "-r", results_path,
+                   "--qpack-table", self.__qpack_table,
+                   "--metrics-interval", "0"]
+        start = time.perf_counter()
+        process = subprocess.Popen(command,
+                                   cwd=REPO_DIR,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.stdout.read().decode(errors="replace")
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_time = time.perf_counter() - start
+        if status != 0:
+            raise RuntimeError(f"main.py failed:\n{output}")
+        return wall_time, usage.ru_utime + usage.ru_stime, output
+
+    def __evaluate(self, results_path: str, output: str) -> dict:
+        connection = sqlite3.connect(results_path)
+        rows = connection.execute("SELECT latency, time FROM requests "
+                                  "ORDER BY time").fetchall()
+        verdicts = dict(connection.execute("SELECT verdict, COUNT(*) "
+                                           "FROM requests GROUP BY verdict"))
+        connection.close()
+        latencies = sorted(row[0] for row in rows if row[0] is not None)
+        duration = rows[-1][1] - rows[0][1] if len(rows) > 1 else 0.0
+        return {"requests": len(rows),
+                "requests_per_second": len(rows) / duration if duration else 0.0,
+                "latency_p50": self.__quantile(latencies, 0.5),
+                "latency_p99": self.__quantile(latencies, 0.99),
+                "reconnects": output.count("Reconnecting..."),
+                "verdicts": verdicts}
+
+    def __quantile(self, values: list[float], q: float) -> float | None:
+        if len(values) == 0:
+            return None
+        if len(values) == 1:
+            return values[0]
+        return statistics.quantiles(values, n=100, method="inclusive")[int(q * 100) - 1]
+
+    def __cpu_seconds(self, pid: int) -> float | None:
+        try:
+            with open(f"/proc/{pid}/stat", "r") as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+        except FileNotFoundError:
+            return None
+        # utime and stime are the 14th and 15th field of /proc/<pid>/stat
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+    def __wait_for_start(self, name: str, delay: float = 1.0):
+        time.sleep(delay)
+        if self.__processes[name].poll() is not None:
+            raise RuntimeError(f"{name} exited during startup")
+
+    def __stop_all(self):
+        for process in self.__processes.values():
+            process.terminate()
+        for process in self.__processes.values():
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.__processes = {}
+
+
+def parse_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-n",
+        "--num-fuzzes",
+        type=int,
+        default=500,
+        help="the number of fuzzes"
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        type=int,
+        default=0,
+        help="specify the seed for the random-generator"
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=0.5,
+        help="time the client waits for a server-response in seconds"
+    )
+    parser.add_argument(
+        "-g",
+        "--grammar",
+        type=str,
+        default="experiment.json",
+        help="filepath to JSON file containing grammar"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=4433,
+        help="UDP port of the HTTP/3 front end"
+    )
+    parser.add_argument(
+        "--backend-port",
+        type=int,
+        default=8080,
+        help="TCP port h1server.py listens on"
+    )
+    parser.add_argument(
+        "--qpack-table",
+        choices=["none", "capped", "full"],
+        default="none",
+        help="QPACK dynamic table policy of the campaign, see main.py"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="also write the report as JSON to this file"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="h3fuzz loopback benchmark")
+    args = parse_args(parser)
+    harness = LoopbackHarness(args.num_fuzzes,
+                              args.seed,
+                              args.timeout,
+                              args.port,
+                              args.backend_port,
+                              args.grammar,
+                              args.qpack_table)
+    report = harness.run()
+    print(json.dumps(report, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
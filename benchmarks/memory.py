@@ -0,0 +1,139 @@
+import argparse
+import gc
+import json
+import logging
+import sys
+import tracemalloc
+from grammar import Grammar
+from h3fuzzer import H3Fuzzer
+from metrics import Metrics
+from profiler import StageProfiler
+
+
+AUTHORITY = b"localhost:4433"
+PATH = b"/"
+LIMITS = [16, 256]
+# Bytes a built request may take on top of its header and body bytes, see
+# README (Memory)
+BUDGET = 2048
+
+
+class MemoryBenchmark:
+    """
+    Measures the memory of built but not yet evaluated requests, as they
+    wait in the prefetch queue and the concurrency window.
+
+    Requests are generated with tracemalloc running and kept alive, all
+    memory still allocated afterwards is attributed to them. The payload
+    (header and body bytes) grows with the header limits and is reported
+    separately, the overhead on top of it is what the budget covers.
+    """
+    def __init__(self,
+                 grammar_path: str,
+                 limits: list[int],
+                 num_requests: int,
+                 seed: int):
+        self.__grammar_path = grammar_path
+        self.__limits = limits
+        self.__num_requests = num_requests
+        self.__seed = seed
+        self.__logger = logging.getLogger("h3fuzz.benchmarks")
+        self.__logger.setLevel(logging.CRITICAL)
+
+    def run(self) -> dict:
+        return {str(limit): self.__measure(limit) for limit in self.__limits}
+
+    def __measure(self, limit: int) -> dict:
+        fuzzer = H3Fuzzer(self.__logger,
+                          Grammar(self.__logger,
+                                  self.__grammar_path,
+                                  self.__seed),
+                          AUTHORITY,
+                          PATH,
+                          0,
+                          self.__seed,
+                          0.0,
+                          None,
+                          Metrics(self.__logger),
+                          StageProfiler(self.__logger, None, ""),
+                          0)
+        fuzzer.set_max_name_chars(limit)
+        fuzzer.set_max_value_chars(limit)
+        # Fills the caches of the grammar and the scheduler first
+        for _ in range(self.__num_requests // 10):
+            fuzzer.generate()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            requests = [fuzzer.generate()
+                        for _ in range(self.__num_requests)]
+            gc.collect()
+            allocated, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        payload = sum(len(name) + len(value)
+                      for request in requests
+                      for name, value in request.headers)
+        payload += sum(len(request.data)
+                       for request in requests
+                       if isinstance(request.data, bytes))
+        return {"bytes": allocated / len(requests),
+                "payload": payload / len(requests),
+                "overhead": (allocated - payload) / len(requests)}
+
+
+def parse_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-g",
+        "--grammar",
+        type=str,
+        default="experiment.json",
+        help="filepath to JSON file containing grammar"
+    )
+    parser.add_argument(
+        "-n",
+        "--num-requests",
+        type=int,
+        default=3000,
+        help="number of requests kept alive per header limit"
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        type=int,
+        default=0,
+        help="specify the seed for the random-generator"
+    )
+    parser.add_argument(
+        "--budget",
+        type=int,
+        default=BUDGET,
+        help="fail if the overhead per request exceeds this many bytes"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="also write the report as JSON to this file"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="h3fuzz memory benchmark")
+    args = parse_args(parser)
+    benchmark = MemoryBenchmark(args.grammar,
+                                LIMITS,
+                                args.num_requests,
+                                args.seed)
+    report = benchmark.run()
+    print(json.dumps(report, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    over = [limit for limit, measurement in report.items()
+            if measurement["overhead"] > args.budget]
+    if over != []:
+        print(f"Overhead above the budget of {args.budget} bytes per request "
+              f"at header limits {', '.join(over)}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Subsystems main.py imports per phase and the third-party packages behind
+# most of their import time
+MODULES = ["logpipeline",
+           "profiler",
+           "grammar",
+           "request",
+           "resultstore",
+           "metrics",
+           "corpus",
+           "h3clientmanager",
+           "h3replay",
+           "testmanager",
+           "numpy",
+           "qh3"]
+
+
+class StartupBenchmark:
+    """
+    Measures the startup cost of main.py and its subsystems.
+
+    Every module is imported in a fresh interpreter with -X importtime, the
+    cumulative import time of the module (including everything it pulls in
+    that wasn't loaded by the interpreter itself) is reported. The wall time
+    of `main.py --help` covers interpreter startup and argument parsing.
+    """
+    def __init__(self, modules: list[str], repeat: int):
+        self.__modules = modules
+        self.__repeat = repeat
+
+    def run(self) -> dict:
+        imports = {}
+        for module in self.__modules:
+            timings = [self.__import_time(module)
+                       for _ in range(self.__repeat)]
+            imports[module] = statistics.median(timings)
+        help_timings = [self.__wall_time([os.path.join(REPO_DIR, "main.py"),
+                                          "--help"])
+                        for _ in range(self.__repeat)]
+        interpreter_timings = [self.__wall_time(["-c", "pass"])
+                               for _ in range(self.__repeat)]
+        return {"main_help": statistics.median(help_timings),
+                "interpreter": statistics.median(interpreter_timings),
+                "imports": imports}
+
+    def __import_time(self, module: str) -> float:
+        process = subprocess.run([sys.executable,
+                                  "-X", "importtime",
+                                  "-c", f"import {module}"],
+                                 cwd=REPO_DIR,
+                                 stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE,
+                                 text=True)
+        if process.returncode != 0:
+            raise RuntimeError(f"importing {module} failed:\n"
+                               f"{process.stderr}")
+        # "import time: <self us> | <cumulative us> | <indented name>", the
+        # module itself is the last top-level entry
+        for line in reversed(process.stderr.splitlines()):
+            fields = line.removeprefix("import time:").split("|")
+            if len(fields) == 3 and fields[2].strip() == module \
+                    and not fields[2][1:].startswith(" "):
+                return int(fields[1]) / 1e6
+        raise RuntimeError(f"no import time reported for {module}")
+
+    def __wall_time(self, args: list[str]) -> float:
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args],
+                       cwd=REPO_DIR,
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL,
+                       check=True)
+        return time.perf_counter() - start
+
+
+def parse_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=5,
+        help="number of fresh interpreters per measurement, the median is "
+             "reported"
+    )
+    parser.add_argument(
+        "-k",
+        "--select",
+        type=str,
+        nargs="*",
+        help="only measure these modules"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="also write the report as JSON to this file"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="h3fuzz startup benchmark")
+    args = parse_args(parser)
+    benchmark = StartupBenchmark(args.select or MODULES, args.repeat)
+    report = benchmark.run()
+    print(json.dumps(report, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
@@ -0,0 +1,4 @@
+from .corpus import CorpusWriter, CorpusReader
+from .generator import CorpusGenerator
+
+__all__ = ["CorpusWriter", "CorpusReader", "CorpusGenerator"]
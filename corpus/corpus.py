@@ -0,0 +1,101 @@
+import json
+from logging import Logger
+from utilities import CorpusEntry, MaliciousLoad, BodyStream
+
+
+def _text(field: bytes) -> str:
+    # latin-1 maps every byte to one code point, so arbitrary header bytes
+    # survive the round trip through JSON
+    return field.decode("latin-1")
+
+
+def _bytes(field: str) -> bytes:
+    return field.encode("latin-1")
+
+
+def _body(data: bytes | BodyStream | None):
+    # Body streams are stored as their grammar description
+    if isinstance(data, BodyStream):
+        return {"pattern": _text(data.pattern),
+                "size": data.size,
+                "chunks": list(data.chunks),
+                "content-length-offset": data.content_length_offset}
+    return None if data is None else _text(data)
+
+
+def _parse_body(data) -> bytes | BodyStream | None:
+    if isinstance(data, dict):
+        return BodyStream(_bytes(data["pattern"]),
+                          data["size"],
+                          tuple(data["chunks"]),
+                          data["content-length-offset"])
+    return None if data is None else _bytes(data)
+
+
+class CorpusWriter:
+    """
+    Streams generated requests to a JSON lines file.
+
+    Every line holds the grammar sequence, the header list without the
+    smuggling-id header, the body and the malicious manifest of one request.
+    Byte strings are stored as latin-1 decoded text, body streams as an
+    object with the keys of their grammar data.
+    """
+    def __init__(self, logger: Logger, path: str, buffer_size: int = 1 << 20):
+        self.__logger = logger
+        self.__path = path
+        self.__file = open(path, "w", encoding="utf-8", buffering=buffer_size)
+        self.__encoder = json.JSONEncoder(ensure_ascii=False,
+                                          separators=(",", ":"))
+        self.__num_entries = 0
+
+    @property
+    def num_entries(self) -> int:
+        return self.__num_entries
+
+    def write(self, request):
+        malicious = request.get_malicious()
+        # The smuggling-id is always the last header and assigned on replay
+        entry = {
+            "id": request.request_id,
+            "sequence": request.sequence,
+            "headers": [[_text(name), _text(value)]
+                        for name, value in request.headers[:-1]],
+            "data": _body(request.data),
+            "malicious": [_text(load) for load in malicious.all],
+            "chars": [[table, _text(char[0]), char[1]]
+                      for table, char in malicious.chars],
+        }
+        self.__file.write(self.__encoder.encode(entry))
+        self.__file.write("\n")
+        self.__num_entries += 1
+
+    def close(self):
+        self.__file.close()
+        self.__logger.info(f"Wrote {self.__num_entries} requests to "
+                           f"{self.__path}")
+
+
+class CorpusReader:
+    def __init__(self, path: str):
+        self.__path = path
+
+    def __iter__(self):
+        with open(self.__path, "r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip() == "":
+                    continue
+                yield self.__parse(json.loads(line))
+
+    def __parse(self, entry: dict) -> CorpusEntry:
+        data = entry["data"]
+        chars = [(table, (_bytes(char), index))
+                 for table, char, index in entry.get("chars", [])]
+        return CorpusEntry(entry["id"],
+                           entry["sequence"],
+                           [(_bytes(name), _bytes(value))
+                            for name, value in entry["headers"]],
+                           _parse_body(data),
+                           MaliciousLoad([_bytes(load)
+                                          for load in entry["malicious"]],
+                                         chars))
@@ -0,0 +1,83 @@
+import time
+from logging import Logger
+from numpy import random
+from grammar import Grammar
+from h3fuzzer import H3Fuzzer
+from profiler import StageProfiler
+from metrics import Metrics
+from utilities import TestPhase
+from .corpus import CorpusWriter
+
+
+class CorpusGenerator:
+    """
+    Runs the grammar, mutations and header limits of the fuzzer without a
+    network and streams the generated requests to a corpus file.
+
+    Without a target the <authority> and <path> placeholders are kept, they
+    are substituted when the corpus is replayed.
+    """
+    def __init__(self,
+                 logger: Logger,
+                 grammar_path: str | None,
+                 num_fuzzes: int,
+                 seed: int | None,
+                 out_path: str,
+                 authority: bytes,
+                 path: bytes,
+                 boundary: int | None,
+                 profiler: StageProfiler,
+                 max_resamples: int = 10):
+        self.__logger = logger
+        self.__num_fuzzes = num_fuzzes
+        self.__out_path = out_path
+        self.__profiler = profiler
+        self.__max_resamples = max_resamples
+        seed = self.set_seed(seed)
+        grammar = Grammar(logger, grammar_path, seed)
+        self.__fuzzer = H3Fuzzer(logger,
+                                 grammar,
+                                 authority,
+                                 path,
+                                 num_fuzzes,
+                                 seed,
+                                 0,
+                                 None,
+                                 Metrics(logger),
+                                 profiler,
+                                 max_resamples)
+        if boundary is not None:
+            self.__fuzzer.set_max_name_chars(boundary)
+            self.__fuzzer.set_max_value_chars(boundary)
+
+    def set_seed(self, seed):
+        if seed is None:
+            generated_seed = random.randint(0, 2**32)
+            self.__logger.info(f"Seed for reproducibility: {generated_seed}")
+            return generated_seed
+        else:
+            self.__logger.info(f"Seed manually set to {seed}")
+            return seed
+
+    def run(self):
+        writer = CorpusWriter(self.__logger, self.__out_path)
+        start_time = time.perf_counter()
+        self.__profiler.set_phase(TestPhase.FUZZING)
+        try:
+            for num_generated in range(1, self.__num_fuzzes + 1):
+                writer.write(self.__fuzzer.generate())
+                if num_generated % 1024 == 0:
+                    self.__logger.info("%d/%d generated",
+                                       num_generated,
+                                       self.__num_fuzzes,
+                                       extra={"progress": True})
+        finally:
+            writer.close()
+            runtime = time.perf_counter() - start_time
+            rate = writer.num_entries / runtime if runtime > 0 else 0
+            self.__logger.info(f"Runtime: {runtime} seconds "
+                               f"({rate:.0f} requests/s)")
+            if self.__max_resamples > 0:
+                self.__logger.info(f"Duplicate rate: "
+                                   f"{self.__fuzzer.duplicate_rate:.1%}")
+            self.__profiler.write_report()
@@ -0,0 +1,3 @@
+from .dedup import BloomFilter, fingerprint
+
+__all__ = ["BloomFilter", "fingerprint"]
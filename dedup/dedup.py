@@ -0,0 +1,82 @@
+import hashlib
+import math
+from resultstore import pack_fields
+from utilities import BodyStream
+
+
+def fingerprint(headers, data: bytes | BodyStream | None) -> bytes:
+    """
+    Returns a 16 byte digest of a header list and body.
+
+    The caller passes the headers without the smuggling-id, which differs
+    for every request. Header order is part of the fingerprint.
+    """
+    fields = [field for header in headers for field in header]
+    # Distinguishes a missing body from an empty one and from a stream
+    if data is None:
+        fields.append(b"")
+    elif isinstance(data, BodyStream):
+        fields.append(b"\x02" + data.describe())
+    else:
+        fields.append(b"\x01" + data)
+    return hashlib.blake2b(pack_fields(fields), digest_size=16).digest()
+
+
+class BloomFilter:
+    """
+    Bloom filter over fingerprints with bounded memory.
+
+    The bit array is sized for `capacity` entries at `error_rate`. Once the
+    current generation holds `capacity` entries it becomes the previous
+    generation and a new one is started, lookups check both. Memory stays
+    at two generations, the oldest fingerprints are forgotten.
+    """
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.__capacity = capacity
+        num_bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self.__num_bits = max(8, int(math.ceil(num_bits)))
+        num_hashes = self.__num_bits / capacity * math.log(2)
+        self.__num_hashes = max(1, int(round(num_hashes)))
+        self.__current = bytearray((self.__num_bits + 7) // 8)
+        self.__previous = None
+        self.__num_entries = 0
+
+    def __len__(self) -> int:
+        return self.__num_entries
+
+    def __contains__(self, digest: bytes) -> bool:
+        return self.__known(self.__positions(digest))
+
+    def add(self, digest: bytes) -> bool:
+        """Adds a fingerprint, returns False if it was (probably) known."""
+        positions = self.__positions(digest)
+        if self.__known(positions):
+            return False
+        if self.__num_entries >= self.__capacity:
+            self.__previous = self.__current
+            self.__current = bytearray(len(self.__previous))
+            self.__num_entries = 0
+        for position in positions:
+            self.__current[position >> 3] |= 1 << (position & 7)
+        self.__num_entries += 1
+        return True
+
+    def __positions(self, digest: bytes) -> list[int]:
+        # Kirsch-Mitzenmacher: k positions from two 64-bit hashes
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        return [(h1 + i * h2) % self.__num_bits
+                for i in range(self.__num_hashes)]
+
+    def __known(self, positions: list[int]) -> bool:
+        if self.__test(self.__current, positions):
+            return True
+        if self.__previous is not None:
+            return self.__test(self.__previous, positions)
+        return False
+
+    def __test(self, bits: bytearray, positions: list[int]) -> bool:
+        for position in positions:
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
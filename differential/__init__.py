@@ -0,0 +1,15 @@
+from .differential import (diff_request,
+                           PASSED,
+                           RECASED,
+                           NORMALIZED,
+                           DROPPED,
+                           NOT_FORWARDED,
+                           BODY_FIELD)
+
+__all__ = ["diff_request",
+           "PASSED",
+           "RECASED",
+           "NORMALIZED",
+           "DROPPED",
+           "NOT_FORWARDED",
+           "BODY_FIELD"]
@@ -0,0 +1,63 @@
+from utilities import BodyStream
+
+
+# One character per action keeps the diffs table compact
+PASSED = "P"         # forwarded unchanged
+RECASED = "C"        # only the case of the name changed
+NORMALIZED = "N"     # forwarded with a changed value or name
+DROPPED = "D"        # not forwarded
+NOT_FORWARDED = "-"  # the backend did not receive the request at all
+
+# Field index of the body, header fields use their index in the request
+BODY_FIELD = -1
+
+# Translated into the request line and Host by the proxy, not comparable
+PSEUDO_HEADERS = [b":method", b":scheme", b":authority", b":path"]
+
+
+def diff_request(headers,
+                 data: bytes | BodyStream | None,
+                 backend_headers: dict | None,
+                 backend_data: bytes | None) -> list[tuple[int, bytes, str]]:
+    """
+    Classifies how a proxy forwarded every header and the body of a request.
+
+    Returns (field, name, action) per compared field, field is the index of
+    the header in the request (without the smuggling-id) or BODY_FIELD.
+    """
+    actions = []
+    if backend_headers is not None:
+        lowered = {}
+        for name, value in backend_headers.items():
+            lowered.setdefault(name.lower(), (name, value))
+        stripped = {name.strip().lower(): value
+                    for name, value in backend_headers.items()}
+    for field, (name, value) in enumerate(headers):
+        if name in PSEUDO_HEADERS:
+            continue
+        if backend_headers is None:
+            actions.append((field, name, NOT_FORWARDED))
+        elif backend_headers.get(name) == value:
+            actions.append((field, name, PASSED))
+        elif name in backend_headers:
+            actions.append((field, name, NORMALIZED))
+        elif name.lower() in lowered:
+            if lowered[name.lower()][1] == value:
+                actions.append((field, name, RECASED))
+            else:
+                actions.append((field, name, NORMALIZED))
+        elif name.strip().lower() in stripped:
+            actions.append((field, name, NORMALIZED))
+        else:
+            actions.append((field, name, DROPPED))
+    if data is not None and data != b"":
+        if backend_headers is None:
+            actions.append((BODY_FIELD, b"", NOT_FORWARDED))
+        elif backend_data == data or (isinstance(data, BodyStream)
+                                      and data.matches(backend_data)):
+            actions.append((BODY_FIELD, b"", PASSED))
+        elif backend_data is None or backend_data == b"":
+            actions.append((BODY_FIELD, b"", DROPPED))
+        else:
+            actions.append((BODY_FIELD, b"", NORMALIZED))
+    return actions
@@ -1,7 +1,14 @@
+import functools
+import hashlib
 import json
+import math
+import os
+import pickle
 import re
+import stat
+import threading
 from logging import Logger
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from mutation import (Mutation,
                       InsertChar,
                       DeleteChar,
@@ -12,27 +19,67 @@ from utilities import (Header,
                        NonTerminal,
                        Terminal,
                        Data,
+                       BodyStream,
+                       MAX_STREAM_CHUNK,
                        PreTest,
                        PreTestAction,
                        CharTable,
                        TestResult)
 
 
+# Header names whose illegal terminals are not malicious tokens on their own,
+# every request contains them
+PSEUDO_HEADERS = [b":method", b":authority", b":path", b":scheme"]
+
+# DATA frame size of body streams without a chunk schedule
+DEFAULT_STREAM_CHUNK = 1 << 14
+
+# Sources whose changes invalidate cached grammars: the parser and checks,
+# the pickled classes and the mutations recreated on load
+CACHED_SOURCES = ["grammar/grammar.py", "mutation/mutation.py", "utilities.py"]
+
+
+@functools.cache
+def code_version() -> str:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    digest = hashlib.blake2b(digest_size=16)
+    for source in CACHED_SOURCES:
+        with open(os.path.join(root, source), "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
 class Grammar:
+    # Directory of parsed and checked grammars, None disables the cache
+    cache_dir = None
+
     def __init__(self, logger, grammar_path, seed):
         self.__logger: Logger = logger
+        # Held while drawing from or reporting to a char table, the fuzzer
+        # may build requests on a producer thread
+        self.lock = threading.Lock()
         self.__nonterminals: dict[NonTerminal] = {}
         self.__char_tables: dict[CharTable] = {}
         self.__mutations: dict[Mutation] = {}
+        self.__mutation_specs: dict[dict] = {}
         self.__pre_tests: dict[PreTest] = {}
+        self.__bindings: dict[dict[Header]] = {}
+        self.__illegal_probabilities: dict[float] = {}
+        self.__derivative_illegal_probabilities: dict[list[float]] = {}
         self.__seed = seed
         self.__logger.info("Reading grammar-file")
         self.__laplace_alpha = 0.1
         self.__laplace_beta = 0.1
         self.__success_boost = 1.0
-        file = open(grammar_path, "r")
+        with open(grammar_path, "rb") as file:
+            content = file.read()
+        cache_path = self.__cache_path(content)
+        if cache_path is not None and self.__load_cache(cache_path):
+            self.__update_illegality()
+            self.__logger.info(f"Loaded checked grammar from {cache_path}")
+            return
         try:
-            json_dict = json.loads(file.read())
+            json_dict = json.loads(content)
         except Exception as e:
             self.__logger.critical("Error reading grammar-json. Error:",
                                    str(e))
@@ -41,7 +88,13 @@ class Grammar:
         error_message = self.__check_grammar()
         if error_message is not None:
             self.__parser_error(f"grammar check failed - {error_message}")
+        self.__update_illegality()
+        if not self.can_derive_illegal():
+            self.__parser_error("grammar check failed - no derivation of "
+                                "'start' contains an illegal nonterminal")
         self.__logger.info("Grammar check passed")
+        if cache_path is not None:
+            self.__write_cache(cache_path)
 
     def get_nonterminal(self, nonterminal) -> NonTerminal:
         return self.__nonterminals[nonterminal]
@@ -63,6 +116,67 @@ class Grammar:
 
     def is_header(self, nonterminal) -> bool:
         return isinstance(self.__nonterminals[nonterminal], Header)
+
+    def bind(self, authority: bytes, path: bytes) -> dict[Header]:
+        """
+        Returns all headers specialized for a target: <authority> and <path>
+        are substituted in every terminal, Terminal.malicious and
+        Terminal.key are set.
+        Pre-test actions only change nonterminals, so a binding is computed
+        once per target and kept.
+        """
+        bound = self.__bindings.get((authority, path))
+        if bound is None:
+            bound = {}
+            for name, header in self.__nonterminals.items():
+                if isinstance(header, Header):
+                    bound[name] = self.bind_header(header, authority, path)
+            self.__bindings[(authority, path)] = bound
+        return bound
+
+    def bind_header(self, header: Header, authority, path) -> Header:
+        """Binds a single header, e.g. one built outside the grammar."""
+        return Header(header.name,
+                      self.__bind_terminal(header.name_terminal,
+                                           authority,
+                                           path,
+                                           f"{header.name}:name"),
+                      self.__bind_terminal(header.value_terminal,
+                                           authority,
+                                           path,
+                                           f"{header.name}:value"))
+
+    def __bind_terminal(self,
+                        terminal: Terminal,
+                        authority,
+                        path,
+                        key: str) -> Terminal:
+        terminals = [choice.replace(b"<authority>", authority)
+                           .replace(b"<path>", path)
+                     for choice in terminal.terminals]
+        malicious = [terminal.is_illegal and choice not in PSEUDO_HEADERS
+                     for choice in terminals]
+        return replace(terminal,
+                       terminals=terminals,
+                       malicious=malicious,
+                       key=key)
+
+    def illegal_probability(self, nonterminal) -> float:
+        """
+        Probability that the derivation of a nonterminal contains an illegal
+        nonterminal or data, not counting the nonterminal itself.
+        """
+        return self.__illegal_probabilities.get(nonterminal, 0.0)
+
+    def derivative_illegal_probabilities(self, nonterminal) -> list[float]:
+        """Per derivative, the probability that it leads to an illegal item."""
+        return self.__derivative_illegal_probabilities[nonterminal]
+
+    def can_derive_illegal(self) -> bool:
+        start = self.__nonterminals.get("start")
+        if not isinstance(start, NonTerminal):
+            return False
+        return start.is_illegal or self.illegal_probability("start") > 0
     
     def report_pre_test_result(self, pre_test_key, result: TestResult):
         self.__pre_tests[pre_test_key].result = result
@@ -91,6 +205,7 @@ class Grammar:
                         case _:
                             raise ValueError(f"unkown result in PreTest: {result}")
                     target_func(key, actions)
+        self.__update_illegality()
 
     def __apply_pre_tests_drops(self, pre_test_key, actions):
         for action, influence in actions.items():
@@ -239,10 +354,124 @@ class Grammar:
                         self.__parse_char_table(char_table_key, char_table)
                 case "mutations":
                     for mutation_key, mutation in group.items():
+                        self.__mutation_specs[mutation_key] = mutation
                         self.__parse_mutation(mutation_key, mutation)
                 case _:
                     self.__parser_error(f"key '{str(key)}' unkown")
 
+    def __update_illegality(self, max_iterations: int = 1000):
+        """
+        Fuzz cases must contain an illegal item, which the fuzzer samples
+        conditioned on instead of rejecting legal derivations. The
+        probabilities are the least fixed point of
+
+            r(N) = sum_d p_d * (1 - prod_{Y in d} (1 - i(Y)))
+
+        with i(Y) = 1 for illegal items and r(Y) otherwise, iterated from 0
+        so recursive nonterminals converge from below.
+        """
+        nonterminals = {name: nonterminal
+                        for name, nonterminal in self.__nonterminals.items()
+                        if isinstance(nonterminal, NonTerminal)}
+        probabilities = {name: 0.0 for name in nonterminals}
+        for _ in range(max_iterations):
+            change = 0.0
+            for name, nonterminal in nonterminals.items():
+                derivatives = self.__derivatives_illegality(nonterminal,
+                                                            probabilities)
+                probability = sum(p * q for p, q
+                                  in zip(nonterminal.probabilities,
+                                         derivatives))
+                change = max(change, abs(probability - probabilities[name]))
+                probabilities[name] = probability
+            if change < 1e-12:
+                break
+        self.__illegal_probabilities = probabilities
+        self.__derivative_illegal_probabilities = {
+            name: self.__derivatives_illegality(nonterminal, probabilities)
+            for name, nonterminal in nonterminals.items()}
+
+    def __derivatives_illegality(self, nonterminal: NonTerminal,
+                                 probabilities: dict) -> list[float]:
+        derivatives = []
+        for derivative in nonterminal.derivatives:
+            legal = 1.0
+            for item in derivative or []:
+                obj = self.__nonterminals.get(item)
+                if isinstance(obj, (NonTerminal, Data)) and obj.is_illegal:
+                    legal = 0.0
+                    break
+                legal *= 1.0 - probabilities.get(item, 0.0)
+            derivatives.append(1.0 - legal)
+        return derivatives
+
+    def __cache_path(self, content: bytes) -> str | None:
+        if Grammar.cache_dir is None:
+            return None
+        digest = hashlib.blake2b(content, digest_size=16)
+        digest.update(code_version().encode())
+        return os.path.join(Grammar.cache_dir, f"{digest.hexdigest()}.pickle")
+
+    def __load_cache(self, cache_path: str) -> bool:
+        """
+        Restores the parsed and checked grammar. Mutations hold a random
+        generator seeded per run and a reference to the grammar, so they are
+        recreated from their specs instead of being cached.
+
+        Unpickling runs arbitrary code, so the entry and the cache directory
+        must be owned by the user and not writable by group or others.
+        """
+        try:
+            fd = os.open(cache_path, os.O_RDONLY | os.O_NOFOLLOW)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            self.__logger.warning(f"Ignoring grammar cache {cache_path}: {e}")
+            return False
+        try:
+            with os.fdopen(fd, "rb") as file:
+                if not self.__trusted(os.stat(Grammar.cache_dir)) or \
+                   not self.__trusted(os.fstat(file.fileno())):
+                    self.__logger.warning(f"Ignoring grammar cache "
+                                          f"{cache_path}: not owned by the "
+                                          f"user or writable by others")
+                    return False
+                cached = pickle.load(file)
+        except Exception as e:
+            self.__logger.warning(f"Ignoring grammar cache {cache_path}: {e}")
+            return False
+        self.__nonterminals = cached["nonterminals"]
+        self.__char_tables = cached["char-tables"]
+        self.__pre_tests = cached["pre-tests"]
+        self.__mutation_specs = cached["mutations"]
+        for mutation_key, mutation in self.__mutation_specs.items():
+            self.__parse_mutation(mutation_key, mutation)
+        return True
+
+    @staticmethod
+    def __trusted(status: os.stat_result) -> bool:
+        return status.st_uid == os.getuid() and \
+            not status.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+    def __write_cache(self, cache_path: str):
+        # Written before any pre-test results are reported, so the cache holds
+        # the grammar as parsed
+        cached = {"nonterminals": self.__nonterminals,
+                  "char-tables": self.__char_tables,
+                  "pre-tests": self.__pre_tests,
+                  "mutations": self.__mutation_specs}
+        # Concurrent workers may write the same entry, os.replace is atomic
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(Grammar.cache_dir, mode=0o700, exist_ok=True)
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, "wb") as file:
+                pickle.dump(cached, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            self.__logger.warning(f"Could not write grammar cache "
+                                  f"{cache_path}: {e}")
+
     def __parse_char_table(self, name, dict):
         """
         Parses char tables from grammar-file.
@@ -296,12 +525,22 @@ class Grammar:
         self.__nonterminals[name] = header
 
     def __parse_data(self, name, dict):
-        load = dict.get("load")
-        if load is None:
-            load = b""
+        if "pattern" in dict:
+            # Body stream, see utilities.BodyStream
+            chunks = dict.get("chunks")
+            if chunks is None:
+                chunks = [DEFAULT_STREAM_CHUNK]
+            load = BodyStream(dict["pattern"].encode(),
+                              dict.get("size"),
+                              tuple(chunks),
+                              dict.get("content-length-offset"))
         else:
-            load = load.encode()
-        data = Data(load)
+            load = dict.get("load")
+            if load is None:
+                load = b""
+            else:
+                load = load.encode()
+        data = Data(load, self.__parse_illegal(dict))
         self.__nonterminals[name] = data
 
     def __parse_nonterminal(self, name, dict):
@@ -645,12 +884,42 @@ class Grammar:
         return None
 
     def __check_data(self, data: Data):
-        if not isinstance(data.load, bytes):
+        if isinstance(data.load, BodyStream):
+            error_msg = self.__check_body_stream(data.load)
+            if error_msg is not None:
+                return error_msg
+        elif not isinstance(data.load, bytes):
             raise TypeError
         if not isinstance(data.is_illegal, bool):
             raise TypeError
         return None
 
+    def __check_body_stream(self, stream: BodyStream):
+        name = stream.pattern.decode()
+        if stream.pattern == b"":
+            return "body stream: pattern must not be empty"
+        if stream.size is not None \
+                and (not isinstance(stream.size, int) or stream.size < 0):
+            return f"body stream '{name}': size must be an int >= 0 or null"
+        if stream.chunks == () or not all(isinstance(chunk, int)
+                                          and 0 <= chunk <= MAX_STREAM_CHUNK
+                                          for chunk in stream.chunks):
+            return (f"body stream '{name}': chunks must be ints between 0 "
+                    f"and {MAX_STREAM_CHUNK}")
+        if sum(stream.chunks) == 0 and stream.size != 0:
+            return f"body stream '{name}': chunks must not all be 0"
+        if stream.content_length_offset is not None:
+            if not isinstance(stream.content_length_offset, int):
+                return (f"body stream '{name}': content-length-offset must "
+                        f"be of type int")
+            if stream.size is None:
+                return (f"body stream '{name}': content-length-offset needs "
+                        f"a size")
+            if stream.content_length < 0:
+                return (f"body stream '{name}': declared content-length "
+                        f"must not be negative")
+        return None
+
     def __check_header(self, header: Header):
         if not isinstance(header.name_terminal, Terminal):
             raise TypeError
@@ -686,7 +955,7 @@ class Grammar:
         if not isinstance(terminal.mutations_probabilities, list):
             if terminal.mutations_probabilities is not None:
                 raise TypeError
-        if not sum(terminal.terminals_probabilities) == 1:
+        if not math.isclose(sum(terminal.terminals_probabilities), 1):
             return f"{name}: terminals-probabilities do not add up to 1"
         if len(terminal.terminals) != len(terminal.terminals_probabilities):
             return f"{name}: number of terminals does not match number of " + \
@@ -706,7 +975,7 @@ class Grammar:
         # Check if mutations-probabilities are given
         if terminal.mutations_probabilities is None:
             return None
-        if not sum(terminal.mutations_probabilities) == 1:
+        if not math.isclose(sum(terminal.mutations_probabilities), 1):
             return f"{name}: mutations-probabilities do not add up to 1"
         if len(terminal.mutations) != len(terminal.mutations_probabilities):
             return f"{name}: number of mutations does not match number of " + \
@@ -736,7 +1005,7 @@ class Grammar:
                         return "NonTerminal " + extended_item + " is missing"
             else:
                 raise TypeError
-        if not sum(nonterminal.probabilities) == 1:
+        if not math.isclose(sum(nonterminal.probabilities), 1):
             return f"{nonterminal.name}: probabilities do not add up to 1"
         return None
     
@@ -0,0 +1,103 @@
+import asyncio
+import socket
+import struct
+import sys
+
+
+# Linux UDP generic segmentation offload, see udp(7)
+UDP_SEGMENT = 103
+# Kernel limits of one GSO send: segments and bytes of a UDP payload
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_BYTES = 65000
+
+
+class BatchingTransport:
+    """
+    Collects the datagrams of one QuicConnectionProtocol.transmit() and
+    sends them in as few syscalls as possible.
+
+    Takes the place of the protocol's transport, which only calls sendto().
+    On Linux with UDP_SEGMENT support consecutive datagrams of the same
+    size (the last one may be shorter) go out in one sendmsg, the kernel
+    splits them into packets. Elsewhere, or while the transport buffers
+    datagrams itself, every datagram is one sendto as before.
+    """
+    def __init__(self, transport: asyncio.DatagramTransport):
+        self.__transport = transport
+        self.__socket = None
+        self.__datagrams = []
+        if sys.platform == "linux":
+            transport_socket = transport.get_extra_info("socket")
+            try:
+                transport_socket.getsockopt(socket.SOL_UDP, UDP_SEGMENT)
+                # sendmsg is not exposed by asyncio's TransportSocket
+                self.__socket = transport_socket._sock
+            except (OSError, AttributeError):
+                pass
+
+    @property
+    def gso(self) -> bool:
+        return self.__socket is not None
+
+    def sendto(self, data: bytes, addr) -> None:
+        self.__datagrams.append((data, addr))
+
+    def flush(self) -> tuple[int, int, int]:
+        """
+        Sends the collected datagrams, returns the number of datagrams, of
+        syscalls and of datagrams sent with GSO.
+        """
+        datagrams = self.__datagrams
+        self.__datagrams = []
+        num_syscalls = 0
+        num_segmented = 0
+        index = 0
+        while index < len(datagrams):
+            end = self.__segment_end(datagrams, index)
+            if end - index > 1 and self.__send_segments(datagrams[index:end]):
+                num_segmented += end - index
+                num_syscalls += 1
+            else:
+                for data, addr in datagrams[index:end]:
+                    self.__transport.sendto(data, addr)
+                    num_syscalls += 1
+            index = end
+        return len(datagrams), num_syscalls, num_segmented
+
+    def __segment_end(self, datagrams, start: int) -> int:
+        if self.__socket is None \
+                or self.__transport.get_write_buffer_size() > 0:
+            return start + 1
+        size = len(datagrams[start][0])
+        addr = datagrams[start][1]
+        total = size
+        end = start + 1
+        while end < len(datagrams) and end - start < GSO_MAX_SEGMENTS:
+            data, next_addr = datagrams[end]
+            if next_addr != addr or len(data) > size \
+                    or total + len(data) > GSO_MAX_BYTES:
+                break
+            total += len(data)
+            end += 1
+            if len(data) < size:
+                # Only the last segment may be shorter
+                break
+        return end
+
+    def __send_segments(self, datagrams) -> bool:
+        size = len(datagrams[0][0])
+        try:
+            self.__socket.sendmsg([data for data, _ in datagrams],
+                                  [(socket.SOL_UDP,
+                                    UDP_SEGMENT,
+                                    struct.pack("=H", size))],
+                                  0,
+                                  datagrams[0][1])
+        except BlockingIOError:
+            # The transport buffers them until the socket is writable
+            return False
+        except OSError:
+            # e.g. EIO without checksum offload on the route, don't retry
+            self.__socket = None
+            return False
+        return True
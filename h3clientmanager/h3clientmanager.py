@@ -1,6 +1,8 @@
 import time
 import asyncio
+import functools
 import ssl
+from contextlib import AsyncExitStack
 from logging import Logger
 from collections import deque
 from typing import Deque, Dict, List, Optional, cast
@@ -9,12 +11,32 @@ from qh3.quic.packet import *
 from qh3.asyncio.client import connect
 from qh3.asyncio.protocol import QuicConnectionProtocol
 from qh3.quic.configuration import QuicConfiguration
+from qh3.quic.connection import QuicConnectionState
 from qh3.quic.events import QuicEvent
-from qh3.h3.connection import H3_ALPN, ErrorCode, H3Connection
+from qh3.h3.connection import (H3_ALPN,
+                               ErrorCode,
+                               FrameType,
+                               H3Connection,
+                               HeadersState,
+                               ProtocolError,
+                               encode_frame)
 from qh3.h3.events import (DataReceived,
                            H3Event,
                            HeadersReceived,
                            PushPromiseReceived)
+from metrics import Metrics
+from profiler import StageProfiler
+from qpack import (CAPPED_TABLE_CAPACITY,
+                   StaticQpackEncoder,
+                   CappedQpackEncoder)
+from utilities import BodyStream
+from .batching import BatchingTransport
+from .response import RESPONSE_PREFIX, Response
+
+
+# Unacknowledged bytes of a body stream before its sender waits, see
+# HttpClient.send_body_stream
+BODY_STREAM_WINDOW = 1 << 18
 
 
 class URL:
@@ -42,25 +64,46 @@ class HttpRequest:
 
 
 class HttpClient(QuicConnectionProtocol):
-    def __init__(self, *args, **kwargs) -> None:
+    def __init__(self,
+                 *args,
+                 metrics: Metrics,
+                 profiler: StageProfiler,
+                 qpack_capacity: int | None = None,
+                 response_prefix: int = RESPONSE_PREFIX,
+                 **kwargs) -> None:
         super().__init__(*args, **kwargs)
+        self.__metrics = metrics
+        self.__profiler = profiler
+        self.__response_prefix = response_prefix
+        self.__batch = None
+        self.__requests_queued = False
+        # Body streams waiting for acknowledgements or flow-control credit
+        self.__body_waiters = []
         self.pushes: Dict[int, Deque[H3Event]] = {}
-        self._request_events: Dict[int, Deque[H3Event]] = {}
-        self._request_waiter: Dict[int, asyncio.Future[Deque[H3Event]]] = {}
+        self._request_responses: Dict[int, Response] = {}
+        self._request_waiter: Dict[int, asyncio.Future[Response]] = {}
         if self._quic.configuration.alpn_protocols[0].startswith("hq-"):
             print("ERROR: Missing python-module qh3.h0. Program exits.")
             exit(1)
         else:
             self._http = H3Connection(self._quic)
+            if qpack_capacity is not None:
+                # Replaced before the peer's SETTINGS configure it
+                self._http._encoder = CappedQpackEncoder(qpack_capacity)
 
     def http_event_received(self, event: H3Event) -> None:
         if isinstance(event, (HeadersReceived, DataReceived)):
             stream_id = event.stream_id
-            if stream_id in self._request_events:
-                self._request_events[event.stream_id].append(event)
+            if stream_id in self._request_responses:
+                response = self._request_responses[stream_id]
+                if isinstance(event, HeadersReceived):
+                    response.add_headers(event.headers)
+                else:
+                    response.add_data(event.data)
                 if event.stream_ended:
                     req_waiter = self._request_waiter.pop(stream_id)
-                    req_waiter.set_result(self._request_events.pop(stream_id))
+                    req_waiter.set_result(
+                        self._request_responses.pop(stream_id))
 
             elif event.push_id in self.pushes:
                 self.pushes[event.push_id].append(event)
@@ -74,15 +117,161 @@ class HttpClient(QuicConnectionProtocol):
             for http_event in self._http.handle_event(event):
                 self.http_event_received(http_event)
 
+    def expect_response(self, stream_id: int) -> asyncio.Future[Response]:
+        """
+        Returns the future of the response on stream_id. Cancelling it
+        abandons the response, e.g. after a timeout.
+        """
+        waiter = self._loop.create_future()
+        self._request_responses[stream_id] = Response(self.__response_prefix)
+        self._request_waiter[stream_id] = waiter
+        waiter.add_done_callback(functools.partial(self.__abandon_response,
+                                                   stream_id))
+        return waiter
+
+    def __abandon_response(self, stream_id: int, waiter: asyncio.Future):
+        if not waiter.cancelled():
+            return
+        # Drops its state and asks the peer to stop sending, instead of
+        # reading a body nobody waits for until the stream ends
+        self._request_responses.pop(stream_id, None)
+        self._request_waiter.pop(stream_id, None)
+        stream = self._quic._streams.get(stream_id)
+        if stream is not None and not stream.receiver.is_finished \
+                and self._quic._state == QuicConnectionState.CONNECTED:
+            self._quic.stop_stream(stream_id, ErrorCode.H3_REQUEST_CANCELLED)
+            self._transmit_soon()
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        super().connection_made(transport)
+        self.__batch = BatchingTransport(transport)
+        self._transport = self.__batch
+        self.__metrics.set_gso(self.__batch.gso)
+
+    def transmit(self) -> None:
+        if self.__requests_queued:
+            self.__requests_queued = False
+            with self.__profiler.stage("send"):
+                self.__transmit()
+        else:
+            self.__transmit()
+
+    def transmit_soon(self) -> None:
+        """
+        Transmits once the callbacks of the current event loop iteration
+        ran, so requests queued together share datagrams and syscalls.
+        """
+        self.__requests_queued = True
+        self._transmit_soon()
+
+    def __transmit(self) -> None:
+        super().transmit()
+        datagrams, syscalls, segmented = self.__batch.flush()
+        if datagrams > 0:
+            self.__metrics.report_transmit(datagrams, syscalls, segmented)
+        # Every received datagram ends in a transmit, e.g. ACK or MAX_DATA
+        waiters = self.__body_waiters
+        self.__body_waiters = []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def send_body_stream(self,
+                               stream_id: int,
+                               body: BodyStream,
+                               response: asyncio.Future) -> None:
+        """
+        Sends a body stream as DATA frames after the HEADERS frame.
+
+        The next frame is only generated while less than BODY_STREAM_WINDOW
+        bytes of the stream are unacknowledged, so a peer that withholds
+        flow-control credit holds the sender back instead of the whole body
+        piling up in the stream buffer. Once the response arrived, the peer
+        sent STOP_SENDING or the connection closed the rest is not sent and
+        the stream is reset.
+        """
+        sender = self._quic._streams[stream_id].sender
+        finished = False
+        try:
+            for payload, end_stream in body.frames():
+                while not self.__body_stopped(sender, response) \
+                        and sender._buffer_stop - sender._buffer_start \
+                        >= BODY_STREAM_WINDOW:
+                    waiter = self._loop.create_future()
+                    self.__body_waiters.append(waiter)
+                    await waiter
+                if self.__body_stopped(sender, response):
+                    return
+                self._http.send_data(stream_id, payload, end_stream)
+                self.transmit_soon()
+            finished = True
+        finally:
+            if not finished and sender._reset_error_code is None \
+                    and self._quic._state == QuicConnectionState.CONNECTED:
+                self._quic.reset_stream(stream_id,
+                                        ErrorCode.H3_REQUEST_CANCELLED)
+                self.transmit_soon()
+
+    def __body_stopped(self, sender, response: asyncio.Future) -> bool:
+        return response.done() \
+            or sender._reset_error_code is not None \
+            or self._quic._state != QuicConnectionState.CONNECTED
+
+    def send_encoded_headers(self,
+                             stream_id: int,
+                             field_section: bytes,
+                             end_stream: bool) -> None:
+        """
+        Sends a HEADERS frame with a field section that is already QPACK
+        encoded, H3Connection.send_headers would encode it on every call.
+        """
+        stream = self._http._get_or_create_stream(stream_id)
+        if stream.headers_send_state != HeadersState.INITIAL:
+            raise RuntimeError("HEADERS frame already sent on this stream")
+        # DATA frames check this state
+        stream.headers_send_state = HeadersState.AFTER_HEADERS
+        self._quic.send_stream_data(stream_id,
+                                    encode_frame(FrameType.HEADERS,
+                                                 field_section),
+                                    end_stream)
+
 
 class H3ClientManager:
-    def __init__(self, logger: Logger, url, ca_certs, secrets_log):
+    def __init__(self,
+                 logger: Logger,
+                 url,
+                 ca_certs,
+                 secrets_log,
+                 metrics: Metrics,
+                 profiler: StageProfiler,
+                 qpack_table: str = "none",
+                 qpack_capacity: int = CAPPED_TABLE_CAPACITY,
+                 standby: int = 1,
+                 response_prefix: int = RESPONSE_PREFIX):
         self.__logger = logger
+        self.__metrics = metrics
+        self.__profiler = profiler
+        # "none": static-only sections sent as raw HEADERS frames, "capped"
+        # and "full": qh3's encoder with a capped or the peer's dynamic table
+        self.__qpack_table = qpack_table
+        self.__metrics.set_qpack_table(qpack_table)
+        self.__create_protocol = functools.partial(
+            HttpClient,
+            metrics=metrics,
+            profiler=profiler,
+            qpack_capacity=qpack_capacity if qpack_table == "capped" else None,
+            response_prefix=response_prefix)
         self.__configuration = QuicConfiguration(is_client=True,
                                                  alpn_protocols=H3_ALPN)
         self.__first_time = True
         self.__url = url
         self.__client = None
+        # Connections kept handshaked for the next reconnect, see run_loop
+        self.__num_standby = standby
+        self.__standby = deque()
+        self.__closing = set()
+        # Static-only, so the cached field lines survive reconnects
+        self.__encoder = StaticQpackEncoder()
 
         if ca_certs is not None:
             self.__configuration.load_verify_locations(ca_certs)
@@ -131,24 +320,35 @@ class H3ClientManager:
         self.__url = _p.geturl()
 
         # Create client and run start test pipeline in testmanager
-        # This loop creates new clients and hands them to the testmanager
-        # until the testpipline is finished.
+        # This loop hands clients to the testmanager until the testpipline
+        # is finished. Up to num_standby further clients do their handshake
+        # in the background, a reconnect promotes the oldest one and only
+        # waits for a handshake if all of them died.
         testing = True
-        while (testing):
+        try:
+            while (testing):
             #try:
+                reconnecting = not self.__first_time
                 if self.__first_time:
                     self.__first_time = False
                     self.__logger.info("Connecting...")
                 else:
                     self.__logger.info("Reconnecting...")
-                async with connect(host,
-                                   port,
-                                   configuration=self.__configuration,
-                                   create_protocol=HttpClient,
-                                   local_port=0) as client:
-                    self.__client = cast(HttpClient, client)
+                    self.__metrics.reconnected()
+                start_time = time.perf_counter()
+                self.__fill_standby(host, port)
+                stack, client = await self.__promote(host, port)
+                self.__fill_standby(host, port)
+                if reconnecting:
+                    self.__metrics.report_failover(time.perf_counter()
+                                                   - start_time)
+                self.__client = client
+                try:
                     testing = await test_pipeline(self.perform_http_request,
                                                   self.connection_state)
+                finally:
+                    # Draining the old connection is off the critical path
+                    self.__close_later(stack)
             #except Exception as e:
             #    final_msg = "Connection couldn't be established"
             #    error_msg = str(e)
@@ -159,10 +359,77 @@ class H3ClientManager:
             #    exit(-1)
             #if not testing:
             #    self.__client._quic.close(error_code=ErrorCode.H3_NO_ERROR)
+        finally:
+            await self.__close_all()
         return
 
-    async def perform_http_request(self, headers=None, data=None) -> str:
+    async def __open(self, host, port) -> tuple[AsyncExitStack, HttpClient]:
+        stack = AsyncExitStack()
+        client = await stack.enter_async_context(
+            connect(host,
+                    port,
+                    configuration=self.__configuration,
+                    create_protocol=self.__create_protocol,
+                    local_port=0))
+        return stack, cast(HttpClient, client)
+
+    def __fill_standby(self, host, port):
+        while len(self.__standby) < self.__num_standby:
+            self.__standby.append(asyncio.create_task(self.__open(host,
+                                                                  port)))
+
+    async def __promote(self, host, port) -> tuple[AsyncExitStack, HttpClient]:
+        while self.__standby:
+            try:
+                stack, client = await self.__standby.popleft()
+            except Exception as e:
+                # e.g. a proxy limiting connections per client
+                self.__logger.warning(f"Standby connection failed: {e}")
+                continue
+            if client._quic._state == QuicConnectionState.CONNECTED:
+                return stack, client
+            # Closed while waiting, e.g. by the proxy's idle timeout
+            self.__close_later(stack)
+        return await self.__open(host, port)
+
+    def __close_later(self, stack: AsyncExitStack):
+        task = asyncio.create_task(stack.aclose())
+        self.__closing.add(task)
+        task.add_done_callback(self.__closing.discard)
 
+    async def __close_all(self):
+        while self.__standby:
+            task = self.__standby.popleft()
+            if task.done() and task.exception() is None:
+                self.__close_later(task.result()[0])
+            else:
+                task.cancel()
+                self.__closing.add(task)
+        await asyncio.gather(*self.__closing, return_exceptions=True)
+
+    async def perform_http_request(self,
+                                   headers=None,
+                                   data=None) -> Response:
+        waiter, body = self.__queue_request(headers, data)
+        # Requests issued in the same loop iteration are sent together
+        self.__client.transmit_soon()
+        return await self.__wait_for_response(waiter, body)
+
+    async def perform_http_requests(self, requests) -> list:
+        """
+        Sends several (headers, data) requests with a single transmit and
+        returns their responses in order. The frames of all streams are
+        coalesced into full-size datagrams.
+        """
+        queued = [self.__queue_request(headers, data)
+                  for headers, data in requests]
+        with self.__profiler.stage("send"):
+            self.__client.transmit()
+        return await asyncio.gather(*[self.__wait_for_response(waiter, body)
+                                      for waiter, body in queued])
+
+    def __queue_request(self, headers, data) -> tuple[asyncio.Future,
+                                                      asyncio.Task | None]:
         stream_id = self.__client._quic.get_next_available_stream_id()
         parsed_url = urlparse(self.__url)
         full_path = parsed_url.path
@@ -176,25 +443,58 @@ class H3ClientManager:
                     (b"user-agent", b"test"),
                 ]
 
-        self.__client._http.send_headers(
-            stream_id=stream_id,
-            headers=headers,
-            end_stream=True if data is None else False,
-        )
-
-        send_data = data
-        if isinstance(data, str):
-            send_data = data.encode()
-        if data is not None:
-            self.__client._http.send_data(
-                stream_id=stream_id, data=send_data, end_stream=True
-            )
-
-        self.__client.transmit()
-
-        waiter = self.__client._loop.create_future()
-        self.__client._request_events[stream_id] = deque()
-        self.__client._request_waiter[stream_id] = waiter
+        with self.__profiler.stage("encode"):
+            if self.__qpack_table == "none":
+                self.__client.send_encoded_headers(
+                    stream_id=stream_id,
+                    field_section=self.__encoder.encode(headers),
+                    end_stream=True if data is None else False,
+                )
+            else:
+                try:
+                    self.__client._http.send_headers(
+                        stream_id=stream_id,
+                        headers=headers,
+                        end_stream=True if data is None else False,
+                    )
+                except ProtocolError:
+                    # e.g. QpackEncoderStreamError
+                    self.__metrics.qpack_error()
+                    raise
+
+            send_data = data
+            if isinstance(data, str):
+                send_data = data.encode()
+            if data is not None and not isinstance(data, BodyStream):
+                self.__client._http.send_data(
+                    stream_id=stream_id, data=send_data, end_stream=True
+                )
+
+        waiter = self.__client.expect_response(stream_id)
+        body = None
+        if isinstance(data, BodyStream):
+            # Sent frame by frame while the response is awaited
+            body = asyncio.create_task(
+                self.__client.send_body_stream(stream_id, data, waiter))
+        return waiter, body
+
+    async def __wait_for_response(self,
+                                  waiter: asyncio.Future,
+                                  body: asyncio.Task | None = None):
         # Wait for response
-        http_events = await asyncio.shield(waiter)
-        return http_events
+        start_time = time.perf_counter()
+        latency = None
+        self.__metrics.request_started()
+        try:
+            with self.__profiler.stage("wait"):
+                response = await asyncio.shield(waiter)
+            latency = time.perf_counter() - start_time
+        finally:
+            self.__metrics.request_finished(latency)
+            if not waiter.done():
+                # e.g. a timeout, see HttpClient.expect_response
+                waiter.cancel()
+            if body is not None:
+                # e.g. a timeout or a response before the body was sent
+                body.cancel()
+        return response
@@ -0,0 +1,52 @@
+import hashlib
+
+
+# Body bytes kept per response by default, see main (--response-prefix)
+RESPONSE_PREFIX = 1024
+
+
+class Response:
+    """
+    What is kept of the response to one request.
+
+    The oracle only needs the status, yet the echo backend returns the whole
+    request as body, so large fuzz cases come back at full size. Only the
+    first HEADERS frame, the first prefix bytes of the body and the length
+    and a running BLAKE2b digest of the whole body are kept; memory per
+    response is flat however large the body is. All three are stored with
+    the verdict, the digest tells whether two targets answered alike.
+    """
+    __slots__ = ("headers", "body", "length", "__digest", "__prefix")
+
+    def __init__(self, prefix: int = RESPONSE_PREFIX):
+        self.headers = None
+        self.body = b""
+        self.length = 0
+        self.__digest = hashlib.blake2b(digest_size=16)
+        self.__prefix = prefix
+
+    @property
+    def status(self) -> bytes | None:
+        if self.headers is None:
+            return None
+        for name, value in self.headers:
+            if name == b":status":
+                return value
+        return None
+
+    @property
+    def digest(self) -> bytes:
+        """16 byte digest of the whole body."""
+        return self.__digest.digest()
+
+    def add_headers(self, headers):
+        # Later HEADERS frames are trailers or follow an informational
+        # response, the oracle has always judged the first one
+        if self.headers is None:
+            self.headers = headers
+
+    def add_data(self, data: bytes):
+        if len(self.body) < self.__prefix:
+            self.body += data[:self.__prefix - len(self.body)]
+        self.length += len(data)
+        self.__digest.update(data)
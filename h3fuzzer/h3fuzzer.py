@@ -1,10 +1,18 @@
 import time
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from numpy import random
 from request import Request
 from grammar import Grammar, NonTerminal, Header, Terminal, Data
 from mutation import FillUntilMax
-from utilities import TestState, TestResult
+from resultstore import ResultStore
+from metrics import Metrics
+from profiler import StageProfiler
+from dedup import BloomFilter, fingerprint
+from scheduler import CoverageScheduler
+from minimizer import Minimizer
+from utilities import TestState, TestResult, intern_value
 from qh3.quic.connection import QuicConnectionState
 
 
@@ -16,10 +24,21 @@ class H3Fuzzer:
                  path,
                  num_fuzzes,
                  seed,
-                 timeout: float):
+                 timeout: float,
+                 result_store: ResultStore,
+                 metrics: Metrics,
+                 profiler: StageProfiler,
+                 max_resamples: int = 10,
+                 dedup_capacity: int = 1 << 20,
+                 scheduler: CoverageScheduler | None = None,
+                 minimizer: Minimizer | None = None,
+                 prefetch: int = 0):
         self.state = TestState.INIT
         self.__logger = logger
         self.__grammar = grammar
+        self.__results = result_store
+        self.__metrics = metrics
+        self.__profiler = profiler
         self.__max_name_chars = 16
         self.__max_value_chars = 16
         self.__num_tests = 0
@@ -28,27 +47,85 @@ class H3Fuzzer:
         self.__path = path
         self.__timeout = timeout
         self.__random = random.default_rng(seed)
+        self.__scheduler = scheduler
+        self.__features = []
+        # Duplicates are resampled up to max_resamples times, 0 disables it
+        self.__max_resamples = max_resamples
+        self.__seen = None
+        if max_resamples > 0:
+            self.__seen = BloomFilter(dedup_capacity)
+        self.__num_generated = 0
+        self.__num_duplicates = 0
+        self.__minimizer = minimizer
+        self.__oracle_lock = nullcontext()
+        if minimizer is not None:
+            self.__oracle_lock = minimizer.oracle_lock
+        # Number of requests built ahead on a producer thread, 0 builds
+        # every request when it is sent
+        self.__prefetch = prefetch
+        self.__queue = None
+        self.__producer = None
 
     async def run_tests(self, http_request, connection_state):
         self.state = TestState.RUNNING
+        if self.__minimizer is not None:
+            self.__minimizer.start(http_request, connection_state)
+        if self.__prefetch > 0 and self.__producer is None:
+            # Keeps its queue across reconnects
+            self.__queue = asyncio.Queue(self.__prefetch)
+            self.__producer = asyncio.create_task(
+                self.__produce(self.__num_fuzzes - self.__num_tests))
         while self.__num_tests < self.__num_fuzzes:
             if connection_state() != QuicConnectionState.CONNECTED:
                 self.state = TestState.WAITING_FOR_NEW_CLIENT
                 return
             self.__num_tests += 1
-            request = self.__get_fuzz()
+            request = await self.__next_fuzz()
             result = None
-            try:
-                resp = await asyncio.wait_for(http_request(request.headers,
-                                                           request.data),
-                                              timeout=self.__timeout)
-            except TimeoutError:
-                resp = None
-            except Exception as e:
-                self.__logger.critical(str(e))
-                self.state = TestState.FINISHED_WITH_ERROR
-            result = request.evaluate_response(resp)
-            self.__logger.info(f"{self.__num_tests}/{self.__num_fuzzes} fuzz[{request.request_id}]: {result.name}")
+            async with self.__oracle_lock:
+                start_time = time.perf_counter()
+                try:
+                    resp = await asyncio.wait_for(
+                        http_request(request.headers, request.data),
+                        timeout=self.__timeout)
+                except TimeoutError:
+                    resp = None
+                except Exception as e:
+                    self.__logger.critical(str(e))
+                    self.state = TestState.FINISHED_WITH_ERROR
+                latency = time.perf_counter() - start_time
+                with self.__profiler.stage("oracle"):
+                    result = request.evaluate_response(resp)
+            if self.__minimizer is not None:
+                self.__minimizer.submit(request, result)
+            with self.__profiler.stage("logging"):
+                if self.__scheduler is not None:
+                    self.__scheduler.report(request.features, result)
+                self.__results.add(request, result, latency)
+                self.__metrics.report_result(result)
+                self.__logger.info("%d/%d fuzz[%d]: %s",
+                                   self.__num_tests,
+                                   self.__num_fuzzes,
+                                   request.request_id,
+                                   result.name,
+                                   extra={"progress": True})
+        if self.__minimizer is not None:
+            # Finish the queued minimizations before the campaign ends
+            while self.__minimizer.busy:
+                if connection_state() != QuicConnectionState.CONNECTED:
+                    self.state = TestState.WAITING_FOR_NEW_CLIENT
+                    return
+                await asyncio.sleep(0.1)
+            await self.__minimizer.stop()
+        if self.__producer is not None:
+            await self.__producer
+            self.__producer = None
+        if self.__seen is not None:
+            self.__logger.info(f"Duplicates: {self.__num_duplicates} of "
+                               f"{self.__num_generated} generated requests "
+                               f"({self.duplicate_rate:.1%}) resampled")
+        if self.__scheduler is not None:
+            self.__logger.info(self.__scheduler.summary())
         self.state = TestState.FINISHED
 
     def set_max_name_chars(self, max: int):
@@ -57,49 +134,162 @@ class H3Fuzzer:
     def set_max_value_chars(self, max: int):
         self.__max_value_chars = max
 
+    @property
+    def duplicate_rate(self) -> float:
+        if self.__num_generated == 0:
+            return 0.0
+        return self.__num_duplicates / self.__num_generated
+
+    def generate(self) -> Request:
+        """Derives and builds one fuzz case without sending it."""
+        return self.__get_fuzz()
+
+    async def __next_fuzz(self) -> Request:
+        if self.__queue is None:
+            return self.__get_fuzz()
+        request = await self.__queue.get()
+        if isinstance(request, Exception):
+            raise request
+        return request
+
+    async def __produce(self, num_requests: int):
+        """
+        Builds requests on a thread while the event loop waits for the
+        network. The bounded queue is the backpressure: at most prefetch
+        requests are built ahead, so the char tables and the scheduler they
+        were derived from are at most prefetch + 1 verdicts old. Char table
+        draws and reports take the grammar lock; the scheduler's counters
+        are only updated by single dict and list operations.
+        """
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(1, "h3fuzz-producer") as executor:
+            try:
+                for _ in range(num_requests):
+                    request = await loop.run_in_executor(executor,
+                                                         self.__get_fuzz)
+                    await self.__queue.put(request)
+            except Exception as e:
+                await self.__queue.put(e)
+
     def __get_fuzz(self) -> Request:
-        sequence = []
-        sequence_is_legal = True
-        while sequence_is_legal:
-            # Init sequence and check if start is illegal
-            sequence = [self.__grammar.get_nonterminal("start")]
-            if sequence[0].is_illegal:
-                sequence_is_legal = False
-            # Iteratively extend sequence until only headers remain
-            while not all(self.__is_header_or_data(item) for item in sequence):
-                new_sequence = []
-                for item in sequence:
-                    if isinstance(item, Header):
-                        new_sequence.append(item)
-                    elif isinstance(item, Data):
-                        self.__data = item.load
-                    elif isinstance(item, NonTerminal):
-                        extended_item = self.__extend_nonterminal(item.name)
-                        if sequence_is_legal:
-                            if any(item.is_illegal for item in extended_item):
-                                sequence_is_legal = False
-                        if extended_item is not None:
-                            new_sequence.extend(extended_item)
-                    else:
-                        raise TypeError
-                sequence = new_sequence
-        return Request(self.__logger,
-                       sequence,
-                       self.__grammar,
-                       self.__authority,
-                       self.__path,
-                       self.__max_name_chars,
-                       self.__max_value_chars,
-                       False,
-                       self.__random)
+        resamples = 0
+        while True:
+            request = self.__build_fuzz()
+            self.__num_generated += 1
+            if self.__seen is None:
+                return request
+            digest = fingerprint(request.headers[:-1], request.data)
+            if self.__seen.add(digest):
+                self.__metrics.report_generated(False)
+                return request
+            self.__num_duplicates += 1
+            self.__metrics.report_generated(True)
+            if resamples >= self.__max_resamples:
+                # The grammar may not have enough distinct requests left
+                return request
+            resamples += 1
+
+    def __build_fuzz(self) -> Request:
+        with self.__profiler.stage("generation"):
+            sequence = self.__derive_sequence()
+        with self.__profiler.stage("build"):
+            request = Request(self.__logger,
+                              sequence,
+                              self.__grammar,
+                              self.__authority,
+                              self.__path,
+                              self.__max_name_chars,
+                              self.__max_value_chars,
+                              False,
+                              self.__random,
+                              scheduler=self.__scheduler)
+            # Derivative choices first, then the mutation choices of Request
+            request.features = self.__features + request.features
+            return request
+
+    def __derive_sequence(self) -> list:
+        """
+        Derives a sequence that contains at least one illegal nonterminal or
+        data, without retries: while none occurred, every derivative is
+        weighted by the probability that the sequence still turns illegal
+        if it is chosen, i.e. sampling is conditioned on illegality.
+        """
+        self.__features = []
+        start = self.__grammar.get_nonterminal("start")
+        sequence = [start]
+        found_illegal = start.is_illegal
+        # Iteratively extend sequence until only headers remain
+        while not all(self.__is_header_or_data(item) for item in sequence):
+            # legal_after[i]: no illegal item below sequence[i + 1:]
+            legal_after = [1.0] * (len(sequence) + 1)
+            for i in range(len(sequence) - 1, -1, -1):
+                legal_after[i] = legal_after[i + 1] \
+                    * (1.0 - self.__illegal_probability(sequence[i]))
+            # Same for the items already derived on this level
+            legal_derived = 1.0
+            new_sequence = []
+            for i, item in enumerate(sequence):
+                if isinstance(item, Header):
+                    new_sequence.append(item)
+                elif isinstance(item, Data):
+                    self.__data = item.load
+                elif isinstance(item, NonTerminal):
+                    legal_rest = 0.0
+                    if not found_illegal:
+                        legal_rest = legal_derived * legal_after[i + 1]
+                    extended_item = self.__extend_nonterminal(item.name,
+                                                              legal_rest)
+                    if extended_item is not None:
+                        for obj in extended_item:
+                            if isinstance(obj, (NonTerminal, Data)) \
+                                    and obj.is_illegal:
+                                found_illegal = True
+                            legal_derived *= 1.0 \
+                                - self.__illegal_probability(obj)
+                        new_sequence.extend(extended_item)
+                else:
+                    raise TypeError
+            sequence = new_sequence
+        return sequence
+
+    def __illegal_probability(self, object) -> float:
+        if isinstance(object, NonTerminal):
+            return self.__grammar.illegal_probability(object.name)
+        return 0.0
 
     def __is_header_or_data(self, object: NonTerminal):
         return (isinstance(object, Header) or isinstance(object, Data))
 
-    def __extend_nonterminal(self, nonterminal_str):
+    def __extend_nonterminal(self, nonterminal_str, legal_rest: float):
+        """
+        legal_rest is the probability that neither the rest of the sequence
+        nor anything derived so far is illegal; 0 if an illegal item already
+        occurred, then the grammar probabilities are used unconditioned.
+        """
         nonterminal = self.__grammar.get_nonterminal(nonterminal_str)
-        choice = self.__choice(nonterminal.derivatives,
-                               nonterminal.probabilities)
+        probabilities = nonterminal.probabilities
+        likelihoods = None
+        if legal_rest > 0:
+            # P(illegal sequence | derivative) = 1 - (1 - q_d) * legal_rest
+            likelihoods = [1.0 - (1.0 - q) * legal_rest
+                           for q in self.__grammar
+                           .derivative_illegal_probabilities(nonterminal.name)]
+        if self.__scheduler is None:
+            if likelihoods is not None:
+                weights = [p * l for p, l in zip(probabilities, likelihoods)]
+                total = sum(weights)
+                probabilities = [weight / total for weight in weights]
+            index = self.__choice_index(probabilities)
+        else:
+            index = self.__scheduler.choose(self.__random,
+                                            "N",
+                                            nonterminal.name,
+                                            probabilities,
+                                            likelihoods)
+        self.__features.append(intern_value(("N",
+                                             nonterminal.name,
+                                             int(index))))
+        choice = nonterminal.derivatives[index]
         extended = []
         if choice is None:
             return None
@@ -111,7 +301,6 @@ class H3Fuzzer:
         else:
             return extended
 
-    def __choice(self, options, probabilities):
-        index = self.__random.choice(list(range(len(options))),
-                                     p=probabilities)
-        return options[index]
+    def __choice_index(self, probabilities):
+        return self.__random.choice(list(range(len(probabilities))),
+                                    p=probabilities)
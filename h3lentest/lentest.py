@@ -54,7 +54,7 @@ class HeaderLengthTest:
         try:
             resp = await asyncio.wait_for(http_request(headers=headers),
                                           timeout=self.__timeout)
-            if resp[0].headers[0][1] == b'200':
+            if resp.status == b'200':
                 return True
             else:
                 return False
@@ -0,0 +1,3 @@
+from .replay import H3Replay
+
+__all__ = ["H3Replay"]
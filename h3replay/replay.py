@@ -0,0 +1,172 @@
+import asyncio
+import time
+from logging import Logger
+from urllib.parse import urlparse
+from qh3.quic.connection import QuicConnectionState
+from corpus import CorpusReader
+from request import Request
+from h3clientmanager import H3ClientManager
+from resultstore import ResultStore
+from metrics import Metrics
+from profiler import StageProfiler
+from utilities import TestPhase, TestState, TestResult
+
+
+class H3Replay:
+    """
+    Replays a stored corpus against a target.
+
+    Up to `concurrency` requests are in flight at once, `rate` caps the
+    number of requests started per second (None for no limit). Responses are
+    judged by Request.evaluate_response in the default executor, so reading
+    the backend capture does not block the event loop.
+    """
+    def __init__(self,
+                 logger: Logger,
+                 url: str,
+                 corpus_path: str,
+                 h3clientmanager: H3ClientManager,
+                 timeout: float,
+                 concurrency: int,
+                 rate: float | None,
+                 result_store: ResultStore,
+                 metrics: Metrics,
+                 profiler: StageProfiler,
+                 metrics_port: int | None = None,
+                 metrics_interval: float | None = None):
+        self.state = TestState.INIT
+        self.__logger = logger
+        self.__authority = urlparse(url).netloc.encode()
+        self.__path = urlparse(url).path.encode()
+        self.__corpus_path = corpus_path
+        self.__entries = iter(CorpusReader(corpus_path))
+        self.__next_entry = None
+        self.__h3client = h3clientmanager
+        self.__timeout = timeout
+        self.__concurrency = concurrency
+        self.__interval = 1 / rate if rate else 0
+        self.__next_start = 0
+        self.__results = result_store
+        self.__metrics = metrics
+        self.__profiler = profiler
+        self.__metrics_port = metrics_port
+        self.__metrics_interval = metrics_interval
+        self.__num_tests = 0
+        self.__verdicts = {result: 0 for result in TestResult}
+        self.__errors = 0
+        if concurrency > 1 and Request.capture_dir is None:
+            self.__logger.warning("Concurrent replay without --capture-dir: "
+                                  "backend captures of parallel requests "
+                                  "overwrite each other")
+
+    async def run(self):
+        self.__logger.info(f"Replaying {self.__corpus_path} with "
+                           f"concurrency {self.__concurrency}")
+        start_time = time.perf_counter()
+        self.__metrics.set_phase(TestPhase.REPLAY)
+        self.__profiler.set_phase(TestPhase.REPLAY)
+        await self.__metrics.start(self.__metrics_port, self.__metrics_interval)
+        try:
+            await self.__h3client.run_loop(self.test_pipeline)
+        finally:
+            await self.__metrics.stop()
+            self.__results.close()
+            runtime = time.perf_counter() - start_time
+            self.__logger.info(f"Runtime: {runtime} seconds")
+            self.__logger.info("Verdicts: " + ", ".join(
+                f"{result.name}={count}"
+                for result, count in self.__verdicts.items()))
+            if self.__errors:
+                self.__logger.critical(f"{self.__errors} requests could not "
+                                       f"be judged, see the log above")
+            self.__logger.info(self.__metrics.summary())
+            self.__logger.info(self.__metrics.qpack_summary())
+            self.__logger.info(self.__metrics.transmit_summary())
+            self.__profiler.write_report()
+
+    async def test_pipeline(self, http_request, connection_state):
+        await self.run_tests(http_request, connection_state)
+        match self.state:
+            case TestState.WAITING_FOR_NEW_CLIENT:
+                return True
+            case TestState.FINISHED:
+                self.__logger.info("Finished replay")
+                return False
+            case _:
+                self.__logger.critical("Program exited unexpectedly")
+                return False
+
+    async def run_tests(self, http_request, connection_state):
+        self.state = TestState.RUNNING
+        window = asyncio.Semaphore(self.__concurrency)
+        in_flight = set()
+        while True:
+            await window.acquire()
+            if connection_state() != QuicConnectionState.CONNECTED:
+                self.state = TestState.WAITING_FOR_NEW_CLIENT
+                break
+            if self.__next_entry is None:
+                self.__next_entry = next(self.__entries, None)
+                if self.__next_entry is None:
+                    self.state = TestState.FINISHED
+                    break
+            await self.__throttle()
+            request = Request.from_corpus(self.__logger,
+                                          self.__next_entry,
+                                          self.__authority,
+                                          self.__path)
+            self.__next_entry = None
+            task = asyncio.create_task(self.__replay(request,
+                                                     http_request,
+                                                     window))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        if in_flight:
+            await asyncio.gather(*in_flight)
+
+    async def __throttle(self):
+        if self.__interval == 0:
+            return
+        now = time.perf_counter()
+        if self.__next_start > now:
+            await asyncio.sleep(self.__next_start - now)
+            now = self.__next_start
+        self.__next_start = now + self.__interval
+
+    async def __replay(self, request: Request, http_request, window):
+        try:
+            start_time = time.perf_counter()
+            try:
+                resp = await asyncio.wait_for(http_request(request.headers,
+                                                           request.data),
+                                              timeout=self.__timeout)
+            except TimeoutError:
+                resp = None
+            except Exception as e:
+                self.__logger.critical(str(e))
+                resp = None
+            latency = time.perf_counter() - start_time
+            loop = asyncio.get_running_loop()
+            with self.__profiler.stage("oracle"):
+                try:
+                    result = await loop.run_in_executor(
+                        None, request.evaluate_response, resp)
+                except Exception as e:
+                    # The task is not awaited until the end of the replay,
+                    # an oracle failure would otherwise go unnoticed
+                    self.__errors += 1
+                    self.__logger.critical(f"Could not judge request "
+                                           f"{request.request_id}: {e!r}")
+                    return
+            with self.__profiler.stage("logging"):
+                self.__num_tests += 1
+                self.__verdicts[result] += 1
+                self.__results.add(request, result, latency)
+                self.__metrics.report_result(result)
+                self.__logger.info("replay %d [%d]: %s",
+                                   self.__num_tests,
+                                   request.request_id,
+                                   result.name,
+                                   extra={"progress": True})
+        finally:
+            window.release()
@@ -6,6 +6,9 @@ from urllib.parse import urlparse
 from grammar import Grammar, Header, Terminal
 from mutation import InsertChar
 from request import Request
+from resultstore import ResultStore
+from metrics import Metrics
+from profiler import StageProfiler
 from qh3.quic.connection import QuicConnectionState
 
 
@@ -16,10 +19,16 @@ class H3StaticTest:
                  grammar: Grammar,
                  authority :bytes,
                  path: bytes,
-                 timeout: float):
+                 timeout: float,
+                 result_store: ResultStore,
+                 metrics: Metrics,
+                 profiler: StageProfiler):
         self.state = TestState.INIT
         self.result = None
         self.__grammar = grammar
+        self.__results = result_store
+        self.__metrics = metrics
+        self.__profiler = profiler
         self.__authority = urlparse(url).netloc.encode()
         self.__path = urlparse(url).path.encode()
         self.__logger = logger
@@ -111,6 +120,7 @@ class H3StaticTest:
                                   None)
             else:
                 request = test[1]
+            start_time = time.perf_counter()
             try:
                 request_id = request.request_id
                 resp = await asyncio.wait_for(http_request(request.headers,
@@ -122,9 +132,24 @@ class H3StaticTest:
                 self.__logger.critical(str(e))
                 self.state = TestState.FINISHED_WITH_ERROR
                 return
-            result = request.evaluate_response(resp)
+            latency = time.perf_counter() - start_time
+            with self.__profiler.stage("oracle"):
+                result = request.evaluate_response(resp)
             if not char_test:
                 self.__grammar.report_pre_test_result(test[0], result)
-            self.__logger.info(f"Static test id: {request_id} '{test[0]}': {result.name}")
+            with self.__profiler.stage("logging"):
+                self.__results.add(request, result, latency)
+                self.__metrics.report_result(result)
+                self.__logger.info("Static test id: %d '%s': %s",
+                                   request_id,
+                                   test[0],
+                                   result.name,
+                                   extra={"progress": True})
         self.__grammar.apply_pre_test_actions()
+        if not self.__grammar.can_derive_illegal():
+            self.__logger.critical("After the pre-test actions no derivation "
+                                   "of 'start' contains an illegal "
+                                   "nonterminal, nothing left to fuzz")
+            self.state = TestState.FINISHED_WITH_ERROR
+            return
         self.state = TestState.FINISHED
@@ -0,0 +1,5 @@
+from .logpipeline import (LazyQueueHandler,
+                          BatchingHandler,
+                          ProgressRateFilter)
+
+__all__ = ["LazyQueueHandler", "BatchingHandler", "ProgressRateFilter"]
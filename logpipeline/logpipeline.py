@@ -0,0 +1,85 @@
+import time
+import logging
+import threading
+from logging.handlers import QueueHandler, MemoryHandler
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Enqueues records without formatting them.
+
+    The default QueueHandler merges msg and args on the calling thread. Here
+    the record is handed over as is, so formatting (e.g. of whole header
+    lists) happens on the listener thread. Arguments must therefore not be
+    mutated after they were logged.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class BatchingHandler(MemoryHandler):
+    """
+    Buffers records and hands them to the target handler in batches.
+
+    A batch is flushed when it is full, when a record reaches flush_level or
+    when flush_interval seconds passed since the last flush. The interval is
+    checked by a timer thread, so lines buffered before a quiet period (e.g.
+    a reconnect or a long timeout) still reach the file within about one
+    interval.
+    """
+    def __init__(self,
+                 target: logging.Handler,
+                 capacity: int = 256,
+                 flush_level: int = logging.ERROR,
+                 flush_interval: float = 1.0):
+        super().__init__(capacity,
+                         flushLevel=flush_level,
+                         target=target,
+                         flushOnClose=True)
+        self.__flush_interval = flush_interval
+        self.__last_flush = time.monotonic()
+        self.__closed = threading.Event()
+        self.__timer = threading.Thread(target=self.__flush_periodically,
+                                        name="h3fuzz-log-flush",
+                                        daemon=True)
+        self.__timer.start()
+
+    def shouldFlush(self, record: logging.LogRecord) -> bool:
+        return super().shouldFlush(record) or \
+            time.monotonic() - self.__last_flush >= self.__flush_interval
+
+    def flush(self):
+        with self.lock:
+            super().flush()
+            self.__last_flush = time.monotonic()
+
+    def close(self):
+        self.__closed.set()
+        super().close()
+
+    def __flush_periodically(self):
+        while not self.__closed.wait(self.__flush_interval):
+            if time.monotonic() - self.__last_flush >= self.__flush_interval:
+                self.flush()
+
+
+class ProgressRateFilter(logging.Filter):
+    """
+    Lets at most one progress record per interval pass.
+
+    Records are marked as progress with extra={"progress": True}, all other
+    records pass unconditionally.
+    """
+    def __init__(self, interval: float = 1.0):
+        super().__init__()
+        self.__interval = interval
+        self.__last_progress = 0.0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "progress", False):
+            return True
+        now = time.monotonic()
+        if now - self.__last_progress < self.__interval:
+            return False
+        self.__last_progress = now
+        return True
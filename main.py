@@ -1,24 +1,26 @@
 import argparse
+import atexit
 import logging
-import asyncio
 import os
-from numpy import random
-from h3clientmanager import H3ClientManager
-from testmanager import TestManager
+import queue
+import sys
+from logging.handlers import QueueListener
+from logpipeline import LazyQueueHandler, BatchingHandler, ProgressRateFilter
 from datetime import datetime
+from urllib.parse import urlparse
 
 
 import logging
 from datetime import datetime
 
-def init_logger(logger: logging.Logger, debug_mode: bool):
+def init_logger(logger: logging.Logger,
+                debug_mode: bool,
+                date_time: str) -> QueueListener:
     # Define custom REQUEST level if not already defined
     if not hasattr(logging, 'REQUEST'):
         logging.REQUEST = 25  # Between INFO (20) and WARNING (30)
         logging.addLevelName(logging.REQUEST, 'REQUEST')
     
-    now = datetime.now()
-    date_time = now.strftime("%d-%m-%Y_%H-%M-%S")
     main_filename = f"./logs/h3fuzz_{date_time}.log"
     request_filename = f"./logs/h3fuzz_{date_time}_requests.log"  # Separate file for REQUEST logs
     
@@ -34,28 +36,43 @@ def init_logger(logger: logging.Logger, debug_mode: bool):
     # Main file handler (excludes REQUEST logs)
     main_file_handler = logging.FileHandler(main_filename)
     main_file_handler.setFormatter(formatter_std)
-    main_file_handler.addFilter(lambda record: record.levelno != logging.REQUEST)
+    main_batch_handler = BatchingHandler(main_file_handler)
+    main_batch_handler.addFilter(lambda record: record.levelno != logging.REQUEST)
     
-    # Console handler (excludes REQUEST logs)
+    # Console handler (excludes REQUEST logs, at most one progress line per second)
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter_std)
     console_handler.addFilter(lambda record: record.levelno != logging.REQUEST)
+    console_handler.addFilter(ProgressRateFilter(1.0))
     
     # Dedicated handler for REQUEST logs
     request_file_handler = logging.FileHandler(request_filename)
-    request_file_handler.setLevel(logging.REQUEST)
     request_file_handler.setFormatter(formatter_req)
-    request_file_handler.addFilter(lambda record: record.levelno == logging.REQUEST)
+    request_batch_handler = BatchingHandler(request_file_handler)
+    request_batch_handler.setLevel(logging.REQUEST)
+    request_batch_handler.addFilter(lambda record: record.levelno == logging.REQUEST)
     
-    # Add all handlers to the logger
-    logger.addHandler(main_file_handler)
-    logger.addHandler(console_handler)
-    logger.addHandler(request_file_handler)
+    # The event loop only enqueues records, formatting and I/O happen on
+    # the listener thread
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(LazyQueueHandler(log_queue))
+    listener = QueueListener(log_queue,
+                             main_batch_handler,
+                             console_handler,
+                             request_batch_handler,
+                             respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
 
 
 def parse_args(parser: argparse.ArgumentParser):
     parser.add_argument(
-        "url", type=str, help="the URL to query (must be HTTPS)"
+        "url",
+        type=str,
+        nargs="*",
+        help="the URL to query (must be HTTPS), optional with " \
+             "--generate-only; several URLs run a multi-target campaign"
     )
     parser.add_argument(
         "-g",
@@ -104,25 +121,310 @@ def parse_args(parser: argparse.ArgumentParser):
     parser.add_argument(
         "--ca-certs", type=str, help="load CA certificates from specified file"
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "-r",
+        "--results",
+        type=str,
+        default=None,
+        help="SQLite file the per-request results are appended to " \
+             "(default: ./logs/h3fuzz_<date>_results.sqlite)"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="serve Prometheus metrics on http://127.0.0.1:<port>/metrics"
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=10.0,
+        help="seconds between metric summary lines, 0 disables them"
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="stages",
+        default=None,
+        choices=["stages", "cprofile"],
+        help="time every pipeline stage and write a per-stage breakdown " \
+             "to ./logs/h3fuzz_<date>_profile.txt, 'cprofile' additionally " \
+             "dumps cProfile stats per test phase"
+    )
+    parser.add_argument(
+        "--generate-only",
+        action="store_true",
+        default=False,
+        help="generate -n fuzz cases without sending them and write them " \
+             "to the corpus file given by --out"
+    )
+    parser.add_argument(
+        "--out",
+        type=str,
+        default=None,
+        help="corpus file for --generate-only " \
+             "(default: ./logs/h3fuzz_<date>_corpus.jsonl)"
+    )
+    parser.add_argument(
+        "--max-resamples",
+        type=int,
+        default=10,
+        help="resample a generated request up to this many times if it " \
+             "duplicates an earlier one, 0 disables duplicate suppression"
+    )
+    parser.add_argument(
+        "--schedule",
+        type=str,
+        default="grammar",
+        choices=["coverage", "grammar"],
+        help="'coverage' biases derivative and mutation choices towards " \
+             "rarely exercised and successful ones, 'grammar' samples the " \
+             "grammar probabilities only"
+    )
+    parser.add_argument(
+        "--minimize",
+        type=int,
+        default=0,
+        help="delta-debug up to this many ACCEPTED fuzz cases (one per " \
+             "grammar sequence) in the background and store the minimal " \
+             "reproducers in the results"
+    )
+    parser.add_argument(
+        "--differential",
+        action="store_true",
+        default=False,
+        help="with several URLs, store how every proxy forwarded each " \
+             "header and the body (passed, re-cased, normalized, dropped)"
+    )
+    parser.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+        help="send the requests of a corpus file instead of running the " \
+             "test phases"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=16,
+        help="maximum number of replayed requests in flight"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=None,
+        help="maximum number of replayed requests started per second"
+    )
+    parser.add_argument(
+        "--capture-dir",
+        type=str,
+        default=None,
+        help="read backend captures from <dir>/<smuggling-id> instead of " \
+             "./servers/request, e.g. ./servers/captures"
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="number of fuzz cases built ahead on a producer thread while " \
+             "waiting for responses, e.g. 8; 0 builds them one by one. " \
+             "Seeded runs are no longer reproducible with prefetching"
+    )
+    parser.add_argument(
+        "--qpack-table",
+        choices=["none", "capped", "full"],
+        default="none",
+        help="QPACK dynamic table of the client: none (static-only, no " \
+             "encoder stream), capped (at most --qpack-capacity bytes, no " \
+             "blocked streams) or full (as much as the proxy allows)"
+    )
+    parser.add_argument(
+        "--qpack-capacity",
+        type=int,
+        default=1024,
+        help="dynamic table capacity in bytes with --qpack-table capped"
+    )
+    parser.add_argument(
+        "--standby",
+        type=int,
+        default=1,
+        help="number of connections kept handshaked in the background and " \
+             "promoted when the active one dies, 0 connects on demand"
+    )
+    parser.add_argument(
+        "--response-prefix",
+        type=int,
+        default=1024,
+        help="bytes of every response body that are kept, the rest is only " \
+             "counted and hashed"
+    )
+    parser.add_argument(
+        "--grammar-cache",
+        type=str,
+        default=None,
+        help="directory of parsed and checked grammars, keyed by the " \
+             "grammar's content and the code version, e.g. " \
+             "~/.cache/h3fuzz; entries are only loaded if the directory " \
+             "and the entry are owned by the user and not writable by others"
+    )
+    parser.add_argument(
+        "--no-grammar-cache",
+        action="store_true",
+        help="always parse and check the grammar-file, overrides " \
+             "--grammar-cache"
+    )
+    args = parser.parse_args()
+    args.urls = args.url
+    args.url = args.urls[0] if len(args.urls) > 0 else None
+    if args.generate_only:
+        if args.num_fuzzes is None:
+            parser.error("--generate-only requires -n/--num-fuzzes")
+    elif args.url is None:
+        parser.error("the following arguments are required: url")
+    if len(args.urls) > 1:
+        if args.generate_only or args.replay is not None:
+            parser.error("--generate-only and --replay take one URL")
+        if args.num_fuzzes is None:
+            parser.error("several URLs require -n/--num-fuzzes")
+        if args.capture_dir is None:
+            parser.error("several URLs require --capture-dir, the backends "
+                         "would overwrite each other's capture")
+        if args.minimize > 0 or args.prefetch > 0:
+            parser.error("--minimize and --prefetch take one URL")
+    elif args.differential:
+        parser.error("--differential requires several URLs")
+    if args.profile is not None and args.prefetch > 0:
+        # cProfile only sees the loop thread and the stage times of the
+        # producer thread overlap the wait stage
+        parser.error("--profile requires --prefetch 0")
+    return args
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="HTTP/3 RFC 9114 fuzzer")
     args = parse_args(parser)
 
+    date_time = datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
     logger = logging.getLogger(__name__)
-    init_logger(logger, args.debug)
+    init_logger(logger, args.debug, date_time)
+
+    # Subsystems are imported once the arguments are parsed and only by the
+    # phases that need them: numpy, qh3 and the grammar take most of the
+    # startup time, --help and invalid arguments don't pay for them
+    from profiler import StageProfiler
+    from grammar import Grammar
+    profiler = StageProfiler(logger, args.profile, f"./logs/h3fuzz_{date_time}")
+    if args.grammar_cache is not None and not args.no_grammar_cache:
+        Grammar.cache_dir = os.path.expanduser(args.grammar_cache)
+
+    if args.generate_only:
+        # Offline, no network stack
+        from corpus import CorpusGenerator
+        out_path = args.out
+        if out_path is None:
+            out_path = f"./logs/h3fuzz_{date_time}_corpus.jsonl"
+        authority, path = b"<authority>", b"<path>"
+        if args.url is not None:
+            authority = urlparse(args.url).netloc.encode()
+            path = urlparse(args.url).path.encode()
+        generator = CorpusGenerator(logger=logger,
+                                    grammar_path=args.grammar,
+                                    num_fuzzes=args.num_fuzzes,
+                                    seed=args.seed,
+                                    out_path=out_path,
+                                    authority=authority,
+                                    path=path,
+                                    boundary=args.boundary,
+                                    profiler=profiler,
+                                    max_resamples=args.max_resamples)
+        generator.run()
+        sys.exit(0)
+
+    results_path = args.results
+    if results_path is None:
+        results_path = f"./logs/h3fuzz_{date_time}_results.sqlite"
+    import asyncio
+    from h3clientmanager import H3ClientManager
+    from resultstore import ResultStore
+    from metrics import Metrics
+    from request import Request
+    result_store = ResultStore(logger, results_path)
+    metrics = Metrics(logger)
+
+    Request.capture_dir = args.capture_dir
+    if len(args.urls) > 1:
+        from testmanager import MultiTargetManager
+        h3clientmanagers = [H3ClientManager(logger=logger,
+                                            url=url,
+                                            ca_certs=args.ca_certs,
+                                            secrets_log=args.secrets_log,
+                                            metrics=metrics,
+                                            profiler=profiler,
+                                            qpack_table=args.qpack_table,
+                                            qpack_capacity=args.qpack_capacity,
+                                            standby=args.standby,
+                                            response_prefix=args.response_prefix)
+                            for url in args.urls]
+        manager = MultiTargetManager(logger=logger,
+                                     urls=args.urls,
+                                     grammar_path=args.grammar,
+                                     num_fuzzes=args.num_fuzzes,
+                                     h3clientmanagers=h3clientmanagers,
+                                     seed=args.seed,
+                                     timeout=args.timeout,
+                                     result_store=result_store,
+                                     metrics=metrics,
+                                     profiler=profiler,
+                                     metrics_port=args.metrics_port,
+                                     metrics_interval=args.metrics_interval,
+                                     max_resamples=args.max_resamples,
+                                     coverage_guided=args.schedule == "coverage",
+                                     differential=args.differential)
+        asyncio.run(manager.run())
+        sys.exit(0)
 
     h3clientmanager = H3ClientManager(logger=logger,
                                       url=args.url,
                                       ca_certs=args.ca_certs,
-                                      secrets_log=args.secrets_log)
+                                      secrets_log=args.secrets_log,
+                                      metrics=metrics,
+                                      profiler=profiler,
+                                      qpack_table=args.qpack_table,
+                                      qpack_capacity=args.qpack_capacity,
+                                      standby=args.standby,
+                                      response_prefix=args.response_prefix)
+    if args.replay is not None:
+        from h3replay import H3Replay
+        replay = H3Replay(logger=logger,
+                          url=args.url,
+                          corpus_path=args.replay,
+                          h3clientmanager=h3clientmanager,
+                          timeout=args.timeout,
+                          concurrency=args.concurrency,
+                          rate=args.rate,
+                          result_store=result_store,
+                          metrics=metrics,
+                          profiler=profiler,
+                          metrics_port=args.metrics_port,
+                          metrics_interval=args.metrics_interval)
+        asyncio.run(replay.run())
+        sys.exit(0)
+
+    from testmanager import TestManager
     testmanager = TestManager(logger=logger,
                               h3clientmanager=h3clientmanager,
                               url=args.url,
                               grammar_path=args.grammar,
                               num_fuzzes=args.num_fuzzes,
                               seed=args.seed,
-                              timeout= args.timeout)
+                              timeout= args.timeout,
+                              result_store=result_store,
+                              metrics=metrics,
+                              profiler=profiler,
+                              metrics_port=args.metrics_port,
+                              metrics_interval=args.metrics_interval,
+                              max_resamples=args.max_resamples,
+                              coverage_guided=args.schedule == "coverage",
+                              minimize=args.minimize,
+                              prefetch=args.prefetch)
     asyncio.run(testmanager.run())
@@ -0,0 +1,3 @@
+from .metrics import Metrics, Histogram
+
+__all__ = ["Metrics", "Histogram"]
@@ -0,0 +1,319 @@
+import asyncio
+import math
+import time
+from logging import Logger
+from utilities import TestPhase, TestResult
+
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+
+class Histogram:
+    def __init__(self, buckets: list[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float | None:
+        """
+        Estimates a quantile as the upper bound of the bucket containing it.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                if index < len(self.buckets):
+                    return self.buckets[index]
+                return math.inf
+        return math.inf
+
+
+class Metrics:
+    def __init__(self, logger: Logger):
+        self.__logger = logger
+        self.__grammar = None
+        self.__phase = TestPhase.NORMAL_REQUEST
+        self.__phase_start = time.perf_counter()
+        self.__phase_requests = {phase: 0 for phase in TestPhase}
+        self.__phase_durations = {phase: 0.0 for phase in TestPhase}
+        self.__latencies = {phase: Histogram(LATENCY_BUCKETS)
+                            for phase in TestPhase}
+        self.__results = {result: 0 for result in TestResult}
+        self.__in_flight = 0
+        self.__reconnects = 0
+        self.__failovers = Histogram(LATENCY_BUCKETS)
+        self.__gso = False
+        self.__datagrams = 0
+        self.__send_calls = 0
+        self.__segmented = 0
+        self.__qpack_table = None
+        self.__qpack_errors = 0
+        self.__start = time.perf_counter()
+        self.__generated = 0
+        self.__duplicates = 0
+        self.__last_summary = (time.perf_counter(), 0)
+        self.__tasks = []
+        self.__server = None
+
+    def set_grammar(self, grammar):
+        self.__grammar = grammar
+
+    def set_phase(self, phase: TestPhase):
+        now = time.perf_counter()
+        self.__phase_durations[self.__phase] += now - self.__phase_start
+        self.__phase_start = now
+        self.__phase = phase
+
+    def request_started(self):
+        self.__in_flight += 1
+
+    def request_finished(self, latency: float | None):
+        self.__in_flight -= 1
+        self.__phase_requests[self.__phase] += 1
+        if latency is not None:
+            self.__latencies[self.__phase].observe(latency)
+
+    def report_result(self, result: TestResult):
+        self.__results[result] += 1
+
+    def report_generated(self, duplicate: bool):
+        self.__generated += 1
+        if duplicate:
+            self.__duplicates += 1
+
+    def reconnected(self):
+        self.__reconnects += 1
+
+    def report_failover(self, duration: float):
+        """Time from losing a connection until the next one is usable."""
+        self.__failovers.observe(duration)
+
+    def set_gso(self, gso: bool):
+        self.__gso = gso
+
+    def report_transmit(self, datagrams: int, send_calls: int, segmented: int):
+        self.__datagrams += datagrams
+        self.__send_calls += send_calls
+        self.__segmented += segmented
+
+    def transmit_summary(self) -> str:
+        requests = sum(self.__phase_requests.values())
+        per_request = ""
+        if requests > 0:
+            per_request = f" ({self.__datagrams / requests:.2f} datagrams " \
+                          f"and {self.__send_calls / requests:.2f} send " \
+                          f"calls per request)"
+        return f"Sent {self.__datagrams} datagrams in {self.__send_calls} " \
+               f"send calls{per_request}, {self.__segmented} datagrams " \
+               f"with GSO ({'on' if self.__gso else 'off'})"
+
+    def set_qpack_table(self, policy: str):
+        self.__qpack_table = policy
+
+    def qpack_error(self):
+        self.__qpack_errors += 1
+
+    async def start(self, port: int | None, interval: float | None):
+        if port is not None:
+            self.__server = await asyncio.start_server(self.__handle_scrape,
+                                                       "127.0.0.1",
+                                                       port)
+            self.__logger.info(f"Metrics served on http://127.0.0.1:{port}/metrics")
+        if interval:
+            self.__tasks.append(asyncio.create_task(self.__summarize(interval)))
+
+    async def stop(self):
+        for task in self.__tasks:
+            task.cancel()
+        self.__tasks = []
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+            self.__server = None
+
+    def requests_per_second(self, phase: TestPhase) -> float:
+        duration = self.__phase_durations[phase]
+        if phase == self.__phase:
+            duration += time.perf_counter() - self.__phase_start
+        if duration <= 0:
+            return 0.0
+        return self.__phase_requests[phase] / duration
+
+    def qpack_rates(self) -> tuple[float, float, float]:
+        """
+        Returns the reconnects per request, the share of TIMEOUT verdicts
+        and the useful requests (verdicts other than TIMEOUT) per second
+        of the run, the figures to compare QPACK table policies by.
+        """
+        requests = sum(self.__phase_requests.values())
+        verdicts = sum(self.__results.values())
+        timeouts = self.__results[TestResult.TIMEOUT]
+        duration = time.perf_counter() - self.__start
+        reconnect_rate = self.__reconnects / requests if requests else 0.0
+        timeout_rate = timeouts / verdicts if verdicts else 0.0
+        useful_rate = (verdicts - timeouts) / duration if duration > 0 else 0.0
+        return reconnect_rate, timeout_rate, useful_rate
+
+    def qpack_summary(self) -> str:
+        reconnect_rate, timeout_rate, useful_rate = self.qpack_rates()
+        return f"QPACK table {self.__qpack_table}: " \
+               f"{reconnect_rate:.2%} reconnects per request, " \
+               f"{timeout_rate:.1%} timeouts, " \
+               f"{self.__qpack_errors} QPACK errors, " \
+               f"{useful_rate:.1f} useful req/s"
+
+    def char_table_convergence(self):
+        """
+        Returns (name, remaining chars, highest probability, normalized
+        entropy) per char table. An entropy of 1.0 means the table is still
+        uniform, values towards 0.0 mean it converged to few chars.
+        """
+        convergence = []
+        if self.__grammar is None:
+            return convergence
+        for name, char_table in self.__grammar.get_all_char_tables():
+            probabilities = char_table.probabilities
+            if len(probabilities) == 0:
+                convergence.append((name, 0, 0.0, 0.0))
+                continue
+            entropy = -sum(p * math.log(p) for p in probabilities if p > 0)
+            if len(probabilities) > 1:
+                entropy /= math.log(len(probabilities))
+            else:
+                entropy = 0.0
+            convergence.append((name,
+                                len(probabilities),
+                                max(probabilities),
+                                entropy))
+        return convergence
+
+    def summary(self) -> str:
+        now = time.perf_counter()
+        total = sum(self.__phase_requests.values())
+        last_time, last_total = self.__last_summary
+        self.__last_summary = (now, total)
+        current_rate = 0.0
+        if now > last_time:
+            current_rate = (total - last_total) / (now - last_time)
+        histogram = self.__latencies[self.__phase]
+        p50 = self.__format_seconds(histogram.quantile(0.5))
+        p99 = self.__format_seconds(histogram.quantile(0.99))
+        results = " ".join(f"{result.name}={count}"
+                           for result, count in self.__results.items()
+                           if count > 0)
+        failover = ""
+        if self.__failovers.count > 0:
+            p50_failover = self.__failovers.quantile(0.5)
+            failover = f" (failover p50 {self.__format_seconds(p50_failover)})"
+        duplicates = ""
+        if self.__generated > 0:
+            rate = self.__duplicates / self.__generated
+            duplicates = f"duplicates {rate:.1%}, "
+        return f"Metrics: {self.__phase.name} {current_rate:.1f} req/s " \
+               f"(phase avg {self.requests_per_second(self.__phase):.1f}), " \
+               f"in-flight {self.__in_flight}, " \
+               f"reconnects {self.__reconnects}{failover}, {duplicates}" \
+               f"p50 {p50} p99 {p99}, {results}"
+
+    def render(self) -> str:
+        lines = []
+        lines.append("# TYPE h3fuzz_requests_total counter")
+        for phase, count in self.__phase_requests.items():
+            lines.append(f'h3fuzz_requests_total{{phase="{phase.name}"}} {count}')
+        lines.append("# TYPE h3fuzz_requests_per_second gauge")
+        for phase in TestPhase:
+            rate = self.requests_per_second(phase)
+            lines.append(f'h3fuzz_requests_per_second{{phase="{phase.name}"}} {rate}')
+        lines.append("# TYPE h3fuzz_phase gauge")
+        for phase in TestPhase:
+            active = int(phase == self.__phase)
+            lines.append(f'h3fuzz_phase{{phase="{phase.name}"}} {active}')
+        lines.append("# TYPE h3fuzz_in_flight gauge")
+        lines.append(f"h3fuzz_in_flight {self.__in_flight}")
+        lines.append("# TYPE h3fuzz_reconnects_total counter")
+        lines.append(f"h3fuzz_reconnects_total {self.__reconnects}")
+        policy = f'policy="{self.__qpack_table}"'
+        reconnect_rate, timeout_rate, useful_rate = self.qpack_rates()
+        lines.append("# TYPE h3fuzz_qpack_errors_total counter")
+        lines.append(f"h3fuzz_qpack_errors_total{{{policy}}} {self.__qpack_errors}")
+        lines.append("# TYPE h3fuzz_qpack_reconnect_rate gauge")
+        lines.append(f"h3fuzz_qpack_reconnect_rate{{{policy}}} {reconnect_rate}")
+        lines.append("# TYPE h3fuzz_qpack_timeout_rate gauge")
+        lines.append(f"h3fuzz_qpack_timeout_rate{{{policy}}} {timeout_rate}")
+        lines.append("# TYPE h3fuzz_qpack_useful_requests_per_second gauge")
+        lines.append(f"h3fuzz_qpack_useful_requests_per_second{{{policy}}} {useful_rate}")
+        lines.append("# TYPE h3fuzz_datagrams_sent_total counter")
+        lines.append(f"h3fuzz_datagrams_sent_total {self.__datagrams}")
+        lines.append("# TYPE h3fuzz_send_calls_total counter")
+        lines.append(f"h3fuzz_send_calls_total {self.__send_calls}")
+        lines.append("# TYPE h3fuzz_datagrams_segmented_total counter")
+        lines.append(f"h3fuzz_datagrams_segmented_total {self.__segmented}")
+        lines.append("# TYPE h3fuzz_failover_seconds histogram")
+        cumulative = 0
+        for bound, count in zip(self.__failovers.buckets + ["+Inf"],
+                                self.__failovers.counts):
+            cumulative += count
+            lines.append(f'h3fuzz_failover_seconds_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"h3fuzz_failover_seconds_sum {self.__failovers.sum}")
+        lines.append(f"h3fuzz_failover_seconds_count {self.__failovers.count}")
+        lines.append("# TYPE h3fuzz_generated_total counter")
+        lines.append(f"h3fuzz_generated_total {self.__generated}")
+        lines.append("# TYPE h3fuzz_duplicates_total counter")
+        lines.append(f"h3fuzz_duplicates_total {self.__duplicates}")
+        lines.append("# TYPE h3fuzz_results_total counter")
+        for result, count in self.__results.items():
+            lines.append(f'h3fuzz_results_total{{result="{result.name}"}} {count}')
+        lines.append("# TYPE h3fuzz_latency_seconds histogram")
+        for phase, histogram in self.__latencies.items():
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ["+Inf"],
+                                    histogram.counts):
+                cumulative += count
+                lines.append(f'h3fuzz_latency_seconds_bucket{{phase="{phase.name}",le="{bound}"}} {cumulative}')
+            lines.append(f'h3fuzz_latency_seconds_sum{{phase="{phase.name}"}} {histogram.sum}')
+            lines.append(f'h3fuzz_latency_seconds_count{{phase="{phase.name}"}} {histogram.count}')
+        lines.append("# TYPE h3fuzz_char_table_chars gauge")
+        lines.append("# TYPE h3fuzz_char_table_max_probability gauge")
+        lines.append("# TYPE h3fuzz_char_table_entropy gauge")
+        for name, chars, highest, entropy in self.char_table_convergence():
+            lines.append(f'h3fuzz_char_table_chars{{table="{name}"}} {chars}')
+            lines.append(f'h3fuzz_char_table_max_probability{{table="{name}"}} {highest}')
+            lines.append(f'h3fuzz_char_table_entropy{{table="{name}"}} {entropy}')
+        return "\n".join(lines) + "\n"
+
+    async def __summarize(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.__logger.info(self.summary())
+
+    async def __handle_scrape(self, reader, writer):
+        try:
+            await reader.readline()
+            body = self.render().encode()
+            writer.write(b"HTTP/1.0 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4\r\n"
+                         b"Content-Length: " + str(len(body)).encode() +
+                         b"\r\n\r\n" + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def __format_seconds(self, seconds: float | None) -> str:
+        if seconds is None:
+            return "-"
+        if math.isinf(seconds):
+            return f">{LATENCY_BUCKETS[-1]}s"
+        return f"<={seconds * 1000:g}ms"
@@ -0,0 +1,3 @@
+from .minimizer import Minimizer, ddmin
+
+__all__ = ["Minimizer", "ddmin"]
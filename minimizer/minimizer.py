@@ -0,0 +1,229 @@
+import asyncio
+from contextlib import nullcontext
+from logging import Logger
+from qh3.quic.connection import QuicConnectionState
+from request import Request
+from resultstore import ResultStore
+from utilities import CorpusEntry, MaliciousLoad, TestResult, BodyStream
+
+
+async def ddmin(items: list, test) -> list:
+    """
+    Zeller's delta debugging: returns a 1-minimal sublist of items for which
+    the coroutine test(sublist) still returns True. test(items) is assumed to
+    be True.
+    """
+    granularity = 2
+    while len(items) >= 2:
+        chunk = -(-len(items) // granularity)
+        subsets = [items[i:i + chunk] for i in range(0, len(items), chunk)]
+        reduced = False
+        for subset in subsets:
+            if await test(subset):
+                items = subset
+                granularity = 2
+                reduced = True
+                break
+        if not reduced:
+            for index in range(len(subsets)):
+                complement = [item
+                              for other, subset in enumerate(subsets)
+                              if other != index
+                              for item in subset]
+                if await test(complement):
+                    items = complement
+                    granularity = max(granularity - 1, 2)
+                    reduced = True
+                    break
+        if not reduced:
+            if granularity >= len(items):
+                break
+            granularity = min(granularity * 2, len(items))
+    return items
+
+
+class Minimizer:
+    """
+    Shrinks ACCEPTED fuzz cases in a background task.
+
+    The header list is minimized first, then the bytes of every remaining
+    header name and value, then the body. A candidate keeps the malicious
+    tokens of the original that still occur in it and has to be ACCEPTED
+    again. Candidates are sent on the campaign connection next to the
+    fuzzer; without per-request captures (--capture-dir) the fuzzer and the
+    minimizer take turns through oracle_lock, since they would overwrite
+    each other's capture. Candidates do not update the char tables.
+    """
+    def __init__(self,
+                 logger: Logger,
+                 result_store: ResultStore,
+                 authority: bytes,
+                 path: bytes,
+                 timeout: float,
+                 max_findings: int,
+                 max_tests: int = 256):
+        self.__logger = logger
+        self.__results = result_store
+        self.__authority = authority
+        self.__path = path
+        self.__timeout = timeout
+        self.__max_findings = max_findings
+        self.__max_tests = max_tests
+        self.__queue = asyncio.Queue()
+        self.__seen_sequences = set()
+        self.__num_submitted = 0
+        self.__num_pending = 0
+        self.__num_tests = 0
+        self.__task = None
+        self.__http_request = None
+        self.__connection_state = None
+        if Request.capture_dir is None:
+            self.oracle_lock = asyncio.Lock()
+        else:
+            self.oracle_lock = nullcontext()
+
+    @property
+    def busy(self) -> bool:
+        return self.__num_pending > 0
+
+    def submit(self, request: Request, result: TestResult):
+        if result != TestResult.ACCEPTED:
+            return
+        if self.__num_submitted >= self.__max_findings:
+            return
+        # One reproducer per grammar sequence is enough
+        key = ",".join(request.sequence)
+        if key in self.__seen_sequences:
+            return
+        self.__seen_sequences.add(key)
+        self.__num_submitted += 1
+        self.__num_pending += 1
+        # Findings may wait long, only keep what replaying them needs
+        self.__queue.put_nowait(request.to_corpus_entry())
+
+    def start(self, http_request, connection_state):
+        self.__http_request = http_request
+        self.__connection_state = connection_state
+        if self.__task is None:
+            self.__task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+
+    async def __run(self):
+        while True:
+            entry = await self.__queue.get()
+            try:
+                await self.__minimize(entry)
+            except Exception as e:
+                self.__logger.error(f"Minimizing fuzz[{entry.request_id}] "
+                                    f"failed: {e}")
+            finally:
+                self.__num_pending -= 1
+
+    async def __minimize(self, entry: CorpusEntry):
+        self.__num_tests = 0
+        self.__original = entry
+        self.__tokens = list(entry.malicious.all)
+        headers = entry.headers
+        data = entry.data
+        if not await self.__test(headers, data):
+            self.__logger.info(f"Fuzz[{entry.request_id}] is not "
+                               f"reproducible, not minimized")
+            return
+        headers = await ddmin(headers, lambda h: self.__test(h, data))
+        for index in range(len(headers)):
+            name, value = headers[index]
+            name = await self.__ddmin_bytes(
+                name,
+                lambda n: self.__test(self.__replace(headers, index, n, value),
+                                      data))
+            value = await self.__ddmin_bytes(
+                value,
+                lambda v: self.__test(self.__replace(headers, index, name, v),
+                                      data))
+            headers = self.__replace(headers, index, name, value)
+        if data is not None:
+            if await self.__test(headers, None):
+                data = None
+            elif not isinstance(data, BodyStream):
+                data = await self.__ddmin_bytes(
+                    data,
+                    lambda d: self.__test(headers, d))
+        tokens = self.__surviving_tokens(headers, data)
+        self.__results.add_reproducer(entry.request_id,
+                                      headers,
+                                      data,
+                                      tokens,
+                                      self.__num_tests)
+        self.__logger.info(f"Minimized fuzz[{entry.request_id}]: "
+                           f"{len(entry.headers)} headers / "
+                           f"{self.__size(entry.headers, entry.data)}"
+                           f" bytes -> {len(headers)} headers / "
+                           f"{self.__size(headers, data)} bytes "
+                           f"in {self.__num_tests} tests")
+
+    async def __ddmin_bytes(self, field: bytes, test) -> bytes:
+        chars = await ddmin([field[i:i + 1] for i in range(len(field))],
+                            lambda c: test(b"".join(c)))
+        return b"".join(chars)
+
+    async def __test(self, headers, data) -> bool:
+        if self.__num_tests >= self.__max_tests:
+            return False
+        tokens = self.__surviving_tokens(headers, data)
+        if tokens == []:
+            return False
+        self.__num_tests += 1
+        entry = CorpusEntry(self.__original.request_id,
+                            self.__original.sequence,
+                            headers,
+                            data,
+                            MaliciousLoad(tokens, []))
+        candidate = Request.from_corpus(self.__logger,
+                                        entry,
+                                        self.__authority,
+                                        self.__path)
+        while True:
+            # Never wait for a reconnect while holding the lock, the fuzzer
+            # has to return to the test manager for it
+            while self.__connection_state() != QuicConnectionState.CONNECTED:
+                await asyncio.sleep(0.1)
+            async with self.oracle_lock:
+                if self.__connection_state() != QuicConnectionState.CONNECTED:
+                    continue
+                try:
+                    resp = await asyncio.wait_for(
+                        self.__http_request(candidate.headers, candidate.data),
+                        timeout=self.__timeout)
+                except TimeoutError:
+                    resp = None
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(None,
+                                                    candidate.evaluate_response,
+                                                    resp)
+                return result == TestResult.ACCEPTED
+
+    def __surviving_tokens(self, headers, data) -> list[bytes]:
+        fields = [field for header in headers for field in header]
+        if isinstance(data, bytes):
+            fields.append(data)
+        return [token for token in self.__tokens
+                if token != b"" and any(token in field for field in fields)]
+
+    def __replace(self, headers, index, name, value):
+        return headers[:index] + [(name, value)] + headers[index + 1:]
+
+    def __size(self, headers, data) -> int:
+        size = sum(len(name) + len(value) for name, value in headers)
+        if isinstance(data, BodyStream):
+            size += data.size or 0
+        elif data is not None:
+            size += len(data)
+        return size
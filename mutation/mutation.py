@@ -43,8 +43,10 @@ class InsertChar(Mutation):
             raise TypeError
         for i in range(self._quantity):
             if forced_choice is None:
-                choice = self._choice(char_table.chars,
-                                      char_table.probabilities)
+                # Verdicts may update the table while a producer thread builds
+                with self._grammar.lock:
+                    choice = self._choice(char_table.chars,
+                                          char_table.probabilities)
                 if choice is None:
                     return input, MaliciousLoad(None, None)
             else:
@@ -0,0 +1,3 @@
+from .profiler import StageProfiler
+
+__all__ = ["StageProfiler"]
@@ -0,0 +1,107 @@
+import cProfile
+import time
+from contextlib import nullcontext
+from logging import Logger
+from utilities import TestPhase
+
+
+STAGES = ["generation", "build", "encode", "send", "wait", "oracle", "logging"]
+
+
+class _Stage:
+    __slots__ = ("__timings", "__start")
+
+    def __init__(self, timings: list):
+        self.__timings = timings
+
+    def __enter__(self):
+        self.__start = time.perf_counter_ns()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter_ns() - self.__start
+        self.__timings[0] += 1
+        self.__timings[1] += elapsed
+        if elapsed > self.__timings[2]:
+            self.__timings[2] = elapsed
+        return False
+
+
+class StageProfiler:
+    """
+    Accumulates the time spent in each pipeline stage per test phase.
+
+    mode None disables profiling, stage() then returns a shared no-op
+    context manager. "stages" only times the stages, "cprofile" additionally
+    runs cProfile per test phase and dumps its stats next to the report.
+    """
+    def __init__(self, logger: Logger, mode: str | None, output_prefix: str):
+        self.__logger = logger
+        self.__mode = mode
+        self.__output_prefix = output_prefix
+        self.__noop = nullcontext()
+        self.__phase = TestPhase.NORMAL_REQUEST
+        self.__phase_start = time.perf_counter_ns()
+        self.__phase_durations = {phase: 0 for phase in TestPhase}
+        self.__timings = {phase: {stage: [0, 0, 0] for stage in STAGES}
+                          for phase in TestPhase}
+        self.__cprofile = None
+        if self.__mode == "cprofile":
+            self.__start_cprofile()
+
+    @property
+    def enabled(self) -> bool:
+        return self.__mode is not None
+
+    def stage(self, name: str):
+        if self.__mode is None:
+            return self.__noop
+        return _Stage(self.__timings[self.__phase][name])
+
+    def set_phase(self, phase: TestPhase):
+        if self.__mode is None:
+            return
+        now = time.perf_counter_ns()
+        self.__phase_durations[self.__phase] += now - self.__phase_start
+        self.__phase_start = now
+        if self.__cprofile is not None:
+            self.__stop_cprofile()
+        self.__phase = phase
+        if self.__mode == "cprofile" and phase != TestPhase.FINISHED:
+            self.__start_cprofile()
+
+    def write_report(self):
+        if self.__mode is None:
+            return
+        self.set_phase(TestPhase.FINISHED)
+        filename = f"{self.__output_prefix}_profile.txt"
+        lines = [f"{'phase':<20} {'stage':<11} {'count':>9} {'total[s]':>10} "
+                 f"{'mean[ms]':>10} {'max[ms]':>10} {'share':>7}"]
+        for phase, stages in self.__timings.items():
+            duration = self.__phase_durations[phase]
+            if duration == 0:
+                continue
+            for stage, (count, total, maximum) in stages.items():
+                if count == 0:
+                    continue
+                lines.append(f"{phase.name:<20} {stage:<11} {count:>9} "
+                             f"{total / 1e9:>10.3f} "
+                             f"{total / count / 1e6:>10.3f} "
+                             f"{maximum / 1e6:>10.3f} "
+                             f"{100 * total / duration:>6.1f}%")
+            lines.append(f"{phase.name:<20} {'(wall)':<11} {'':>9} "
+                         f"{duration / 1e9:>10.3f}")
+        with open(filename, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        for line in lines:
+            self.__logger.info(line)
+        self.__logger.info(f"Profile written to {filename}")
+
+    def __start_cprofile(self):
+        self.__cprofile = cProfile.Profile()
+        self.__cprofile.enable()
+
+    def __stop_cprofile(self):
+        self.__cprofile.disable()
+        filename = f"{self.__output_prefix}_profile_{self.__phase.name}.prof"
+        self.__cprofile.dump_stats(filename)
+        self.__cprofile = None
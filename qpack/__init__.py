@@ -0,0 +1,13 @@
+from .qpack import (QPACK_TABLE_POLICIES,
+                    CAPPED_TABLE_CAPACITY,
+                    STATIC_TABLE,
+                    StaticQpackEncoder,
+                    CappedQpackEncoder,
+                    encode_field)
+
+__all__ = ["QPACK_TABLE_POLICIES",
+           "CAPPED_TABLE_CAPACITY",
+           "STATIC_TABLE",
+           "StaticQpackEncoder",
+           "CappedQpackEncoder",
+           "encode_field"]
@@ -0,0 +1,246 @@
+from collections import OrderedDict
+from qh3.h3.connection import QpackEncoder
+
+
+# Dynamic table policies of the client, see H3ClientManager
+QPACK_TABLE_POLICIES = ["none", "capped", "full"]
+CAPPED_TABLE_CAPACITY = 1024
+
+# RFC 9204 Appendix A
+STATIC_TABLE = [
+    (b":authority", b""),
+    (b":path", b"/"),
+    (b"age", b"0"),
+    (b"content-disposition", b""),
+    (b"content-length", b"0"),
+    (b"cookie", b""),
+    (b"date", b""),
+    (b"etag", b""),
+    (b"if-modified-since", b""),
+    (b"if-none-match", b""),
+    (b"last-modified", b""),
+    (b"link", b""),
+    (b"location", b""),
+    (b"referer", b""),
+    (b"set-cookie", b""),
+    (b":method", b"CONNECT"),
+    (b":method", b"DELETE"),
+    (b":method", b"GET"),
+    (b":method", b"HEAD"),
+    (b":method", b"OPTIONS"),
+    (b":method", b"POST"),
+    (b":method", b"PUT"),
+    (b":scheme", b"http"),
+    (b":scheme", b"https"),
+    (b":status", b"103"),
+    (b":status", b"200"),
+    (b":status", b"304"),
+    (b":status", b"404"),
+    (b":status", b"503"),
+    (b"accept", b"*/*"),
+    (b"accept", b"application/dns-message"),
+    (b"accept-encoding", b"gzip, deflate, br"),
+    (b"accept-ranges", b"bytes"),
+    (b"access-control-allow-headers", b"cache-control"),
+    (b"access-control-allow-headers", b"content-type"),
+    (b"access-control-allow-origin", b"*"),
+    (b"cache-control", b"max-age=0"),
+    (b"cache-control", b"max-age=2592000"),
+    (b"cache-control", b"max-age=604800"),
+    (b"cache-control", b"no-cache"),
+    (b"cache-control", b"no-store"),
+    (b"cache-control", b"public, max-age=31536000"),
+    (b"content-encoding", b"br"),
+    (b"content-encoding", b"gzip"),
+    (b"content-type", b"application/dns-message"),
+    (b"content-type", b"application/javascript"),
+    (b"content-type", b"application/json"),
+    (b"content-type", b"application/x-www-form-urlencoded"),
+    (b"content-type", b"image/gif"),
+    (b"content-type", b"image/jpeg"),
+    (b"content-type", b"image/png"),
+    (b"content-type", b"text/css"),
+    (b"content-type", b"text/html; charset=utf-8"),
+    (b"content-type", b"text/plain"),
+    (b"content-type", b"text/plain;charset=utf-8"),
+    (b"range", b"bytes=0-"),
+    (b"strict-transport-security", b"max-age=31536000"),
+    (b"strict-transport-security", b"max-age=31536000; includesubdomains"),
+    (b"strict-transport-security",
+     b"max-age=31536000; includesubdomains; preload"),
+    (b"vary", b"accept-encoding"),
+    (b"vary", b"origin"),
+    (b"x-content-type-options", b"nosniff"),
+    (b"x-xss-protection", b"1; mode=block"),
+    (b":status", b"100"),
+    (b":status", b"204"),
+    (b":status", b"206"),
+    (b":status", b"302"),
+    (b":status", b"400"),
+    (b":status", b"403"),
+    (b":status", b"421"),
+    (b":status", b"425"),
+    (b":status", b"500"),
+    (b"accept-language", b""),
+    (b"access-control-allow-credentials", b"FALSE"),
+    (b"access-control-allow-credentials", b"TRUE"),
+    (b"access-control-allow-headers", b"*"),
+    (b"access-control-allow-methods", b"get"),
+    (b"access-control-allow-methods", b"get, post, options"),
+    (b"access-control-allow-methods", b"options"),
+    (b"access-control-expose-headers", b"content-length"),
+    (b"access-control-request-headers", b"content-type"),
+    (b"access-control-request-method", b"get"),
+    (b"access-control-request-method", b"post"),
+    (b"alt-svc", b"clear"),
+    (b"authorization", b""),
+    (b"content-security-policy",
+     b"script-src 'none'; object-src 'none'; base-uri 'none'"),
+    (b"early-data", b"1"),
+    (b"expect-ct", b""),
+    (b"forwarded", b""),
+    (b"if-range", b""),
+    (b"origin", b""),
+    (b"purpose", b"prefetch"),
+    (b"server", b""),
+    (b"timing-allow-origin", b"*"),
+    (b"upgrade-insecure-requests", b"1"),
+    (b"user-agent", b""),
+    (b"x-forwarded-for", b""),
+    (b"x-frame-options", b"deny"),
+    (b"x-frame-options", b"sameorigin"),
+]
+
+STATIC_FIELDS = {field: index for index, field
+                 in reversed(list(enumerate(STATIC_TABLE)))}
+STATIC_NAMES = {name: index for index, (name, _)
+                in reversed(list(enumerate(STATIC_TABLE)))}
+
+# Required Insert Count 0 and Delta Base 0: no dynamic table references
+SECTION_PREFIX = b"\x00\x00"
+
+# Field lines up to this size are cached, e.g. pseudo-headers and the
+# headers of the length tests. The least recently used line is evicted once
+# the cache is full, so one-off fuzz fields don't crowd out repeated ones.
+CACHE_CAPACITY = 1 << 14
+MAX_CACHED_FIELD = 256
+
+
+def encode_integer(first: int, prefix_bits: int, value: int) -> bytes:
+    """
+    Encodes an integer with an N-bit prefix (RFC 7541 Section 5.1), first
+    holds the bits of the first byte above the prefix.
+    """
+    limit = (1 << prefix_bits) - 1
+    if value < limit:
+        return bytes([first | value])
+    encoded = bytearray([first | limit])
+    value -= limit
+    while value >= 0x80:
+        encoded.append(0x80 | (value & 0x7f))
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def encode_name(name: bytes) -> bytes:
+    """
+    Encodes the name part of a literal field line, a static table reference
+    if the table holds the name.
+    """
+    index = STATIC_NAMES.get(name)
+    if index is not None:
+        # Literal field line with name reference, N=0, T=1
+        return encode_integer(0x50, 4, index)
+    # Literal field line with literal name, N=0, H=0
+    return encode_integer(0x20, 3, len(name)) + name
+
+
+def encode_field(name: bytes, value: bytes) -> bytes:
+    """
+    Encodes a field line with static table references only.
+
+    Names and values are sent as plain literals, never Huffman-coded, so
+    the bytes on the wire are exactly the generated ones. Names are matched
+    case-sensitively: a malformed name never turns into a table entry.
+    """
+    index = STATIC_FIELDS.get((name, value))
+    if index is not None:
+        # Indexed field line, T=1
+        return encode_integer(0xc0, 6, index)
+    return encode_name(name) + encode_integer(0x00, 7, len(value)) + value
+
+
+# Unique per request, only their encoded names are cached
+UNCACHED_NAMES = {b"smuggling-id": encode_name(b"smuggling-id")}
+
+
+class StaticQpackEncoder:
+    """
+    QPACK encoder that never uses the dynamic table.
+
+    Field sections only reference the static table and need no encoder
+    stream, so they can't block a stream or fail on encoder stream state.
+    The encoded field lines of repeated headers are cached (LRU) and
+    spliced into every section that contains them.
+    """
+    def __init__(self):
+        self.__cache = OrderedDict()
+        self.__hits = 0
+        self.__misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.__hits + self.__misses
+        return 0.0 if lookups == 0 else self.__hits / lookups
+
+    def encode(self, headers) -> bytes:
+        """Returns the field section (HEADERS frame payload) of headers."""
+        lines = [SECTION_PREFIX]
+        for header in headers:
+            name = UNCACHED_NAMES.get(header[0])
+            if name is not None:
+                lines.append(name + encode_integer(0x00, 7, len(header[1]))
+                             + header[1])
+                continue
+            line = self.__cache.get(header)
+            if line is None:
+                self.__misses += 1
+                line = encode_field(*header)
+                if len(line) <= MAX_CACHED_FIELD:
+                    self.__cache[header] = line
+                    if len(self.__cache) > CACHE_CAPACITY:
+                        self.__cache.popitem(last=False)
+            else:
+                self.__hits += 1
+                self.__cache.move_to_end(header)
+            lines.append(line)
+        return b"".join(lines)
+
+
+class CappedQpackEncoder:
+    """
+    qh3's QPACK encoder with a smaller dynamic table than the peer allows.
+
+    The table capacity is capped and no stream may block: only entries the
+    peer acknowledged are referenced, so a slow or broken decoder stream
+    costs compression instead of blocked streams.
+    """
+    def __init__(self, capacity: int):
+        self.__encoder = QpackEncoder()
+        self.__capacity = capacity
+
+    def apply_settings(self,
+                       max_table_capacity: int,
+                       dyn_table_capacity: int,
+                       blocked_streams: int) -> bytes:
+        return self.__encoder.apply_settings(
+            max_table_capacity=max_table_capacity,
+            dyn_table_capacity=min(dyn_table_capacity, self.__capacity),
+            blocked_streams=0)
+
+    def encode(self, stream_id: int, headers) -> tuple[bytes, bytes]:
+        return self.__encoder.encode(stream_id, headers)
+
+    def feed_decoder(self, data: bytes):
+        self.__encoder.feed_decoder(data)
@@ -1,13 +1,43 @@
+import itertools
 import os
 import time
 import logging
 
 from grammar import Grammar
-from utilities import TestResult, MaliciousLoad, Header, Data, Terminal
+from utilities import (TestResult,
+                       MaliciousLoad,
+                       Header,
+                       Data,
+                       BodyStream,
+                       Terminal,
+                       CorpusEntry,
+                       intern_value)
 from mutation import FillUntilMax, AddMax
 
 class Request:
-    request_id = 0
+    # Millions of requests may be buffered or in flight, see README (Memory)
+    __slots__ = ("request_id",
+                 "headers",
+                 "data",
+                 "sequence",
+                 "features",
+                 "status_code",
+                 "response",
+                 "__backend_headers",
+                 "__backend_data",
+                 "__logger",
+                 "__max_name_chars",
+                 "__max_value_chars",
+                 "__grammar",
+                 "__path",
+                 "__random",
+                 "__scheduler",
+                 "__malicious")
+    # next() is atomic, requests are also built on the fuzzer's producer thread
+    __ids = itertools.count()
+    # Directory the backend writes one capture per smuggling-id to,
+    # None reads the single ./servers/request file
+    capture_dir = None
     def __init__(self,
                  logger: logging.Logger,
                  sequence: list[str],
@@ -18,11 +48,17 @@ class Request:
                  max_value_chars: int,
                  static: bool,
                  random_generator,
-                 malicious = None):
-        self.request_id = Request.request_id
-        Request.request_id += 1
+                 malicious = None,
+                 scheduler = None):
+        self.request_id = next(Request.__ids)
         self.headers = []
         self.data = None
+        self.sequence = []
+        # Derivation path as (kind, key, index) choices, see CoverageScheduler
+        self.features = []
+        self.status_code = None
+        # Kept for the results, see ResultStore.add
+        self.response = None
         self.__backend_headers = None
         self.__backend_data = None
         self.__logger = logger
@@ -31,6 +67,7 @@ class Request:
         self.__grammar = grammar
         self.__path = path
         self.__random = random_generator
+        self.__scheduler = scheduler
         if malicious is None:
             self.__malicious = MaliciousLoad([], [])
         else:
@@ -44,65 +81,144 @@ class Request:
             self.__malicious = MaliciousLoad(all, chars)
         self.__build(sequence, authority, path, static)
 
+    @classmethod
+    def from_corpus(cls,
+                    logger: logging.Logger,
+                    entry: CorpusEntry,
+                    authority: bytes,
+                    path: bytes,
+                    grammar: Grammar | None = None):
+        """
+        Rebuilds a stored request with a fresh smuggling-id.
+
+        Without a grammar the char tables are not updated, the chars of the
+        manifest are also part of its malicious tokens.
+        """
+        request = cls(logger, [], grammar, authority, path, 0, 0, True, None)
+        smuggling_id = request.headers[-1]
+        request.headers = [cls.__substitute(header, authority, path)
+                           for header in entry.headers]
+        request.headers.append(smuggling_id)
+        request.data = entry.data
+        request.sequence = entry.sequence
+        request.__malicious = MaliciousLoad(
+            [load.replace(b"<authority>", authority).replace(b"<path>", path)
+             for load in entry.malicious.all],
+            [] if grammar is None else list(entry.malicious.chars))
+        return request
+
+    @staticmethod
+    def __substitute(header, authority, path):
+        name, value = header
+        name = name.replace(b"<authority>", authority)
+        name = name.replace(b"<path>", path)
+        value = value.replace(b"<authority>", authority)
+        value = value.replace(b"<path>", path)
+        return name, value
+
     def get_malicious(self):
         return self.__malicious
+
+    def to_corpus_entry(self) -> CorpusEntry:
+        """
+        Returns the verdict-only state of the request, enough to replay it
+        and judge it again. Unlike the request it holds no grammar, logger
+        or backend request, so it is cheap to keep around.
+        """
+        return CorpusEntry(self.request_id,
+                           self.sequence,
+                           self.headers[:-1],
+                           self.data,
+                           MaliciousLoad(self.__malicious.all,
+                                         self.__malicious.chars))
+
+    def get_backend_request(self):
+        return self.__backend_headers, self.__backend_data
     
     def __log_requests(self, result: TestResult, status_code):
         if result == TestResult.ACCEPTED or result == TestResult.MODIFIED:
-            data_info = f"\nMALICIOUS: {self.__malicious}\nHEADERS: {self.headers}"
+            # Arguments are formatted lazily by the logging thread
+            msg = "[%d] %s \nMALICIOUS: %s\nHEADERS: %s"
+            args = [self.request_id, result.name, self.__malicious, self.headers]
             if self.data is not None:
-                data_info += f"\nDATA: {self.data}"
+                msg += "\nDATA: %s"
+                args.append(self.data)
             if self.__backend_headers is not None:
-                data_info += f"\nHEADERS RECIEVED: {self.__backend_headers}"
+                msg += "\nHEADERS RECIEVED: %s"
+                args.append(self.__backend_headers)
             if self.__backend_data is not None:
-                data_info += f"\nBODY RECIEVED: {self.__backend_data}"
-            self.__logger.log(logging.REQUEST, f"[{self.request_id}] {result.name} {data_info}")
+                msg += "\nBODY RECIEVED: %s"
+                args.append(self.__backend_data)
+            self.__logger.log(logging.REQUEST, msg, *args)
         return
 
     def __build(self, sequence, authority, path, static):
+        if self.__grammar is None:
+            # Corpus replays without a grammar start from an empty sequence
+            bound_headers = {}
+        else:
+            bound_headers = self.__grammar.bind(authority, path)
         for object in sequence:
             if isinstance(object, str):
                 object = self.__grammar.get_nonterminal(object)
             if isinstance(object, Data):
                 self.data = object.load
+                self.sequence.append("data")
+                if isinstance(object.load, BodyStream) \
+                        and object.load.content_length is not None:
+                    self.__declare_length(object.load)
                 continue
             if not isinstance(object, Header):
                 raise TypeError
+            self.sequence.append(object.name)
+            if object.name in bound_headers:
+                object = bound_headers[object.name]
+            else:
+                # The static tests build headers outside the grammar
+                object = self.__grammar.bind_header(object, authority, path)
             name = self.__build_terminal(object.name_terminal,
                                          self.__max_name_chars,
-                                         authority,
-                                         path,
                                          static)
             value = self.__build_terminal(object.value_terminal,
                                           self.__max_value_chars,
-                                          authority,
-                                          path,
                                           static)
             self.headers.append((name, value))
         self.headers.append((b"smuggling-id", str(self.request_id).encode()))
     
+    def __declare_length(self, stream: BodyStream):
+        value = str(stream.content_length).encode()
+        self.headers.append((b"content-length", value))
+        if stream.content_length_offset != 0:
+            # The mismatching length is the malicious token
+            self.__malicious.all.append(value)
+
     def __build_terminal(self,
                          terminal: Terminal,
                          max_chars: int,
-                         authority,
-                         path,
                          static):
-        choice = None
-        if static:
-            choice = terminal.terminals[0]
-        else:
-            choice = self.__choice(terminal.terminals,
-                                   terminal.terminals_probabilities)
-        choice = choice.replace(b"<authority>", authority)
-        choice = choice.replace(b"<path>", path)
-        if terminal.is_illegal:
-            if choice not in [b":method", b":authority", b":path", b":scheme"]:
-                self.__malicious.all.append(choice)
+        # terminal is bound to the target, see Grammar.bind
+        index = 0
+        if not static:
+            index = self.__choice_index(terminal.terminals_probabilities)
+        choice = terminal.terminals[index]
+        if terminal.malicious[index]:
+            self.__malicious.all.append(choice)
         if not static:
             # Apply mutations
             if terminal.mutations is not None and terminal.mutations != []:
-                mutations = self.__choice(terminal.mutations,
-                                          terminal.mutations_probabilities)
+                if self.__scheduler is None:
+                    index = self.__choice_index(
+                        terminal.mutations_probabilities)
+                else:
+                    index = self.__scheduler.choose(
+                        self.__random,
+                        "M",
+                        terminal.key,
+                        terminal.mutations_probabilities)
+                self.features.append(intern_value(("M",
+                                                   terminal.key,
+                                                   int(index))))
+                mutations = terminal.mutations[index]
                 if mutations is not None:
                     for mutation_str in mutations:
                         mutation = self.__grammar.get_mutation(mutation_str)
@@ -138,19 +254,34 @@ class Request:
             if response is None:
                 result = TestResult.TIMEOUT
             else:
-                status_code = response[0].headers[0][1]
+                status_code = response.status
                 if status_code == b'200':
                     raise Exception("Backend did not write request but" \
                                     "proxy responded with 200 OK")
                 result = TestResult.REJECTED
         # Report TIMEOUT and REJECTED to char table
-        for char_tuple in self.__malicious.chars:
-            char_table = self.__grammar.get_char_table(char_tuple[0])
-            char_table.report_result(char_tuple[1], result)
+        self.__report_chars(self.__malicious.chars, result)
         return result, status_code
 
+    def __report_chars(self, chars, result: TestResult):
+        if chars == []:
+            return
+        with self.__grammar.lock:
+            for char in chars:
+                char_table = self.__grammar.get_char_table(char[0])
+                char_table.report_result(char[1], result)
+
+    def report_chars(self, result: TestResult):
+        """
+        Reports a verdict for the chars of this request, used when a clone
+        was judged in its place (see MultiTargetManager).
+        """
+        self.__report_chars(self.__malicious.chars, result)
+
     def evaluate_response(self, response):
         result, status_code = self.__evaluate_response(response)
+        self.status_code = status_code
+        self.response = response
         self.__log_requests(result, status_code)
         return result
     
@@ -170,7 +301,7 @@ class Request:
                 continue
             malicious_str = malicious.decode()
             lowered = malicious_str.lower()
-            canoncial = self.__make_canonical(lowered).encode()
+            canoncial = intern_value(self.__make_canonical(lowered).encode())
             if canoncial not in self.__malicious.all:
                 to_be_added.append(canoncial)
         self.__malicious.all.extend(to_be_added)
@@ -189,6 +320,8 @@ class Request:
         return output
     
     def __read_request_from_file(self):
+        if Request.capture_dir is not None:
+            return self.__read_request_from_capture_dir()
         tries = 0
         while True:
             tries += 1
@@ -215,6 +348,22 @@ class Request:
         headers, body = self.__read_data(request)
         return headers, body
     
+    def __read_request_from_capture_dir(self):
+        # The backend writes the capture before it responds, no need to wait
+        filename = os.path.join(Request.capture_dir, str(self.request_id))
+        try:
+            with open(filename, "rb") as f:
+                request = f.read()
+        except FileNotFoundError:
+            return None
+        os.remove(filename)
+        if not request.startswith(b"####REQ_ID_"):
+            raise SyntaxError("request-file does not start with ####REQ_ID_")
+        request = request.removeprefix(b"####REQ_ID_")
+        id = self.__read_until_signal(request, b"####")
+        request = request.removeprefix(id + b"####")
+        return self.__read_data(request)
+
     def __read_until_signal(self, request: bytes, signal: bytes):
         index = 0
         found = False
@@ -254,10 +403,9 @@ class Request:
         return headers, body
 
     
-    def __choice(self, options, probabilities):
-        index = self.__random.choice(list(range(len(options))),
-                                     p=probabilities)
-        return options[index]
+    def __choice_index(self, probabilities):
+        return self.__random.choice(list(range(len(probabilities))),
+                                    p=probabilities)
 
     def __malicious_reached_backend(self, headers: dict):
         found = False
@@ -279,13 +427,9 @@ class Request:
             for name, value in headers.items():
                 if malicious in name or malicious in value:
                     found = True
-        for char in accepted_chars:
-            char_table = self.__grammar.get_char_table(char[0])
-            char_table.report_result(char[1], TestResult.ACCEPTED)
-            self.__malicious.chars.remove(char)
-        for char in modified_chars:
-            char_table = self.__grammar.get_char_table(char[0])
-            char_table.report_result(char[1], TestResult.MODIFIED)
+        self.__report_chars(accepted_chars, TestResult.ACCEPTED)
+        self.__report_chars(modified_chars, TestResult.MODIFIED)
+        for char in accepted_chars + modified_chars:
             self.__malicious.chars.remove(char)
         return found
         
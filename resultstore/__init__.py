@@ -0,0 +1,3 @@
+from .resultstore import ResultStore, pack_fields, unpack_fields
+
+__all__ = ["ResultStore", "pack_fields", "unpack_fields"]
@@ -0,0 +1,273 @@
+import sqlite3
+import struct
+import time
+from logging import Logger
+from utilities import TestResult, BodyStream
+
+
+LENGTH_PREFIX = struct.Struct(">I")
+
+
+def pack_fields(fields) -> bytes:
+    """
+    Packs a list of byte-strings into one blob.
+
+    Every field is prefixed with its length as unsigned 32-bit big-endian
+    integer, so header lists can be stored without any escaping.
+    """
+    return b"".join(LENGTH_PREFIX.pack(len(field)) + field for field in fields)
+
+
+def unpack_fields(blob: bytes) -> list[bytes]:
+    fields = []
+    index = 0
+    while index < len(blob):
+        length, = LENGTH_PREFIX.unpack_from(blob, index)
+        index += LENGTH_PREFIX.size
+        fields.append(blob[index:index + length])
+        index += length
+    return fields
+
+
+def pack_headers(headers) -> bytes | None:
+    if headers is None:
+        return None
+    if isinstance(headers, dict):
+        headers = headers.items()
+    return pack_fields([field for header in headers for field in header])
+
+
+def pack_body(data) -> bytes | None:
+    # Body streams are stored as their description, not as the body
+    if isinstance(data, BodyStream):
+        return data.describe()
+    return data
+
+
+class ResultStore:
+    """
+    Appends the results of one run to a SQLite file.
+
+    Request ids start at 0 in every process, so every run gets a row in the
+    runs table and all other rows are keyed by (run_id, request id). Rows
+    are only ever inserted, a duplicate key is an error instead of silently
+    replacing the results of an earlier run.
+    """
+    def __init__(self, logger: Logger, path: str, batch_size: int = 512):
+        self.__logger = logger
+        self.__path = path
+        self.__batch_size = batch_size
+        self.__requests = []
+        self.__header_names = []
+        self.__fanout = []
+        self.__diffs = []
+        self.__num_targets = 0
+        self.__num_records = 0
+        self.__connection = sqlite3.connect(path)
+        # Results are append-only, a lost tail after a crash is acceptable
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=OFF")
+        self.__create_tables()
+        with self.__connection:
+            self.run_id = self.__connection.execute(
+                "INSERT INTO runs (started) VALUES (?)",
+                (time.time(),)).lastrowid
+
+    def add(self,
+            request,
+            result: TestResult,
+            latency: float | None):
+        backend_headers, backend_data = request.get_backend_request()
+        response = request.response
+        self.__requests.append((self.run_id,
+                                request.request_id,
+                                ",".join(request.sequence),
+                                result.name,
+                                request.status_code,
+                                latency,
+                                time.time(),
+                                pack_headers(request.headers),
+                                pack_body(request.data),
+                                pack_fields(request.get_malicious().all),
+                                pack_headers(backend_headers),
+                                backend_data,
+                                ";".join(f"{kind}:{key}={index}"
+                                         for kind, key, index
+                                         in request.features),
+                                None if response is None else response.length,
+                                None if response is None else response.digest,
+                                None if response is None else response.body))
+        for name, _ in request.headers:
+            self.__header_names.append((self.run_id, request.request_id, name))
+        if len(self.__requests) >= self.__batch_size:
+            self.flush()
+
+    def set_targets(self, urls: list[str]):
+        """
+        Creates the tables of a multi-target campaign: targets maps target
+        indices to URLs, fanout holds the clone id and verdict of every
+        target side by side per generated request, diffs one action code per
+        target and compared field.
+        """
+        self.__num_targets = len(urls)
+        columns = "".join(f", target_{index}_request INTEGER"
+                          f", target_{index}_verdict TEXT"
+                          for index in range(len(urls)))
+        action_columns = "".join(f", target_{index} TEXT"
+                                 for index in range(len(urls)))
+        with self.__connection:
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS targets ("
+                                      "run_id INTEGER, "
+                                      "id INTEGER, "
+                                      "url TEXT, "
+                                      "PRIMARY KEY (run_id, id))")
+            self.__connection.executemany(
+                "INSERT INTO targets VALUES (?, ?, ?)",
+                [(self.run_id, index, url)
+                 for index, url in enumerate(urls)])
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS fanout ("
+                                      "run_id INTEGER, "
+                                      f"request_id INTEGER{columns}, "
+                                      "PRIMARY KEY (run_id, request_id))")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS diffs ("
+                                      "run_id INTEGER, "
+                                      "request_id INTEGER, "
+                                      "field INTEGER, "
+                                      "name BLOB, "
+                                      f"divergent INTEGER{action_columns})")
+        # One column pair per target, the file must match the campaign
+        self.__check_columns("fanout", 2 + 2 * len(urls))
+        self.__check_columns("diffs", 5 + len(urls))
+
+    def add_fanout(self, request_id: int, clones):
+        """
+        clones holds one (clone request id, verdict) per target, None for
+        targets the request was not sent to.
+        """
+        row = [self.run_id, request_id]
+        for clone in clones:
+            if clone is None:
+                row.extend((None, None))
+            else:
+                row.extend((clone[0], clone[1].name))
+        self.__fanout.append(row)
+
+    def add_diffs(self, request_id: int, rows):
+        """
+        rows holds (field, name, divergent, actions) per compared field with
+        one action code per target, see differential.diff_request.
+        """
+        for field, name, divergent, actions in rows:
+            self.__diffs.append([self.run_id,
+                                 request_id,
+                                 field,
+                                 name,
+                                 int(divergent)]
+                                + actions)
+
+    def add_reproducer(self,
+                       request_id: int,
+                       headers,
+                       data: bytes | BodyStream | None,
+                       malicious: list[bytes],
+                       num_tests: int):
+        # Reproducers are rare, they are written right away
+        with self.__connection:
+            self.__connection.execute(
+                "INSERT INTO reproducers VALUES (?, ?, ?, ?, ?, ?)",
+                (self.run_id,
+                 request_id,
+                 pack_headers(headers),
+                 pack_body(data),
+                 pack_fields(malicious),
+                 num_tests))
+
+    def flush(self):
+        if len(self.__requests) == 0 and len(self.__fanout) == 0 \
+           and len(self.__diffs) == 0:
+            return
+        with self.__connection:
+            self.__connection.executemany(
+                "INSERT INTO requests VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self.__requests)
+            self.__connection.executemany(
+                "INSERT INTO header_names VALUES (?, ?, ?)",
+                self.__header_names)
+            if len(self.__diffs) > 0:
+                placeholders = ", ".join("?" * (5 + self.__num_targets))
+                self.__connection.executemany(
+                    f"INSERT INTO diffs VALUES ({placeholders})",
+                    self.__diffs)
+            if len(self.__fanout) > 0:
+                placeholders = ", ".join("?" * (2 + 2 * self.__num_targets))
+                self.__connection.executemany(
+                    f"INSERT INTO fanout VALUES ({placeholders})",
+                    self.__fanout)
+        self.__num_records += len(self.__requests)
+        self.__requests = []
+        self.__header_names = []
+        self.__fanout = []
+        self.__diffs = []
+
+    def close(self):
+        self.flush()
+        # Indices are built once at the end to keep inserts cheap
+        with self.__connection:
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS "
+                                      "requests_verdict ON requests(verdict)")
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS "
+                                      "header_names_name ON header_names(name)")
+            if self.__num_targets > 0:
+                self.__connection.execute("CREATE INDEX IF NOT EXISTS "
+                                          "diffs_divergent ON diffs(divergent)")
+        self.__connection.close()
+        self.__logger.info(f"Stored {self.__num_records} results of run "
+                           f"{self.run_id} in {self.__path}")
+
+    def __create_tables(self):
+        with self.__connection:
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS runs ("
+                                      "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                      "started REAL)")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS requests ("
+                                      "run_id INTEGER, "
+                                      "id INTEGER, "
+                                      "sequence TEXT, "
+                                      "verdict TEXT, "
+                                      "status_code BLOB, "
+                                      "latency REAL, "
+                                      "time REAL, "
+                                      "headers BLOB, "
+                                      "data BLOB, "
+                                      "malicious BLOB, "
+                                      "backend_headers BLOB, "
+                                      "backend_data BLOB, "
+                                      "derivation TEXT, "
+                                      "response_length INTEGER, "
+                                      "response_digest BLOB, "
+                                      "response_body BLOB, "
+                                      "PRIMARY KEY (run_id, id))")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS reproducers ("
+                                      "run_id INTEGER, "
+                                      "request_id INTEGER, "
+                                      "headers BLOB, "
+                                      "data BLOB, "
+                                      "malicious BLOB, "
+                                      "tests INTEGER, "
+                                      "PRIMARY KEY (run_id, request_id))")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS header_names ("
+                                      "run_id INTEGER, "
+                                      "request_id INTEGER, "
+                                      "name BLOB)")
+        # Files of older versions have no run ids or response columns
+        self.__check_columns("requests", 16)
+
+    def __check_columns(self, table: str, num_columns: int):
+        columns = self.__connection.execute(
+            f"PRAGMA table_info({table})").fetchall()
+        if len(columns) != num_columns or columns[0][1] != "run_id":
+            self.__logger.critical(f"{self.__path}: table {table} does not "
+                                   f"match this campaign, use another "
+                                   f"results file (-r)")
+            exit(-1)
@@ -0,0 +1,3 @@
+from .scheduler import CoverageScheduler
+
+__all__ = ["CoverageScheduler"]
@@ -0,0 +1,88 @@
+import math
+from utilities import TestResult
+
+
+# Verdicts that count as finding a violation
+SUCCESS = (TestResult.ACCEPTED, TestResult.MODIFIED)
+
+
+class CoverageScheduler:
+    """
+    Biases derivative and mutation choices by the verdicts their features
+    produced.
+
+    A feature is one choice of a derivation path: (kind, key, index) where
+    kind is "N" for a nonterminal derivative and "M" for a mutation choice
+    of a header name or value terminal. The weight of an option is its
+    grammar probability times a novelty bonus for rarely exercised options
+    and a reward for options that led to ACCEPTED or MODIFIED:
+
+        p * (1 + exploration / sqrt(1 + n)) * (1 + reward * (s + 1) / (n + 2))
+
+    n is the number of evaluated requests containing the feature, s the
+    number of those that were ACCEPTED or MODIFIED. Options with grammar
+    probability 0 are never chosen. Optional likelihoods condition the
+    choice (e.g. on leading to an illegal sequence) by multiplying into the
+    weights, they don't change which options count towards the coverage.
+    """
+    def __init__(self, exploration: float = 1.0, reward: float = 4.0):
+        self.__exploration = exploration
+        self.__reward = reward
+        # feature -> verdict counts indexed by TestResult.value - 1
+        self.__counts = {}
+        self.__num_options = {}
+
+    def choose(self,
+               random_generator,
+               kind: str,
+               key: str,
+               probabilities,
+               likelihoods=None):
+        num_options = len(probabilities)
+        # Options the grammar excludes do not count towards the coverage
+        self.__num_options[(kind, key)] = sum(1 for probability
+                                              in probabilities
+                                              if probability > 0)
+        weights = [0.0] * num_options
+        total = 0.0
+        for index, probability in enumerate(probabilities):
+            if probability <= 0:
+                continue
+            counts = self.__counts.get((kind, key, index))
+            if counts is None:
+                n, s = 0, 0
+            else:
+                n = sum(counts)
+                s = sum(counts[result.value - 1] for result in SUCCESS)
+            weight = probability \
+                * (1 + self.__exploration / math.sqrt(1 + n)) \
+                * (1 + self.__reward * (s + 1) / (n + 2))
+            if likelihoods is not None:
+                weight *= likelihoods[index]
+            weights[index] = weight
+            total += weight
+        weights = [weight / total for weight in weights]
+        return random_generator.choice(num_options, p=weights)
+
+    def report(self, features, result: TestResult):
+        # A feature occurring twice in a request is only counted once
+        for feature in set(features):
+            counts = self.__counts.get(feature)
+            if counts is None:
+                counts = [0] * len(TestResult)
+                self.__counts[feature] = counts
+            counts[result.value - 1] += 1
+
+    def summary(self) -> str:
+        exercised = {"N": 0, "M": 0}
+        total = {"N": 0, "M": 0}
+        successful = 0
+        for (kind, _), num_options in self.__num_options.items():
+            total[kind] += num_options
+        for (kind, _, _), counts in self.__counts.items():
+            exercised[kind] += 1
+            if any(counts[result.value - 1] > 0 for result in SUCCESS):
+                successful += 1
+        return f"Coverage: {exercised['N']}/{total['N']} derivatives, " \
+               f"{exercised['M']}/{total['M']} mutation choices exercised, " \
+               f"{successful} features led to ACCEPTED or MODIFIED"
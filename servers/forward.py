@@ -0,0 +1,55 @@
+# forward.py
+# Minimal forwarding proxy stand-in for loopback benchmarks. Run it behind
+# h3server.py (python3 h3server.py forward:app --no-capture) and it passes
+# every request to an HTTP/1.1 backend such as h1server.py. Header fields are
+# forwarded as received, only the message framing is re-done.
+import asyncio
+import os
+
+BACKEND_HOST = os.environ.get("H3FUZZ_BACKEND_HOST", "127.0.0.1")
+BACKEND_PORT = int(os.environ.get("H3FUZZ_BACKEND_PORT", "8080"))
+FRAMING_HEADERS = [b"content-length", b"transfer-encoding", b"connection"]
+
+
+async def app(scope, receive, send):
+    assert scope["type"] == "http"
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+    request = scope["method"].encode() + b" " + scope["raw_path"] + \
+        b" HTTP/1.1\r\n"
+    for name, value in scope["headers"]:
+        if name.lower() in FRAMING_HEADERS:
+            continue
+        request += name + b": " + value + b"\r\n"
+    request += b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+    request += b"Connection: close\r\n\r\n" + body
+
+    try:
+        reader, writer = await asyncio.open_connection(BACKEND_HOST,
+                                                       BACKEND_PORT)
+        writer.write(request)
+        writer.write_eof()
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        status_line, _, response_body = response.partition(b"\r\n")
+        status = int(status_line.split(b" ")[1])
+        response_body = response_body.partition(b"\r\n\r\n")[2]
+    except (OSError, IndexError, ValueError):
+        status = 502
+        response_body = b"Bad Gateway"
+
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"text/plain")],
+    })
+    await send({
+        "type": "http.response.body",
+        "body": response_body,
+    })
@@ -1,6 +1,7 @@
 import socket
 import time
 import os
+import sys
 
 def start_echo_server(host="127.0.0.1", port=8080):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
@@ -109,6 +110,8 @@ def parse_data(recv_data: bytes):
 
     return headers, body
 
+capture_dir = None
+
 def write_to_file(headers: dict, body: bytes) -> None:
     req_id = b'####REQ_ID_' + headers.get(b'smuggling-id') + b'####'
     h_name = b'####H_NAME####'
@@ -119,7 +122,13 @@ def write_to_file(headers: dict, body: bytes) -> None:
     for name, value in headers.items():
         content += h_name + name + h_value + value
     content += body_signal + body + req_end
-    f = open("request", "wb")
+    filename = "request"
+    if capture_dir is not None and headers.get(b'smuggling-id').isdigit():
+        # One file per request so concurrent requests do not overwrite
+        # each other
+        filename = os.path.join(capture_dir,
+                                headers.get(b'smuggling-id').decode())
+    f = open(filename, "wb")
     f.write(content)
     f.close()
 
@@ -129,4 +138,10 @@ if __name__ == "__main__":
         exit(-1)
     if os.path.exists("request"):
         os.remove("request")
-    start_echo_server()
\ No newline at end of file
+    if len(sys.argv) > 2:
+        capture_dir = sys.argv[2]
+        os.makedirs(capture_dir, exist_ok=True)
+    if len(sys.argv) > 1:
+        start_echo_server(port=int(sys.argv[1]))
+    else:
+        start_echo_server()
\ No newline at end of file
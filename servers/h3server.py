@@ -486,8 +486,10 @@ class HttpServerProtocol(QuicConnectionProtocol):
             method = ""
             protocol = None
             content = b""
+            request_id = None
             for header, value in event.headers:
                 if header == b"smuggling-id":
+                    request_id = value
                     content = b"####REQ_ID_" + value + b"####" + content
                 else:
                     content += b"####H_NAME####" + header + b"####H_VALUE####" + value
@@ -509,9 +511,14 @@ class HttpServerProtocol(QuicConnectionProtocol):
             if not content.startswith(b"####REQ_ID"):
                 content = b"####REQ_ID_None" + content + b"####"
 
-            f = open("request", "wb")
-            f.write(content)
-            f.close()
+            if capture_requests:
+                filename = "request"
+                if capture_dir is not None and request_id is not None \
+                   and request_id.isdigit():
+                    filename = os.path.join(capture_dir, request_id.decode())
+                f = open(filename, "wb")
+                f.write(content)
+                f.close()
 
             if b"?" in raw_path:
                 path_bytes, query_string = raw_path.split(b"?", maxsplit=1)
@@ -616,7 +623,7 @@ class HttpServerProtocol(QuicConnectionProtocol):
     def quic_event_received(self, event: QuicEvent) -> None:
         if isinstance(event, ProtocolNegotiated):
             if event.alpn_protocol in H3_ALPN:
-                self._http = H3ConnectionInsecure(self._quic, enable_webtransport=True)
+                self._http = H3ConnectionInsecure(self._quic, enable_webtransport=enable_webtransport)
             elif event.alpn_protocol in H0_ALPN:
                 self._http = H0Connection(self._quic)
         elif isinstance(event, DatagramFrameReceived):
@@ -734,10 +741,34 @@ if __name__ == "__main__":
         action="store_true",
         help="send a retry for new connections",
     )
+    parser.add_argument(
+        "--no-capture",
+        action="store_true",
+        help="do not write received requests to ./request (when used as " \
+             "front end in front of a capturing backend)",
+    )
+    parser.add_argument(
+        "--capture-dir",
+        type=str,
+        default=None,
+        help="write every received request to <dir>/<smuggling-id> " \
+             "instead of ./request, required for concurrent replays",
+    )
+    parser.add_argument(
+        "--no-webtransport",
+        action="store_true",
+        help="do not announce WebTransport (qh3 clients reject the " \
+             "SETTINGS aioquic sends for it)",
+    )
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="increase logging verbosity"
     )
     args = parser.parse_args()
+    capture_requests = not args.no_capture
+    enable_webtransport = not args.no_webtransport
+    capture_dir = args.capture_dir
+    if capture_dir is not None:
+        os.makedirs(capture_dir, exist_ok=True)
 
     logging.basicConfig(
         format="%(asctime)s %(levelname)s %(name)s %(message)s",
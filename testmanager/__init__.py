@@ -1,3 +1,4 @@
 from .testmanager import TestManager
+from .multitarget import MultiTargetManager
 
-__all__ = ["TestManager"]
+__all__ = ["TestManager", "MultiTargetManager"]
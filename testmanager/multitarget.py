@@ -0,0 +1,391 @@
+import asyncio
+import logging
+import time
+from logging import Logger
+from numpy import random
+from urllib.parse import urlparse
+from qh3.quic.connection import QuicConnectionState
+from grammar import Grammar
+from h3fuzzer import H3Fuzzer
+from h3clientmanager import H3ClientManager
+from request import Request
+from resultstore import ResultStore
+from metrics import Metrics
+from profiler import StageProfiler
+from scheduler import CoverageScheduler
+from differential import diff_request
+from utilities import TestPhase, TestState, CorpusEntry
+from .testmanager import TestManager
+
+
+class TargetLogger(logging.LoggerAdapter):
+    """Prefixes every record with the target URL, keeps extra intact."""
+    def process(self, msg, kwargs):
+        return f"[{self.extra['url']}] {msg}", kwargs
+
+
+class FanoutTarget:
+    """
+    Fuzzing phase of one target in a multi-target campaign.
+
+    Takes the place of H3Fuzzer in the target's TestManager: instead of
+    generating, it sends clones of the requests the coordinator fans out
+    and resolves one future per clone with (clone, verdict). The clones
+    report to the target's own grammar, so char tables learn per target.
+    """
+    def __init__(self,
+                 logger: Logger,
+                 url: str,
+                 timeout: float,
+                 result_store: ResultStore,
+                 metrics: Metrics,
+                 profiler: StageProfiler,
+                 window: int = 64):
+        self.state = TestState.INIT
+        self.url = url
+        self.ready = asyncio.Event()
+        self.failed = False
+        self.max_name_chars = None
+        self.max_value_chars = None
+        self.__logger = logger
+        self.__grammar = None
+        self.__authority = urlparse(url).netloc.encode()
+        self.__path = urlparse(url).path.encode()
+        self.__timeout = timeout
+        self.__results = result_store
+        self.__metrics = metrics
+        self.__profiler = profiler
+        self.__queue = asyncio.Queue(window)
+        self.__pending = None
+        self.__num_tests = 0
+
+    @property
+    def grammar(self) -> Grammar:
+        return self.__grammar
+
+    def set_grammar(self, grammar: Grammar):
+        self.__grammar = grammar
+
+    def set_max_name_chars(self, max: int):
+        self.max_name_chars = max
+
+    def set_max_value_chars(self, max: int):
+        self.max_value_chars = max
+
+    def set_ready(self):
+        self.ready.set()
+
+    def fail(self):
+        self.failed = True
+        self.ready.set()
+        self.__drain()
+
+    def compatible(self,
+                   entry: CorpusEntry,
+                   max_name_chars: int,
+                   max_value_chars: int) -> bool:
+        """
+        A request generated for larger header limits than the target's is
+        skipped if one of its fields exceeds the target's limits, it would
+        only be rejected for its length. Mutations like AddMax exceed the
+        limits on purpose, so targets whose limits match the generation
+        limits get every request.
+        """
+        check_names = self.max_name_chars < max_name_chars
+        check_values = self.max_value_chars < max_value_chars
+        for name, value in entry.headers:
+            if check_names and len(name) > self.max_name_chars:
+                return False
+            if check_values and len(value) > self.max_value_chars:
+                return False
+        return True
+
+    async def submit(self,
+                     entry: CorpusEntry,
+                     features: list,
+                     max_name_chars: int,
+                     max_value_chars: int):
+        if self.failed or not self.compatible(entry,
+                                              max_name_chars,
+                                              max_value_chars):
+            return None
+        future = asyncio.get_running_loop().create_future()
+        await self.__queue.put((entry, features, future))
+        if self.failed:
+            self.__drain()
+        return future
+
+    async def finish(self):
+        await self.__queue.put((None, None, None))
+
+    async def run_tests(self, http_request, connection_state):
+        self.state = TestState.RUNNING
+        while True:
+            if connection_state() != QuicConnectionState.CONNECTED:
+                self.state = TestState.WAITING_FOR_NEW_CLIENT
+                return
+            if self.__pending is None:
+                # The connection may have closed while waiting, check again
+                self.__pending = await self.__queue.get()
+                continue
+            entry, features, future = self.__pending
+            self.__pending = None
+            if entry is None:
+                self.state = TestState.FINISHED
+                return
+            with self.__profiler.stage("build"):
+                request = Request.from_corpus(self.__logger,
+                                              entry,
+                                              self.__authority,
+                                              self.__path,
+                                              self.__grammar)
+                request.features = features
+            start_time = time.perf_counter()
+            try:
+                resp = await asyncio.wait_for(http_request(request.headers,
+                                                           request.data),
+                                              timeout=self.__timeout)
+            except TimeoutError:
+                resp = None
+            except Exception as e:
+                self.__logger.critical(str(e))
+                resp = None
+            latency = time.perf_counter() - start_time
+            with self.__profiler.stage("oracle"):
+                result = request.evaluate_response(resp)
+            with self.__profiler.stage("logging"):
+                self.__num_tests += 1
+                self.__results.add(request, result, latency)
+                self.__metrics.report_result(result)
+                self.__logger.info("fuzz %d [%d]: %s",
+                                   self.__num_tests,
+                                   request.request_id,
+                                   result.name,
+                                   extra={"progress": True})
+            future.set_result((request, result))
+
+    def __drain(self):
+        items = [] if self.__pending is None else [self.__pending]
+        self.__pending = None
+        while not self.__queue.empty():
+            items.append(self.__queue.get_nowait())
+        for _, _, future in items:
+            if future is not None and not future.done():
+                future.set_result(None)
+
+
+class MultiTargetManager:
+    """
+    Runs one campaign against several targets.
+
+    Every target gets its own client manager and TestManager, so the normal
+    request, header length tests and static tests run per target and update
+    the target's own grammar. Once all targets finished their static tests
+    the coordinator generates every fuzz case once, with the <authority> and
+    <path> placeholders and the largest header limits of all targets, and
+    fans a clone out to every target whose header limits it fits. The
+    verdicts are stored side by side in the fanout table. In differential
+    mode the backend captures of the clones are compared to what was sent
+    and the action of every target per field is stored in the diffs table.
+
+    The coordinator's grammar applies the actions of every pre-test all
+    targets gave the same verdict; a pre-test the targets disagree on is
+    left untouched, dropping or lowering its derivatives would hide exactly
+    the requests they handle differently. Every clone verdict is reported
+    to the chars of the generated request, so the coordinator's char tables
+    learn from all targets.
+    """
+    def __init__(self,
+                 logger: Logger,
+                 urls: list[str],
+                 grammar_path: str | None,
+                 num_fuzzes: int,
+                 h3clientmanagers: list[H3ClientManager],
+                 seed: int | None,
+                 timeout: float,
+                 result_store: ResultStore,
+                 metrics: Metrics,
+                 profiler: StageProfiler,
+                 metrics_port: int | None = None,
+                 metrics_interval: float | None = None,
+                 max_resamples: int = 10,
+                 coverage_guided: bool = False,
+                 differential: bool = False):
+        self.__logger = logger
+        self.__differential = differential
+        self.__num_divergent = 0
+        self.__num_fuzzes = num_fuzzes
+        self.__h3clients = h3clientmanagers
+        self.__results = result_store
+        self.__metrics = metrics
+        self.__profiler = profiler
+        self.__metrics_port = metrics_port
+        self.__metrics_interval = metrics_interval
+        self.__start_time = time.perf_counter()
+        self.__targets = []
+        self.__managers = []
+        # All targets and the coordinator derive from the same seed
+        if seed is None:
+            seed = random.randint(0, 2**32)
+            self.__logger.info(f"Seed for reproducibility: {seed}")
+        for url, h3client in zip(urls, h3clientmanagers):
+            target_logger = TargetLogger(logger, {"url": url})
+            target = FanoutTarget(target_logger,
+                                  url,
+                                  timeout,
+                                  result_store,
+                                  metrics,
+                                  profiler)
+            manager = TestManager(logger=target_logger,
+                                  url=url,
+                                  grammar_path=grammar_path,
+                                  num_fuzzes=num_fuzzes,
+                                  h3clientmanager=h3client,
+                                  seed=seed,
+                                  timeout=timeout,
+                                  result_store=result_store,
+                                  metrics=metrics,
+                                  profiler=profiler,
+                                  fanout=target)
+            self.__targets.append(target)
+            self.__managers.append(manager)
+        self.__scheduler = CoverageScheduler() if coverage_guided else None
+        self.__grammar = Grammar(logger, grammar_path, seed)
+        self.__fuzzer = H3Fuzzer(logger,
+                                 self.__grammar,
+                                 b"<authority>",
+                                 b"<path>",
+                                 num_fuzzes,
+                                 seed,
+                                 timeout,
+                                 result_store,
+                                 metrics,
+                                 profiler,
+                                 max_resamples,
+                                 scheduler=self.__scheduler)
+        self.__metrics.set_grammar(self.__grammar)
+        self.__results.set_targets(urls)
+
+    async def run(self):
+        await self.__metrics.start(self.__metrics_port, self.__metrics_interval)
+        try:
+            campaigns = [asyncio.create_task(h3client.run_loop(
+                             manager.test_pipeline))
+                         for h3client, manager
+                         in zip(self.__h3clients, self.__managers)]
+            coordinator = asyncio.create_task(self.__fan_out())
+            await asyncio.gather(coordinator, *campaigns)
+        finally:
+            self.__results.close()
+            await self.__metrics.stop()
+            runtime = time.perf_counter() - self.__start_time
+            self.__logger.info(f"Runtime: {runtime} seconds")
+            self.__logger.info(self.__metrics.summary())
+            self.__logger.info(self.__metrics.qpack_summary())
+            self.__logger.info(self.__metrics.transmit_summary())
+            self.__profiler.write_report()
+
+    async def __fan_out(self):
+        for target in self.__targets:
+            await target.ready.wait()
+        active = [target for target in self.__targets if not target.failed]
+        if active == []:
+            self.__logger.critical("No target finished its static tests")
+            return
+        if not self.__apply_pre_tests(active):
+            for target in active:
+                await target.finish()
+            return
+        max_name_chars = max(target.max_name_chars for target in active)
+        max_value_chars = max(target.max_value_chars for target in active)
+        self.__fuzzer.set_max_name_chars(max_name_chars)
+        self.__fuzzer.set_max_value_chars(max_value_chars)
+        self.__logger.info(f"Fanning out {self.__num_fuzzes} fuzz cases "
+                           f"to {len(active)} targets")
+        self.__metrics.set_phase(TestPhase.FUZZING)
+        self.__profiler.set_phase(TestPhase.FUZZING)
+        recorders = set()
+        for _ in range(self.__num_fuzzes):
+            request = self.__fuzzer.generate()
+            entry = request.to_corpus_entry()
+            futures = [await target.submit(entry,
+                                           request.features,
+                                           max_name_chars,
+                                           max_value_chars)
+                       for target in self.__targets]
+            recorder = asyncio.create_task(self.__record(request, futures))
+            recorders.add(recorder)
+            recorder.add_done_callback(recorders.discard)
+        for target in self.__targets:
+            if not target.failed:
+                await target.finish()
+        if recorders:
+            await asyncio.gather(*recorders)
+        self.__metrics.set_phase(TestPhase.FINISHED)
+        if self.__differential:
+            self.__logger.info(f"{self.__num_divergent} of "
+                               f"{self.__num_fuzzes} fuzz cases were "
+                               f"forwarded differently by the targets")
+        if self.__scheduler is not None:
+            self.__logger.info(self.__scheduler.summary())
+
+    def __apply_pre_tests(self, active: list[FanoutTarget]) -> bool:
+        agreed = 0
+        for key, _ in self.__grammar.get_all_pre_tests():
+            results = set(target.grammar.get_pre_test(key).result
+                          for target in active)
+            if len(results) == 1:
+                self.__grammar.report_pre_test_result(key, results.pop())
+                agreed += 1
+        self.__grammar.apply_pre_test_actions()
+        self.__logger.info(f"Applied the pre-test actions of {agreed} of "
+                           f"{len(self.__grammar.get_all_pre_tests())} "
+                           f"pre-tests all targets agree on")
+        if not self.__grammar.can_derive_illegal():
+            self.__logger.critical("After the pre-test actions no derivation "
+                                   "of 'start' contains an illegal "
+                                   "nonterminal, nothing left to fuzz")
+            return False
+        return True
+
+    async def __record(self, request: Request, futures):
+        clones = []
+        for future in futures:
+            clone = None if future is None else await future
+            clones.append(clone)
+            if clone is None:
+                continue
+            request.report_chars(clone[1])
+            if self.__scheduler is not None:
+                self.__scheduler.report(request.features, clone[1])
+        self.__results.add_fanout(request.request_id,
+                                  [None if clone is None
+                                   else (clone[0].request_id, clone[1])
+                                   for clone in clones])
+        if self.__differential:
+            self.__record_diff(request, clones)
+
+    def __record_diff(self, request: Request, clones):
+        # field -> (name, action per target), None for targets not sent to
+        fields = {}
+        for index, clone in enumerate(clones):
+            if clone is None:
+                continue
+            backend_headers, backend_data = clone[0].get_backend_request()
+            for field, name, action in diff_request(clone[0].headers[:-1],
+                                                    clone[0].data,
+                                                    backend_headers,
+                                                    backend_data):
+                if field not in fields:
+                    fields[field] = (name, [None] * len(clones))
+                fields[field][1][index] = action
+        rows = []
+        divergent = False
+        for field, (name, actions) in sorted(fields.items()):
+            field_divergent = len(set(action for action in actions
+                                      if action is not None)) > 1
+            divergent = divergent or field_divergent
+            rows.append((field, name, field_divergent, actions))
+        if divergent:
+            self.__num_divergent += 1
+        self.__results.add_diffs(request.request_id, rows)
@@ -8,6 +8,11 @@ from h3fuzzer import H3Fuzzer
 from h3statictest import H3StaticTest
 from h3clientmanager import H3ClientManager
 from h3lentest import HeaderValueLengthTest, HeaderNameLengthTest
+from resultstore import ResultStore
+from metrics import Metrics
+from profiler import StageProfiler
+from scheduler import CoverageScheduler
+from minimizer import Minimizer
 from urllib.parse import urlparse
 from utilities import TestPhase, TestState
 
@@ -20,7 +25,17 @@ class TestManager:
                  num_fuzzes: int,
                  h3clientmanager: H3ClientManager,
                  seed: int | None,
-                 timeout: float):
+                 timeout: float,
+                 result_store: ResultStore,
+                 metrics: Metrics,
+                 profiler: StageProfiler,
+                 metrics_port: int | None = None,
+                 metrics_interval: float | None = None,
+                 max_resamples: int = 10,
+                 coverage_guided: bool = False,
+                 minimize: int = 0,
+                 prefetch: int = 0,
+                 fanout=None):
         req_authority = urlparse(url).netloc.encode()
         req_path = urlparse(url).path.encode()
         self.__logger = logger
@@ -28,26 +43,69 @@ class TestManager:
         self.__test_phase = TestPhase.NORMAL_REQUEST
         self.__num_fuzzes = num_fuzzes
         self.__h3client = h3clientmanager
+        self.__results = result_store
+        self.__metrics = metrics
+        self.__profiler = profiler
+        self.__metrics_port = metrics_port
+        self.__metrics_interval = metrics_interval
+        # Fuzzing phase of a multi-target campaign, see MultiTargetManager
+        self.__fanout = fanout
         self.__max_test_name = HeaderNameLengthTest(logger, url, timeout)
         self.__max_test_value = HeaderValueLengthTest(logger, url, timeout)
         self.__start_time = time.perf_counter()
         self.__grammar = Grammar(logger, grammar_path, self.__seed)
-        self.__fuzzer = H3Fuzzer(logger,
-                                 self.__grammar,
-                                 req_authority,
-                                 req_path,
-                                 num_fuzzes,
-                                 self.__seed,
-                                 timeout)
+        # The coordinator of a multi-target campaign generates, the target
+        # only sends the clones it fans out
+        self.__fuzzer = fanout
+        if fanout is None:
+            scheduler = CoverageScheduler() if coverage_guided else None
+            minimizer = None
+            if minimize > 0:
+                minimizer = Minimizer(logger,
+                                      result_store,
+                                      req_authority,
+                                      req_path,
+                                      timeout,
+                                      minimize)
+            self.__fuzzer = H3Fuzzer(logger,
+                                     self.__grammar,
+                                     req_authority,
+                                     req_path,
+                                     num_fuzzes,
+                                     self.__seed,
+                                     timeout,
+                                     result_store,
+                                     metrics,
+                                     profiler,
+                                     max_resamples,
+                                     scheduler=scheduler,
+                                     minimizer=minimizer,
+                                     prefetch=prefetch)
         self.__static = H3StaticTest(logger,
                                      url,
                                      self.__grammar,
                                      req_authority,
                                      req_path,
-                                     timeout)
+                                     timeout,
+                                     result_store,
+                                     metrics,
+                                     profiler)
+        if fanout is None:
+            self.__metrics.set_grammar(self.__grammar)
+        else:
+            # The coordinator's grammar generates, see MultiTargetManager
+            fanout.set_grammar(self.__grammar)
 
     async def run(self):
-        await self.__h3client.run_loop(self.test_pipeline)
+        await self.__metrics.start(self.__metrics_port, self.__metrics_interval)
+        try:
+            await self.__h3client.run_loop(self.test_pipeline)
+        finally:
+            await self.__metrics.stop()
+            self.__logger.info(self.__metrics.summary())
+            self.__logger.info(self.__metrics.qpack_summary())
+            self.__logger.info(self.__metrics.transmit_summary())
+            self.__profiler.write_report()
 
     async def test_pipeline(self, http_request, connection_state):
         while True:
@@ -150,24 +208,45 @@ class TestManager:
                 if self.__num_fuzzes is not None:
                     self.__logger.info("Proceeding with fuzzing")
                     self.__test_phase = TestPhase.FUZZING
+                    if self.__fanout is not None:
+                        self.__fanout.set_ready()
                 else:
                     self.__logger.info("User did not specify number of tests: skipping fuzzing")
                     runtime = time.perf_counter() - self.__start_time
                     self.__logger.info(f"Runtime: {runtime} seconds")
                     self.__logger.info("Test finished without errors")
+                    self.__close_results()
                     self.__test_phase = TestPhase.FINISHED
             case TestPhase.FUZZING:
                 runtime = time.perf_counter() - self.__start_time
                 self.__logger.info(f"Runtime: {runtime} seconds")
                 self.__logger.info("Test finished without errors")
+                self.__close_results()
                 self.__test_phase = TestPhase.FINISHED
             case TestPhase.FINISHED:
                 raise Exception("Called __next_phase with TestPhase.FINISHED")
             case _:
                 raise ValueError(f"unkown testphase {self.__test_phase}")
+        # Targets of a multi-target campaign run their phases concurrently,
+        # the campaign phase is set by MultiTargetManager
+        if self.__fanout is None:
+            self.__metrics.set_phase(self.__test_phase)
+            self.__profiler.set_phase(self.__test_phase)
+
+    def __close_results(self):
+        # The results of a multi-target campaign are shared by all targets
+        if self.__fanout is None:
+            self.__results.close()
 
     def __error_exit(self):
+        if self.__fanout is not None:
+            # Only this target is dropped from the campaign
+            self.__logger.critical("Target failed, excluded from the campaign")
+            self.__fanout.fail()
+            self.__test_phase = TestPhase.FINISHED
+            return
         self.__logger.critical("Program exited unexpectedly")
+        self.__results.close()
         exit(-1)
 
     async def __normal_request_success(self, http_request):
@@ -176,7 +255,7 @@ class TestManager:
             resp = await asyncio.wait_for(http_request(), timeout=2)
             t_spent = time.perf_counter() - start_time
             self.__logger.info(f"Respones after {t_spent} seconds")
-            status_code = resp[0].headers[0][1]
+            status_code = resp.status
             if status_code == b'200':
                 self.__logger.info("Normal request recieved 200 OK")
                 return True
@@ -1,7 +1,24 @@
+import itertools
 from enum import Enum
 from dataclasses import dataclass
 
 
+# Shared instances of values that repeat across requests, e.g. derivation
+# features and canonical tokens. Bounded, values beyond it are not shared.
+INTERN_CAPACITY = 1 << 16
+_interned = {}
+
+
+def intern_value(value):
+    """Returns the shared instance of a hashable value, see sys.intern."""
+    shared = _interned.get(value)
+    if shared is not None:
+        return shared
+    if len(_interned) < INTERN_CAPACITY:
+        _interned[value] = value
+    return value
+
+
 class TestType(Enum):
     TRANSFER_ENCODING = 1
     CONTENT_LENGTH = 2
@@ -28,6 +45,7 @@ class TestPhase(Enum):
     STATIC = 4
     FUZZING = 5
     FINISHED = 6
+    REPLAY = 7
 
 
 class TestState(Enum):
@@ -38,7 +56,7 @@ class TestState(Enum):
     FINISHED = 5
 
 
-@dataclass
+@dataclass(slots=True)
 class NonTerminal:
     name: str
     derivatives: list[list[str] | None]
@@ -47,48 +65,125 @@ class NonTerminal:
     is_illegal: bool
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Terminal:
     terminals: list[str]
     terminals_probabilities: list[float]
     mutations: list[list]
     mutations_probabilities: list[float]
     is_illegal: bool
+    # Set by Grammar.bind: per terminal, whether it is a malicious token,
+    # and the key of the terminal's mutation choice for the scheduler
+    malicious: list[bool] | None = None
+    key: str | None = None
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Header:
     name: str
     name_terminal: Terminal
     value_terminal: Terminal
 
 
-@dataclass
+# Largest DATA frame of a body stream, every frame is built in memory
+MAX_STREAM_CHUNK = 1 << 16
+
+
+@dataclass(frozen=True, slots=True)
+class BodyStream:
+    """
+    A request body that is described instead of stored.
+
+    The pattern is repeated up to size bytes, or until the request ends if
+    size is None, and sent as one DATA frame per entry of the chunk
+    schedule, which is cycled. With a content-length offset the request
+    declares a content-length of size + offset. Frames are generated when
+    they are sent, the whole body never exists in memory.
+    """
+    pattern: bytes
+    size: int | None
+    chunks: tuple[int, ...]
+    content_length_offset: int | None = None
+
+    @property
+    def content_length(self) -> int | None:
+        if self.content_length_offset is None:
+            return None
+        return self.size + self.content_length_offset
+
+    def frames(self):
+        """Yields (payload, end_stream) of every DATA frame."""
+        block = self.__block()
+        offset = 0
+        for chunk in itertools.cycle(self.chunks):
+            if self.size is not None:
+                chunk = min(chunk, self.size - offset)
+            start = offset % len(self.pattern)
+            offset += chunk
+            end_stream = self.size is not None and offset >= self.size
+            yield block[start:start + chunk], end_stream
+            if end_stream:
+                return
+
+    def matches(self, data: bytes | None) -> bool:
+        """Whether data is the complete body, e.g. as a backend received it."""
+        if data is None or self.size is None or len(data) != self.size:
+            return False
+        block = self.__block()
+        return all(data[offset:offset + len(block)]
+                   == block[:len(data) - offset]
+                   for offset in range(0, len(data), len(block)))
+
+    def describe(self) -> bytes:
+        """Short stand-in for the body in fingerprints, logs and results."""
+        size = "unbounded" if self.size is None else str(self.size)
+        description = (f"<stream {size} bytes of {self.pattern!r} in "
+                       f"chunks {','.join(map(str, self.chunks))}")
+        if self.content_length_offset is not None:
+            description += f", content-length {self.content_length}"
+        return (description + ">").encode()
+
+    def __block(self) -> bytes:
+        # Whole patterns, every frame is a slice of it
+        repeat = max(self.chunks) // len(self.pattern) + 2
+        return self.pattern * repeat
+
+
+@dataclass(slots=True)
 class Data:
-    load: bytes
+    load: bytes | BodyStream
     is_illegal: bool = False
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class PreTestAction:
     nonterminal: str
     derivative: int | None
     factor: float | None
 
 
-@dataclass
+@dataclass(slots=True)
 class PreTest:
     sequence: list[Header]
     influence: dict[dict[list[PreTestAction]] | None]
     result: TestResult | None
 
 
-@dataclass
+@dataclass(slots=True)
 class MaliciousLoad:
     all: list[bytes]
     chars: list[tuple[str, tuple[bytes, int]]] | None
 
 
+@dataclass(frozen=True, slots=True)
+class CorpusEntry:
+    request_id: int
+    sequence: list[str]
+    headers: list[tuple[bytes, bytes]]
+    data: bytes | BodyStream | None
+    malicious: MaliciousLoad
+
+
 class CharTable:
     def __init__(self,
                  chars: list[tuple[bytes, int]],
@@ -138,9 +233,10 @@ class CharTable:
                 self.chars.pop(index)
                 self.results.pop(index)
                 self.probabilities.pop(index)
-            index += 1
-        if len(char_list) > 0:
-            raise Exception("CharTable.__drop: char not found in table")
+            else:
+                index += 1
+        # Chars left over were dropped by the verdict of a request that was
+        # built from the same table state, e.g. prefetched or fanned out
         self.__calculate_possibilities()
         
     def __report(self, input_list, success):
@@ -157,8 +253,7 @@ class CharTable:
                     self.results[index][0] += 1
                 self.__sum_cache += self.__succes_rate(index)
             index += 1
-        if len(char_list) > 0:
-            raise Exception(f"CharTable.__report: {char_list[0]} not found in table")
+        # Chars left over were already dropped, see __drop
         self.__calculate_possibilities()
 
     def __calculate_possibilities(self):